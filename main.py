@@ -13,11 +13,24 @@ import time
 import asyncio
 import aiohttp
 import json
+import base64
 from urllib.parse import urlparse
 import re
+import uuid
+import random
+import hashlib
+import codecs
 import zipfile
 import tarfile
-from collections import defaultdict
+import sqlite3
+import shutil
+import threading
+import functools
+import bisect
+import weakref
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import defaultdict, OrderedDict, deque
 
 # LLM工具支持
 try:
@@ -34,12 +47,1872 @@ except ImportError:
 # 全局存储插件实例,供LLM工具访问
 _plugin_instance = None
 
+# 旧版本每个用户/群目录下的记录文件,仅用于一次性迁移
+LEGACY_RECORD_FILE = '.file_records.json'
+# 统一的SQLite记录库,位于存储根目录
+RECORD_DB_FILE = '.file_records.db'
+# 记录库快照文件后缀,记录库损坏时从快照恢复
+RECORD_SNAPSHOT_SUFFIX = '.snapshot'
+# 下载时累计多少字节再写盘一次
+DOWNLOAD_WRITE_BATCH = 256 * 1024
+# 分段下载进度旁路文件的后缀
+DOWNLOAD_SEGMENTS_SUFFIX = '.segments'
+# 单连接续传时保存服务器文件校验值(ETag/Last-Modified)的旁路文件后缀
+DOWNLOAD_VALIDATOR_SUFFIX = '.validator'
+# 按内容哈希去重存储的文件块目录,位于存储根目录
+BLOB_DIR = '.blobs'
+# 文件类型识别只看文件开头的这些字节
+SNIFF_HEAD_BYTES = 8192
+# 文本文件的BOM与对应编码,UTF-32需先于UTF-16判断
+TEXT_BOMS = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+# 过期清理每批最多删除的记录数,以及没有待过期记录时的最长休眠秒数
+CLEANUP_BATCH_SIZE = 200
+CLEANUP_MAX_SLEEP = 6 * 3600
+# 存储配额淘汰策略及其说明
+EVICTION_POLICY_NAMES = {'oldest': '最早接收', 'largest': '最大文件', 'lru': '最久未发送'}
+# 文件列表排序关键字、指令中的写法及对应的记录字段
+LIST_SORT_FIELDS = {'time': 'receive_time', 'size': 'file_size', 'name': 'final_filename'}
+LIST_SORT_ALIASES = {
+    '按时间': 'time', 'time': 'time', '按大小': 'size', 'size': 'size', '按名称': 'name', 'name': 'name',
+}
+LIST_SORT_NAMES = {'time': '按时间', 'size': '按大小', 'name': '按名称'}
+# 单页最多列出的文件数,以及为翻页保存游标的列表数
+LIST_PAGE_SIZE_MAX = 50
+LIST_CURSOR_CACHE_SIZE = 256
+# AI工具单次读取的最多字符数,以及搜索时的结果数、片段长度和扫描上限
+TOOL_READ_MAX_CHARS = 8000
+TOOL_SEARCH_MAX_RESULTS = 20
+TOOL_SEARCH_SNIPPET_CHARS = 80
+TOOL_SEARCH_SCAN_CHARS = 2 * 1024 * 1024
+TOOL_SEARCH_MAX_FILES = 50
+# 文件名索引的匹配方式说明
+FILE_NAME_MATCH_NAMES = {'exact': '完整名称', 'prefix': '名称开头', 'fuzzy': '相近名称'}
+# 存储对账时,最近这段时间内创建或链接的文件视为正在处理,不当作孤立文件
+RECONCILE_GRACE_SECONDS = 600
+# 对账发现的没有记录的文件移入各用户/群目录下的此目录隔离保存,不直接删除
+ORPHAN_DIR = '.orphans'
+# 文档提取文本的缓存文件后缀,与文件块放在一起,按内容哈希复用
+EXTRACTED_TEXT_SUFFIX = '.txt'
+# 以ZIP为容器的文件类型,需要读取中央目录才能准确区分
+ZIP_CONTAINER_TYPES = {
+    '.zip', '.docx', '.xlsx', '.pptx', '.jar', '.apk', '.epub', '.odt', '.ods', '.odp'
+}
+# 接收时建立成员索引的压缩包类型
+ARCHIVE_TYPES = {'.zip', '.jar', '.tar', '.gz'}
+# ZIP内mimetype条目内容与扩展名的对应关系(EPUB/OpenDocument)
+ZIP_MIMETYPE_EXTENSIONS = {
+    'application/epub+zip': '.epub',
+    'application/vnd.oasis.opendocument.text': '.odt',
+    'application/vnd.oasis.opendocument.spreadsheet': '.ods',
+    'application/vnd.oasis.opendocument.presentation': '.odp',
+}
+
+
+class DownloadRetryError(Exception):
+    """可重试的下载错误(连接中断、服务器5xx等)"""
+
+
+class DownloadSizeExceeded(Exception):
+    """下载的文件超过大小限制"""
+
+    def __init__(self, size=None):
+        super().__init__(f"文件大小超过限制: {size if size is not None else '未知'}")
+        self.size = size
+
+
+class ArchiveGuardError(Exception):
+    """压缩包成员读取被防护规则拒绝(压缩比、总大小、成员数超限等)"""
+
+
+class StorageReservation:
+    """准入时为待下载文件预留的存储配额,文件记录保存或下载失败后释放"""
+
+    def __init__(self, entity_key, size):
+        self.entity_key = entity_key
+        self.size = size
+        # 准入时为腾出空间而淘汰的记录,随完成消息一起告知用户
+        self.evicted = []
+        # 按全局上限从其他用户/群挑选、尚未删除的淘汰记录,需持有其记录锁删除
+        self.pending_evictions = []
+        self.released = False
+
+
+class HeadSniffer:
+    """在下载写盘的同时收集文件开头的字节,供类型识别使用,避免下载后再次读取文件"""
+
+    def __init__(self, head_size=SNIFF_HEAD_BYTES):
+        self.head_size = head_size
+        self._head = bytearray()
+        self.total = 0
+
+    @property
+    def complete(self):
+        return len(self._head) >= self.head_size
+
+    def feed(self, data):
+        self.total += len(data)
+        if not self.complete:
+            self._head.extend(data[:self.head_size - len(self._head)])
+
+    @property
+    def head(self):
+        return bytes(self._head)
+
+    @property
+    def whole_file(self):
+        """收集到的字节是否就是完整文件"""
+        return self.total <= self.head_size
+
+
+# ---- CPU密集的文件分析 ----
+# 以下函数在AnalysisPool的子进程中执行,只依赖标准库(PDF可选依赖pypdf)。
+# 文本提取函数返回提取的纯文本,最多max_chars个字符;不支持的文件返回None。
+
+_OOXML_NS = {
+    'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main',
+    'a': 'http://schemas.openxmlformats.org/drawingml/2006/main',
+    's': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main',
+    'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
+    'rel': 'http://schemas.openxmlformats.org/package/2006/relationships',
+}
+
+
+class _TextCollector:
+    """按字符上限收集文本行"""
+
+    def __init__(self, max_chars):
+        self.max_chars = max_chars
+        self.lines = []
+        self.size = 0
+
+    @property
+    def full(self):
+        return self.size >= self.max_chars
+
+    def add(self, line):
+        if self.full:
+            return
+        line = line[:self.max_chars - self.size]
+        self.lines.append(line)
+        self.size += len(line) + 1
+
+    def text(self):
+        return '\n'.join(self.lines)
+
+
+def _iter_xml_paragraphs(stream, paragraph_tag, text_tag, tab_tag=None):
+    """流式解析XML,逐段落返回其中文本节点拼接的内容"""
+    from xml.etree.ElementTree import iterparse
+    parts = []
+    for event, elem in iterparse(stream, events=('end',)):
+        if elem.tag == text_tag:
+            parts.append(elem.text or '')
+        elif tab_tag and elem.tag == tab_tag:
+            parts.append('\t')
+        elif elem.tag == paragraph_tag:
+            yield ''.join(parts)
+            parts = []
+            elem.clear()
+
+
+def _extract_docx_text(file_path, max_chars):
+    w = '{%s}' % _OOXML_NS['w']
+    collector = _TextCollector(max_chars)
+    with zipfile.ZipFile(file_path) as zf, zf.open('word/document.xml') as f:
+        for paragraph in _iter_xml_paragraphs(f, w + 'p', w + 't', w + 'tab'):
+            if paragraph.strip():
+                collector.add(paragraph)
+            if collector.full:
+                break
+    return collector.text()
+
+
+def _extract_pptx_text(file_path, max_chars):
+    a = '{%s}' % _OOXML_NS['a']
+    collector = _TextCollector(max_chars)
+    with zipfile.ZipFile(file_path) as zf:
+        slides = [name for name in zf.namelist() if re.fullmatch(r'ppt/slides/slide\d+\.xml', name)]
+        slides.sort(key=lambda name: int(re.search(r'(\d+)\.xml$', name).group(1)))
+        for number, name in enumerate(slides, 1):
+            collector.add(f"--- 幻灯片 {number} ---")
+            with zf.open(name) as f:
+                for paragraph in _iter_xml_paragraphs(f, a + 'p', a + 't'):
+                    if paragraph.strip():
+                        collector.add(paragraph)
+                    if collector.full:
+                        return collector.text()
+    return collector.text()
+
+
+def _xlsx_column_index(cell_ref):
+    """把单元格引用(如"AB12")的列字母转换为从0开始的列号"""
+    index = 0
+    for char in cell_ref:
+        if not char.isalpha():
+            break
+        index = index * 26 + (ord(char.upper()) - ord('A') + 1)
+    return index - 1
+
+
+def _extract_xlsx_text(file_path, max_chars):
+    """每个工作表输出为一段CSV"""
+    import csv
+    import io
+    from xml.etree.ElementTree import iterparse, parse
+    ns = '{%s}' % _OOXML_NS['s']
+    collector = _TextCollector(max_chars)
+    with zipfile.ZipFile(file_path) as zf:
+        names = set(zf.namelist())
+        shared_strings = []
+        if 'xl/sharedStrings.xml' in names:
+            with zf.open('xl/sharedStrings.xml') as f:
+                for event, elem in iterparse(f, events=('end',)):
+                    if elem.tag == ns + 'si':
+                        shared_strings.append(''.join(t.text or '' for t in elem.iter(ns + 't')))
+                        elem.clear()
+        
+        # 按工作簿中的顺序和名称找到各工作表文件
+        targets = {}
+        if 'xl/_rels/workbook.xml.rels' in names:
+            with zf.open('xl/_rels/workbook.xml.rels') as f:
+                for rel in parse(f).getroot().iter('{%s}Relationship' % _OOXML_NS['rel']):
+                    target = rel.get('Target', '').lstrip('/')
+                    targets[rel.get('Id')] = target if target.startswith('xl/') else 'xl/' + target
+        sheets = []
+        with zf.open('xl/workbook.xml') as f:
+            for sheet in parse(f).getroot().iter(ns + 'sheet'):
+                target = targets.get(sheet.get('{%s}id' % _OOXML_NS['r']))
+                if target in names:
+                    sheets.append((sheet.get('name', ''), target))
+        
+        for sheet_name, target in sheets:
+            collector.add(f"## 工作表: {sheet_name}")
+            with zf.open(target) as f:
+                for event, elem in iterparse(f, events=('end',)):
+                    if elem.tag != ns + 'row':
+                        continue
+                    row = []
+                    for cell in elem.iter(ns + 'c'):
+                        column = _xlsx_column_index(cell.get('r', '')) if cell.get('r') else len(row)
+                        cell_type = cell.get('t')
+                        if cell_type == 'inlineStr':
+                            value = ''.join(t.text or '' for t in cell.iter(ns + 't'))
+                        else:
+                            v = cell.find(ns + 'v')
+                            value = v.text if v is not None and v.text is not None else ''
+                            if cell_type == 's' and value.isdigit() and int(value) < len(shared_strings):
+                                value = shared_strings[int(value)]
+                        row.extend([''] * (column - len(row)))
+                        row.append(value)
+                    elem.clear()
+                    if any(row):
+                        buffer = io.StringIO()
+                        csv.writer(buffer, lineterminator='').writerow(row)
+                        collector.add(buffer.getvalue())
+                    if collector.full:
+                        return collector.text()
+    return collector.text()
+
+
+def _extract_pdf_text(file_path, max_chars):
+    """需要pypdf,未安装时返回None"""
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        return None
+    collector = _TextCollector(max_chars)
+    reader = PdfReader(file_path)
+    for page in reader.pages:
+        text = (page.extract_text() or '').strip()
+        if text:
+            collector.add(text)
+        if collector.full:
+            break
+    return collector.text()
+
+
+def detect_zip_container(file_path):
+    """根据ZIP中央目录中的条目名区分Office文档、jar、apk、epub、OpenDocument和普通ZIP
+
+    zipfile从文件末尾定位中央目录结束记录,只读取中央目录,
+    读取量与文件大小无关;不是有效ZIP时返回None。
+    """
+    try:
+        with zipfile.ZipFile(file_path) as zf:
+            names = zf.namelist()
+            name_set = set(names)
+            
+            # EPUB/OpenDocument在mimetype条目中声明类型
+            if 'mimetype' in name_set:
+                info = zf.getinfo('mimetype')
+                if info.file_size <= 128:
+                    mimetype = zf.read(info).decode('ascii', errors='ignore').strip()
+                    if mimetype in ZIP_MIMETYPE_EXTENSIONS:
+                        return ZIP_MIMETYPE_EXTENSIONS[mimetype]
+    except (zipfile.BadZipFile, OSError, RuntimeError, NotImplementedError):
+        return None
+    
+    # Office Open XML文档
+    if '[Content_Types].xml' in name_set:
+        prefixes = {name.split('/', 1)[0] for name in names if '/' in name}
+        if 'word' in prefixes:
+            return ".docx"
+        elif 'xl' in prefixes:
+            return ".xlsx"
+        elif 'ppt' in prefixes:
+            return ".pptx"
+    
+    # apk也带有META-INF,需先于jar判断
+    if 'AndroidManifest.xml' in name_set and 'classes.dex' in name_set:
+        return ".apk"
+    if 'META-INF/MANIFEST.MF' in name_set:
+        return ".jar"
+    return ".zip"
+
+
+def scan_archive(file_path, max_members):
+    """读取压缩包的成员名和大小,不解压内容;成员数超过上限时截断
+
+    ZIP只读取中央目录;tar逐个读取成员头,超过上限后停止扫描。
+    """
+    max_members = max(1, int(max_members))
+    members = []
+    member_count = 0
+    total_size = 0
+    truncated = False
+    if zipfile.is_zipfile(file_path):
+        archive_format = 'zip'
+        with zipfile.ZipFile(file_path) as zf:
+            compressed_size = 0
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                member_count += 1
+                total_size += info.file_size
+                compressed_size += info.compress_size
+                if len(members) < max_members:
+                    members.append({
+                        'name': info.filename, 'size': info.file_size, 'compressed_size': info.compress_size
+                    })
+            truncated = member_count > max_members
+    else:
+        archive_format = 'tar'
+        with tarfile.open(file_path, 'r:*') as tf:
+            for info in tf:
+                if not info.isfile():
+                    continue
+                member_count += 1
+                total_size += info.size
+                if member_count > max_members:
+                    truncated = True
+                    break
+                members.append({'name': info.name, 'size': info.size, 'compressed_size': None})
+        compressed_size = os.path.getsize(file_path)
+    return {
+        'format': archive_format,
+        'member_count': member_count,
+        'total_size': total_size,
+        'compressed_size': compressed_size,
+        'truncated': truncated,
+        'members': members
+    }
+
+
+# 文件类型到文本提取函数的映射,新增格式只需在这里注册
+TEXT_EXTRACTORS = {
+    '.pdf': _extract_pdf_text,
+    '.docx': _extract_docx_text,
+    '.xlsx': _extract_xlsx_text,
+    '.pptx': _extract_pptx_text,
+}
+
+
+def extract_document_text(file_type, file_path, max_chars):
+    """按文件类型提取文本,在子进程中执行"""
+    extractor = TEXT_EXTRACTORS.get(file_type)
+    if extractor is None:
+        return None
+    return extractor(file_path, max_chars)
+
+
+class AnalysisPool:
+    """CPU密集的文件分析(文本提取、压缩包索引、ZIP容器识别)使用的进程池
+
+    每个任务有超时;超时或工作进程崩溃时整个进程池被回收,下次提交时重建,
+    因回收而中断的其他任务会在新进程池中重试一次。按阶段统计耗时分布。
+    """
+
+    # 耗时直方图的分桶上限(毫秒),最后一个桶收纳更慢的任务
+    LATENCY_BUCKETS_MS = (10, 50, 100, 500, 1000, 5000, 30000)
+
+    def __init__(self, max_workers=2, timeout=60):
+        self.max_workers = max(1, int(max_workers))
+        self.timeout = timeout
+        self._pool = None
+        self._retired = weakref.WeakSet()
+        self._stages = {}
+        self.recycles = 0
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._pool
+
+    def _recycle(self, pool):
+        """终止进程池的工作进程并丢弃,运行中的任务随之中断"""
+        if pool in self._retired:
+            return
+        self._retired.add(pool)
+        if self._pool is pool:
+            self._pool = None
+        self.recycles += 1
+        for process in list((getattr(pool, '_processes', None) or {}).values()):
+            try:
+                process.terminate()
+            except Exception:
+                pass
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _stage_stats(self, stage):
+        if stage not in self._stages:
+            self._stages[stage] = {
+                'count': 0, 'failed': 0, 'timeouts': 0, 'crashes': 0, 'total_ms': 0.0,
+                'buckets': [0] * (len(self.LATENCY_BUCKETS_MS) + 1)
+            }
+        return self._stages[stage]
+
+    def _record(self, stage, elapsed_ms, outcome):
+        stats = self._stage_stats(stage)
+        stats['count'] += 1
+        stats['total_ms'] += elapsed_ms
+        stats['buckets'][bisect.bisect_left(self.LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        if outcome == 'timeout':
+            stats['timeouts'] += 1
+        elif outcome == 'crashed':
+            stats['crashes'] += 1
+        elif outcome != 'ok':
+            stats['failed'] += 1
+
+    async def run(self, stage, func, *args, timeout=None):
+        """在子进程中执行func(*args),超过超时时间抛出asyncio.TimeoutError"""
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        outcome = 'failed'
+        try:
+            for attempt in range(2):
+                pool = self._get_pool()
+                try:
+                    result = await asyncio.wait_for(
+                        loop.run_in_executor(pool, func, *args), timeout or self.timeout
+                    )
+                    outcome = 'ok'
+                    return result
+                except BrokenProcessPool:
+                    # 进程池被其他任务的超时回收时重试一次;真正的崩溃直接回收并报错
+                    if pool in self._retired and attempt == 0:
+                        continue
+                    outcome = 'crashed'
+                    self._recycle(pool)
+                    raise
+                except asyncio.TimeoutError:
+                    outcome = 'timeout'
+                    self._recycle(pool)
+                    raise
+        finally:
+            self._record(stage, (time.monotonic() - start) * 1000, outcome)
+
+    def stats(self):
+        """各阶段的任务数、失败/超时/崩溃次数、平均耗时和耗时分布"""
+        result = {}
+        for stage, stats in self._stages.items():
+            result[stage] = dict(stats)
+            result[stage]['avg_ms'] = stats['total_ms'] / stats['count'] if stats['count'] else 0.0
+        return result
+
+    def format_histogram(self, buckets):
+        """把耗时分布格式化为"≤10ms:3 ≤50ms:1 >30000ms:0"形式,省略空桶"""
+        labels = [f"≤{limit}ms" for limit in self.LATENCY_BUCKETS_MS] + [f">{self.LATENCY_BUCKETS_MS[-1]}ms"]
+        return ' '.join(f"{label}:{count}" for label, count in zip(labels, buckets) if count)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+class KeyedLock:
+    """按键区分的asyncio锁,不同键之间互不阻塞
+
+    锁对象保存在WeakValueDictionary中,没有协程持有或等待的键随锁对象一起被回收,
+    长时间运行也不会为每个出现过的用户/群累积一把锁。
+    """
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+
+    def __call__(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    def __len__(self):
+        return len(self._locks)
+
+
+class DiskIOExecutor:
+    """插件专用的磁盘I/O线程池
+
+    所有文件读写、目录遍历和记录库访问都经由此线程池执行,避免阻塞事件循环;
+    提交数量受max_pending限制,超出时调用方等待,起到背压作用。
+    """
+
+    def __init__(self, max_workers=4, max_pending=256):
+        self.max_workers = max(1, int(max_workers))
+        self.max_pending = max(1, int(max_pending))
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='file_handler_io')
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._stats_lock = threading.Lock()
+        self.submitted = 0
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.peak_queued = 0
+
+    async def run(self, func, *args, **kwargs):
+        """在线程池中执行阻塞函数并等待结果"""
+        async with self._slots:
+            with self._stats_lock:
+                self.submitted += 1
+                self.peak_queued = max(self.peak_queued, self.submitted - self.started)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(self._call, func, args, kwargs))
+
+    def _call(self, func, args, kwargs):
+        with self._stats_lock:
+            self.started += 1
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            with self._stats_lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._stats_lock:
+                self.completed += 1
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'queued': self.submitted - self.started,
+                'active': self.started - self.completed,
+                'peak_queued': self.peak_queued,
+                'completed': self.completed,
+                'failed': self.failed,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class DownloadScheduler:
+    """文件下载调度器
+
+    固定数量的工作协程构成全局并发上限,每个用户/群另有并发上限;
+    有待下载文件的用户/群按轮询顺序依次取任务,单个刷屏的群不会饿死其他群。
+    排队总数有上限,队列满时submit等待,对消息处理形成背压。
+    """
+
+    def __init__(self, max_concurrent=4, per_entity_limit=2, max_queued=100, debug_mode=False):
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.per_entity_limit = max(1, int(per_entity_limit))
+        self.max_queued = max(1, int(max_queued))
+        self.debug_mode = debug_mode
+        self._queues = {}
+        self._round_robin = deque()
+        self._in_flight = defaultdict(int)
+        self._queued = 0
+        self._cond = asyncio.Condition()
+        self._workers = []
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.peak_queued = 0
+
+    def start(self):
+        """启动工作协程"""
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrent)]
+
+    async def submit(self, entity_key, job):
+        """提交下载任务,job为无参数的协程函数;队列已满时等待"""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._queued < self.max_queued)
+            queue = self._queues.get(entity_key)
+            if queue is None:
+                queue = self._queues[entity_key] = deque()
+                self._round_robin.append(entity_key)
+            queue.append(job)
+            self._queued += 1
+            self.submitted += 1
+            self.peak_queued = max(self.peak_queued, self._queued)
+            self._cond.notify_all()
+
+    def is_full(self):
+        """排队任务是否已达上限"""
+        return self._queued >= self.max_queued
+
+    def _next_job(self):
+        """按轮询顺序取出下一个未达并发上限的用户/群的任务,调用方需持有条件锁"""
+        for _ in range(len(self._round_robin)):
+            entity_key = self._round_robin[0]
+            self._round_robin.rotate(-1)
+            if self._in_flight[entity_key] >= self.per_entity_limit:
+                continue
+            queue = self._queues[entity_key]
+            job = queue.popleft()
+            if not queue:
+                del self._queues[entity_key]
+                self._round_robin.remove(entity_key)
+            return entity_key, job
+        return None
+
+    async def _worker(self):
+        while True:
+            async with self._cond:
+                picked = self._next_job()
+                while picked is None:
+                    await self._cond.wait()
+                    picked = self._next_job()
+                entity_key, job = picked
+                self._queued -= 1
+                self._in_flight[entity_key] += 1
+                self._cond.notify_all()
+
+            try:
+                await job()
+                self.completed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"[DownloadScheduler] 下载任务出错 ({entity_key}): {e}")
+            finally:
+                async with self._cond:
+                    self._in_flight[entity_key] -= 1
+                    if self._in_flight[entity_key] <= 0:
+                        del self._in_flight[entity_key]
+                    self._cond.notify_all()
+
+    def stats(self):
+        return {
+            'max_concurrent': self.max_concurrent,
+            'per_entity_limit': self.per_entity_limit,
+            'max_queued': self.max_queued,
+            'queued': self._queued,
+            'in_flight': sum(self._in_flight.values()),
+            'active_entities': len(self._in_flight),
+            'waiting_entities': len(self._queues),
+            'peak_queued': self.peak_queued,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+        }
+
+    async def shutdown(self):
+        for worker in self._workers:
+            worker.cancel()
+        if self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+class RecordListCache:
+    """按用户/群目录缓存已解析记录列表的LRU缓存
+
+    写操作由FileRecordStore同步更新缓存(写穿),容量超出时淘汰最久未使用的目录。
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max(1, int(max_entries))
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        records = self._entries.get(key)
+        if records is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return records
+
+    def put(self, key, records):
+        self._entries[key] = records
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def peek(self, key):
+        """读取缓存但不影响命中统计和LRU顺序"""
+        return self._entries.get(key)
+
+    def pop(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        if self._entries:
+            self.invalidations += 1
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+class FileNameIndex:
+    """单个用户/群成功记录的文件名索引,文件名与原始文件名都参与匹配,不区分大小写
+
+    依次尝试:精确匹配(哈希表)、前缀匹配(有序列表二分查找)、模糊匹配(1~3字符n-gram倒排索引,
+    按命中的n-gram比例排序)。records按接收时间从新到旧排列,位置即显示序号减一,
+    同等匹配程度时较新的文件优先,查找结果是确定的。
+    """
+
+    # 模糊匹配时查询的n-gram至少有这个比例出现在文件名中才算候选
+    FUZZY_MIN_SCORE = 0.5
+
+    def __init__(self, records):
+        self.records = records
+        self._exact = {}
+        self._trigrams = defaultdict(set)
+        names = []
+        for position, record in enumerate(records):
+            for name in self._record_names(record):
+                self._exact.setdefault(name, []).append(position)
+                names.append((name, position))
+                for size in (1, 2, 3):
+                    for gram in self._ngrams(name, size):
+                        self._trigrams[gram].add(position)
+        names.sort()
+        self._sorted_names = [name for name, _ in names]
+        self._sorted_positions = [position for _, position in names]
+
+    @staticmethod
+    def _record_names(record):
+        return {name.lower() for name in (record.get('final_filename'), record.get('original_name')) if name}
+
+    @staticmethod
+    def _ngrams(text, size):
+        return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+    def lookup(self, query):
+        """查找文件名,返回(匹配方式, 按匹配程度排序的记录位置列表),匹配方式为exact/prefix/fuzzy"""
+        query = query.strip().lower()
+        if not query:
+            return None, []
+        
+        if query in self._exact:
+            return 'exact', sorted(set(self._exact[query]))
+        
+        start = bisect.bisect_left(self._sorted_names, query)
+        prefix_hits = {}
+        for i in range(start, len(self._sorted_names)):
+            name = self._sorted_names[i]
+            if not name.startswith(query):
+                break
+            position = self._sorted_positions[i]
+            prefix_hits[position] = min(len(name), prefix_hits.get(position, len(name)))
+        if prefix_hits:
+            # 文件名越短越接近查询,其次较新的优先
+            return 'prefix', sorted(prefix_hits, key=lambda position: (prefix_hits[position], position))
+        
+        ranked = [position for position, _ in self._fuzzy_scores(query) if _ >= self.FUZZY_MIN_SCORE]
+        return ('fuzzy', ranked) if ranked else (None, [])
+
+    def suggest(self, query, limit=3):
+        """找不到文件时给出最接近的几个文件"""
+        return [self.records[position] for position, _ in self._fuzzy_scores(query.strip().lower())[:limit]]
+
+    def _fuzzy_scores(self, query):
+        """按n-gram重合比例给候选记录打分,包含完整查询串的记录排在最前,返回[(位置, 分数)]"""
+        grams = self._ngrams(query, min(3, len(query)))
+        if not grams:
+            return []
+        shared = defaultdict(int)
+        for gram in grams:
+            for position in self._trigrams.get(gram, ()):
+                shared[position] += 1
+        scored = []
+        for position, count in shared.items():
+            contains = any(query in name for name in self._record_names(self.records[position]))
+            scored.append((not contains, -count / len(grams), position))
+        scored.sort()
+        return [(position, -score) for _, score, position in scored]
+
+
+class FileRecordStore:
+    """基于SQLite(WAL模式)的文件记录存储
+
+    所有用户/群的文件记录集中保存在一个库中,按(类型, ID, 接收时间)和下载状态建立索引,
+    查询、数量限制检查和过期清理都走索引,不再整体解析和重写JSON文件。
+    """
+
+    # 记录字段,与旧版.file_records.json中的键保持一致
+    RECORD_FIELDS = (
+        'identifier', 'type', 'original_name', 'final_filename', 'file_path', 'file_url',
+        'file_id', 'file_size', 'file_type', 'receive_time', 'sender', 'platform', 'download_status',
+        'sha256', 'text_encoding', 'last_sent'
+    )
+
+    # 超出存储配额时挑选淘汰记录的排序方式
+    EVICTION_ORDER = {
+        'oldest': 'receive_time ASC',
+        'largest': 'file_size DESC, receive_time ASC',
+        'lru': 'COALESCE(last_sent, receive_time) ASC',
+    }
+
+    # 按顺序执行的表结构迁移,PRAGMA user_version记录已执行到的版本
+    SCHEMA_MIGRATIONS = (
+        """
+        CREATE TABLE IF NOT EXISTS file_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT NOT NULL,
+            identifier TEXT NOT NULL,
+            original_name TEXT,
+            final_filename TEXT,
+            file_path TEXT,
+            file_url TEXT,
+            file_id TEXT,
+            file_size INTEGER NOT NULL DEFAULT 0,
+            file_type TEXT,
+            receive_time REAL NOT NULL DEFAULT 0,
+            sender TEXT,
+            platform TEXT,
+            download_status TEXT NOT NULL DEFAULT 'success'
+        );
+        CREATE INDEX IF NOT EXISTS idx_records_entity_time ON file_records(type, identifier, receive_time);
+        CREATE INDEX IF NOT EXISTS idx_records_status ON file_records(download_status);
+        CREATE INDEX IF NOT EXISTS idx_records_time ON file_records(receive_time);
+        CREATE TABLE IF NOT EXISTS legacy_imports (
+            path TEXT PRIMARY KEY,
+            imported_at REAL NOT NULL
+        );
+        """,
+        # 按内容哈希去重的文件块,记录通过sha256引用,引用计数归零时删除
+        """
+        ALTER TABLE file_records ADD COLUMN sha256 TEXT;
+        CREATE INDEX IF NOT EXISTS idx_records_sha256 ON file_records(sha256);
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL DEFAULT 0,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            created_time REAL NOT NULL
+        );
+        """,
+        # 平台文件ID到已存储文件块的索引,同一文件再次出现时无需下载
+        """
+        CREATE TABLE IF NOT EXISTS file_id_index (
+            file_id TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            file_type TEXT,
+            last_seen REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_file_id_sha256 ON file_id_index(sha256);
+        """,
+        # 下载时识别出的文本编码,自动读取时直接使用
+        """
+        ALTER TABLE file_records ADD COLUMN text_encoding TEXT;
+        ALTER TABLE file_id_index ADD COLUMN text_encoding TEXT;
+        """,
+        # 压缩包成员索引,按文件块哈希保存,相同内容的压缩包只索引一次
+        """
+        CREATE TABLE IF NOT EXISTS archives (
+            sha256 TEXT PRIMARY KEY,
+            format TEXT NOT NULL,
+            member_count INTEGER NOT NULL,
+            total_size INTEGER NOT NULL,
+            compressed_size INTEGER NOT NULL,
+            truncated INTEGER NOT NULL DEFAULT 0,
+            indexed_time REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS archive_members (
+            sha256 TEXT NOT NULL,
+            member_index INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            compressed_size INTEGER,
+            PRIMARY KEY (sha256, member_index)
+        );
+        """,
+        # 最近一次发送时间,按最近最少使用淘汰文件时使用
+        """
+        ALTER TABLE file_records ADD COLUMN last_sent REAL;
+        """,
+        # 分页列出文件时按大小、文件名排序使用的索引
+        """
+        CREATE INDEX IF NOT EXISTS idx_records_entity_size ON file_records(type, identifier, file_size);
+        CREATE INDEX IF NOT EXISTS idx_records_entity_name ON file_records(type, identifier, final_filename COLLATE NOCASE);
+        """,
+    )
+
+    # 分页列出文件时可用的排序字段
+    PAGE_SORT_COLUMNS = {
+        'time': 'receive_time',
+        'size': 'file_size',
+        'name': 'final_filename COLLATE NOCASE',
+    }
+
+    def __init__(self, db_path, debug_mode=False, cache_size=256):
+        self.db_path = db_path
+        self.debug_mode = debug_mode
+        # 同一连接会被事件循环和线程池共同使用,用锁串行化
+        self._lock = threading.RLock()
+        # 本次启动是否从快照恢复
+        self.restored_from_snapshot = False
+        # 记录库是新建的或从快照/空库恢复的,磁盘上已有的文件可能没有记录,下次对账时补登而不是隔离
+        self.adopt_orphans_pending = False
+        self._conn = self._open_database()
+        self._migrate_schema()
+        self.cache = RecordListCache(cache_size)
+        # 各用户/群的文件名索引,与记录缓存同步失效
+        self.name_indexes = RecordListCache(cache_size)
+        # 记录变更代数:某个用户/群的记录增删时递增其代数,外部修改或整体重建时递增全局代数;分页游标据此失效
+        self._generation = 0
+        self._entity_generations = defaultdict(int)
+        self._data_version = self._read_data_version()
+        # 各用户/群成功记录的文件数和字节数,首次使用时统计一次,之后随增删记录增量维护
+        self._usage = None
+        self._usage_total = [0, 0]
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @staticmethod
+    def _is_corruption_error(error):
+        """是否为库文件损坏(SQLITE_CORRUPT/SQLITE_NOTADB);被锁定、无法打开等错误不算"""
+        code = getattr(error, 'sqlite_errorcode', None)
+        if code is not None:
+            return code & 0xFF in (11, 26)
+        message = str(error).lower()
+        return 'malformed' in message or 'not a database' in message
+
+    @staticmethod
+    def _quick_check(conn):
+        """PRAGMA quick_check的结果,'ok'表示通过"""
+        return conn.execute('PRAGMA quick_check').fetchone()[0]
+
+    def _open_database(self):
+        """打开记录库并做快速完整性检查;库文件损坏时移到一旁,从最近的快照恢复
+
+        只有quick_check不通过或SQLite报告库文件损坏时才视为损坏,被锁定等其他错误直接抛出,
+        不会因为一次打开失败就把正常的记录库移走。
+        """
+        if not os.path.exists(self.db_path):
+            self.adopt_orphans_pending = True
+        conn = None
+        try:
+            conn = self._connect()
+            result = self._quick_check(conn)
+            if result == 'ok':
+                return conn
+            conn.close()
+        except sqlite3.DatabaseError as e:
+            if conn is not None:
+                conn.close()
+            if not self._is_corruption_error(e):
+                raise
+            result = str(e)
+        
+        corrupt_path = f"{self.db_path}.corrupt-{int(time.time())}"
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db_path + suffix):
+                os.replace(self.db_path + suffix, corrupt_path + suffix)
+        logger.error(f"[FileStore] 记录库损坏({result}),已移动到 {corrupt_path}")
+        
+        # 库是重建的,不论能否从快照恢复,磁盘上的文件都要在对账时补登
+        self.adopt_orphans_pending = True
+        snapshot_path = self.db_path + RECORD_SNAPSHOT_SUFFIX
+        if os.path.exists(snapshot_path):
+            snapshot_result = self._check_snapshot(snapshot_path)
+            if snapshot_result == 'ok':
+                shutil.copyfile(snapshot_path, self.db_path)
+                self.restored_from_snapshot = True
+                logger.warning(f"[FileStore] 已从快照恢复记录库: {snapshot_path}")
+            else:
+                logger.error(f"[FileStore] 快照校验失败({snapshot_result}),以空记录库启动: {snapshot_path}")
+        return self._connect()
+
+    def _check_snapshot(self, snapshot_path):
+        """以只读方式对快照做quick_check,返回检查结果"""
+        try:
+            conn = sqlite3.connect(f"file:{snapshot_path}?mode=ro", uri=True)
+            try:
+                return self._quick_check(conn)
+            finally:
+                conn.close()
+        except sqlite3.DatabaseError as e:
+            return str(e)
+
+    def snapshot(self):
+        """生成记录库快照:先完整写入临时文件并落盘,再原子替换旧快照,任何时刻都保留一份完整快照"""
+        snapshot_path = self.db_path + RECORD_SNAPSHOT_SUFFIX
+        temp_path = snapshot_path + '.tmp'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        target = sqlite3.connect(temp_path)
+        try:
+            with self._lock:
+                self._conn.backup(target)
+        finally:
+            target.close()
+        with open(temp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(temp_path, snapshot_path)
+        return snapshot_path
+
+    def checkpoint(self):
+        """把WAL中的内容写回主库并截断WAL文件,返回写回的页数"""
+        with self._lock:
+            row = self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        return row[2]
+
+    def _read_data_version(self):
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def _revalidate_cache(self):
+        """其他连接修改过记录库时(data_version变化)整体作废缓存"""
+        data_version = self._read_data_version()
+        if data_version != self._data_version:
+            self._data_version = data_version
+            self.cache.clear()
+            self.name_indexes.clear()
+            self._generation += 1
+            self._usage = None
+            if self.debug_mode:
+                logger.info("[FileStore] 记录库被外部修改,已清空记录缓存")
+
+    @staticmethod
+    def entity_key(entity_type, entity_id):
+        """缓存键,与用户/群存储目录名一致"""
+        return f"{entity_type}_{entity_id}"
+
+    @staticmethod
+    def _sort_records(records):
+        records.sort(key=lambda r: (r.get('receive_time', 0), r.get('id', 0)), reverse=True)
+
+    def _entity_records(self, entity_type, entity_id):
+        """获取某个用户/群的全部记录(新到旧),优先使用缓存,调用方需持有锁"""
+        self._revalidate_cache()
+        key = self.entity_key(entity_type, entity_id)
+        records = self.cache.get(key)
+        if records is None:
+            records = [self._row_to_record(row) for row in self._conn.execute(
+                'SELECT * FROM file_records WHERE type = ? AND identifier = ? '
+                'ORDER BY receive_time DESC, id DESC',
+                (entity_type, str(entity_id))
+            )]
+            self.cache.put(key, records)
+        return records
+
+    def _rows_for(self, record_ids):
+        """查询一组记录的归属、大小和状态,调用方需持有锁"""
+        rows = []
+        record_ids = list(record_ids)
+        for start in range(0, len(record_ids), 500):
+            chunk = record_ids[start:start + 500]
+            placeholders = ', '.join('?' for _ in chunk)
+            rows.extend(self._conn.execute(
+                f'SELECT type, identifier, file_size, download_status FROM file_records WHERE id IN ({placeholders})',
+                chunk
+            ))
+        return rows
+
+    def _load_usage(self):
+        """统计各用户/群的成功记录数和字节数,调用方需持有锁"""
+        self._revalidate_cache()
+        if self._usage is None:
+            self._usage = {}
+            self._usage_total = [0, 0]
+            for row in self._conn.execute(
+                'SELECT type, identifier, COUNT(*), COALESCE(SUM(file_size), 0) FROM file_records '
+                'WHERE download_status = \'success\' GROUP BY type, identifier'
+            ):
+                self._usage[self.entity_key(row[0], row[1])] = [row[2], row[3]]
+                self._usage_total[0] += row[2]
+                self._usage_total[1] += row[3]
+        return self._usage
+
+    def _adjust_usage(self, key, files, size):
+        """增量更新用量计数,调用方需持有锁"""
+        if self._usage is None:
+            return
+        usage = self._usage.setdefault(key, [0, 0])
+        usage[0] += files
+        usage[1] += size
+        self._usage_total[0] += files
+        self._usage_total[1] += size
+        if usage[0] <= 0:
+            del self._usage[key]
+
+    def entity_usage(self, entity_type, entity_id):
+        """某个用户/群的成功记录数和字节数"""
+        with self._lock:
+            files, size = self._load_usage().get(self.entity_key(entity_type, entity_id), (0, 0))
+        return {'files': files, 'bytes': size}
+
+    def total_usage(self):
+        """全部用户/群的成功记录数和字节数合计"""
+        with self._lock:
+            self._load_usage()
+            files, size = self._usage_total
+        return {'files': files, 'bytes': size}
+
+    def usage_snapshot(self):
+        """全部用户/群的用量,{缓存键: {'files', 'bytes'}}"""
+        with self._lock:
+            return {key: {'files': files, 'bytes': size} for key, (files, size) in self._load_usage().items()}
+
+    def reset_usage(self):
+        """丢弃用量计数,下次使用时重新统计"""
+        with self._lock:
+            self._usage = None
+
+    def _touch_entity(self, key):
+        """某个用户/群的记录有增删:作废文件名索引并递增其变更代数,调用方需持有锁"""
+        self.name_indexes.pop(key)
+        self._entity_generations[key] += 1
+
+    def entity_generation(self, entity_type, entity_id):
+        """某个用户/群记录的当前变更代数,记录增删或外部修改后变化"""
+        with self._lock:
+            self._revalidate_cache()
+            return self._generation, self._entity_generations[self.entity_key(entity_type, entity_id)]
+
+    def _discard_cached(self, keys, record_ids):
+        """从缓存的记录列表中移除已删除的记录"""
+        record_ids = set(record_ids)
+        for key in keys:
+            self._touch_entity(key)
+            records = self.cache.peek(key)
+            if records is not None:
+                records[:] = [r for r in records if r.get('id') not in record_ids]
+
+    def _migrate_schema(self):
+        """执行尚未应用的表结构迁移"""
+        with self._lock:
+            version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+            for index, script in enumerate(self.SCHEMA_MIGRATIONS[version:], start=version + 1):
+                self._conn.executescript(script)
+                self._conn.execute(f'PRAGMA user_version = {index}')
+                if self.debug_mode:
+                    logger.info(f"[FileStore] 记录库结构已升级到版本 {index}")
+
+    @classmethod
+    def _normalize_record(cls, record_info):
+        """将记录字典转换为数据库列值"""
+        values = {field: record_info.get(field) for field in cls.RECORD_FIELDS}
+        values['identifier'] = str(values['identifier'] or '')
+        values['type'] = values['type'] or 'user'
+        if values['file_id'] is not None:
+            values['file_id'] = str(values['file_id'])
+        try:
+            values['file_size'] = int(values['file_size'] or 0)
+        except (TypeError, ValueError):
+            values['file_size'] = 0
+        try:
+            values['receive_time'] = float(values['receive_time'] or 0)
+        except (TypeError, ValueError):
+            values['receive_time'] = 0.0
+        values['download_status'] = values['download_status'] or 'success'
+        return values
+
+    @staticmethod
+    def _row_to_record(row):
+        """数据库行转换为记录字典,空列不输出以兼容旧记录中缺省的键"""
+        return {key: row[key] for key in row.keys() if row[key] is not None}
+
+    def _insert(self, record_info):
+        values = self._normalize_record(record_info)
+        columns = ', '.join(self.RECORD_FIELDS)
+        placeholders = ', '.join('?' for _ in self.RECORD_FIELDS)
+        cursor = self._conn.execute(
+            f'INSERT INTO file_records ({columns}) VALUES ({placeholders})',
+            [values[field] for field in self.RECORD_FIELDS]
+        )
+        return cursor.lastrowid
+
+    def add_record(self, record_info):
+        """新增一条记录,返回记录ID"""
+        with self._lock:
+            with self._conn:
+                record_id = self._insert(record_info)
+            if (record_info.get('download_status') or 'success') == 'success':
+                self._adjust_usage(
+                    self.entity_key(record_info.get('type') or 'user', record_info.get('identifier') or ''),
+                    1, int(record_info.get('file_size') or 0)
+                )
+            key = self.entity_key(record_info.get('type') or 'user', record_info.get('identifier') or '')
+            self._touch_entity(key)
+            cached = self.cache.peek(key)
+            if cached is not None:
+                record = {k: v for k, v in self._normalize_record(record_info).items() if v is not None}
+                record['id'] = record_id
+                cached.append(record)
+                self._sort_records(cached)
+            return record_id
+
+    def list_records(self, entity_type, entity_id, status='success', newest_first=True):
+        """按接收时间列出某个用户/群的记录,status为None时返回全部状态"""
+        with self._lock:
+            records = self._entity_records(entity_type, entity_id)
+            result = [dict(r) for r in records if status is None or r.get('download_status') == status]
+        if not newest_first:
+            result.reverse()
+        return result
+
+    def name_index(self, entity_type, entity_id):
+        """某个用户/群成功记录的文件名索引,记录变化后下次使用时重建"""
+        key = self.entity_key(entity_type, entity_id)
+        with self._lock:
+            records = self._entity_records(entity_type, entity_id)
+            index = self.name_indexes.get(key)
+            if index is None:
+                index = FileNameIndex([dict(r) for r in records if r.get('download_status') == 'success'])
+                self.name_indexes.put(key, index)
+            return index
+
+    def list_records_before(self, receive_time, limit=None):
+        """按接收时间从早到晚列出早于指定时间的记录,limit限制返回数量"""
+        sql = 'SELECT * FROM file_records WHERE receive_time < ? ORDER BY receive_time ASC'
+        params = [receive_time]
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(int(limit))
+        with self._lock:
+            return [self._row_to_record(row) for row in self._conn.execute(sql, params)]
+
+    def page_records(self, entity_type, entity_id, sort='time', descending=True, limit=10, after=None,
+                     offset=0, file_type=None, since=None, until=None, min_size=None, max_size=None):
+        """按页列出某个用户/群的成功记录,返回(本页记录, 是否还有下一页)
+
+        after为上一页最后一条记录的(排序值, 记录ID),从它之后沿索引继续读取,每页只读取limit+1行;
+        没有after时按offset跳过前面的记录。
+        """
+        column = self.PAGE_SORT_COLUMNS.get(sort, self.PAGE_SORT_COLUMNS['time'])
+        sql = 'SELECT * FROM file_records WHERE type = ? AND identifier = ? AND download_status = \'success\''
+        params = [entity_type, str(entity_id)]
+        if file_type:
+            sql += ' AND LOWER(file_type) = ?'
+            params.append(file_type.lower())
+        if since is not None:
+            sql += ' AND receive_time >= ?'
+            params.append(since)
+        if until is not None:
+            sql += ' AND receive_time < ?'
+            params.append(until)
+        if min_size is not None:
+            sql += ' AND file_size >= ?'
+            params.append(int(min_size))
+        if max_size is not None:
+            sql += ' AND file_size <= ?'
+            params.append(int(max_size))
+        if after is not None:
+            # 第一个条件是可沿索引定位的范围,第二个条件排除排序值相同且已列出的记录
+            op = '<' if descending else '>'
+            sql += f' AND {column} {op}= ? AND ({column} {op} ? OR id {op} ?)'
+            params += [after[0], after[0], after[1]]
+        direction = 'DESC' if descending else 'ASC'
+        sql += f' ORDER BY {column} {direction}, id {direction} LIMIT ?'
+        params.append(int(limit) + 1)
+        if after is None and offset:
+            sql += ' OFFSET ?'
+            params.append(int(offset))
+        with self._lock:
+            records = [self._row_to_record(row) for row in self._conn.execute(sql, params)]
+        has_more = len(records) > limit
+        return records[:limit], has_more
+
+    def eviction_candidates(self, policy, entity_type=None, entity_id=None, limit=20):
+        """按淘汰策略列出成功记录,不指定用户/群时在全部记录中挑选"""
+        order = self.EVICTION_ORDER.get(policy, self.EVICTION_ORDER['oldest'])
+        sql = 'SELECT * FROM file_records WHERE download_status = \'success\''
+        params = []
+        if entity_type is not None:
+            sql += ' AND type = ? AND identifier = ?'
+            params += [entity_type, str(entity_id)]
+        sql += f' ORDER BY {order} LIMIT ?'
+        params.append(int(limit))
+        with self._lock:
+            return [self._row_to_record(row) for row in self._conn.execute(sql, params)]
+
+    def mark_sent(self, record_id):
+        """记录文件最近一次被发送的时间"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT type, identifier FROM file_records WHERE id = ?', (record_id,)).fetchone()
+            if row is None:
+                return
+            with self._conn:
+                self._conn.execute('UPDATE file_records SET last_sent = ? WHERE id = ?', (now, record_id))
+            for record in self.cache.peek(self.entity_key(row['type'], row['identifier'])) or ():
+                if record.get('id') == record_id:
+                    record['last_sent'] = now
+
+    def earliest_receive_time(self):
+        """最早一条记录的接收时间,没有记录时返回None;走receive_time索引,不扫描全表"""
+        with self._lock:
+            row = self._conn.execute('SELECT MIN(receive_time) FROM file_records').fetchone()
+        return row[0] if row else None
+
+    def has_record(self, record_id):
+        """记录是否仍然存在"""
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM file_records WHERE id = ?', (record_id,)).fetchone() is not None
+
+    def delete_record(self, record_id):
+        """删除单条记录"""
+        self.delete_records([record_id])
+
+    def delete_records(self, record_ids):
+        """批量删除记录"""
+        record_ids = list(record_ids)
+        if not record_ids:
+            return
+        with self._lock:
+            rows = self._rows_for(record_ids)
+            keys = {self.entity_key(row['type'], row['identifier']) for row in rows}
+            with self._conn:
+                self._conn.executemany('DELETE FROM file_records WHERE id = ?', [(rid,) for rid in record_ids])
+            for row in rows:
+                if row['download_status'] == 'success':
+                    self._adjust_usage(self.entity_key(row['type'], row['identifier']), -1, -(row['file_size'] or 0))
+            self._discard_cached(keys, record_ids)
+
+    def delete_entity_records(self, entity_type, entity_id):
+        """删除某个用户/群的全部记录,返回删除数量"""
+        with self._lock:
+            with self._conn:
+                cursor = self._conn.execute(
+                    'DELETE FROM file_records WHERE type = ? AND identifier = ?',
+                    (entity_type, str(entity_id))
+                )
+            key = self.entity_key(entity_type, entity_id)
+            self.cache.pop(key)
+            self._touch_entity(key)
+            if self._usage is not None and key in self._usage:
+                files, size = self._usage[key]
+                self._adjust_usage(key, -files, -size)
+            return cursor.rowcount
+
+    def acquire_blob(self, sha256, size):
+        """增加文件块的引用计数,返回增加后的计数"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO blobs (sha256, size, ref_count, created_time) VALUES (?, ?, 1, ?) '
+                'ON CONFLICT(sha256) DO UPDATE SET ref_count = ref_count + 1',
+                (sha256, int(size or 0), time.time())
+            )
+            return self._conn.execute('SELECT ref_count FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()[0]
+
+    def release_blob(self, sha256):
+        """减少文件块的引用计数,返回剩余计数;归零时删除该文件块的记录"""
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT ref_count FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()
+            if row is None:
+                return 0
+            remaining = max(0, row[0] - 1)
+            if remaining:
+                self._conn.execute('UPDATE blobs SET ref_count = ? WHERE sha256 = ?', (remaining, sha256))
+            else:
+                self._drop_blob_rows(sha256)
+            return remaining
+
+    def _drop_blob_rows(self, sha256):
+        """删除文件块及依附于它的文件ID索引、压缩包索引,调用方需持有锁并处于事务中"""
+        self._conn.execute('DELETE FROM blobs WHERE sha256 = ?', (sha256,))
+        self._conn.execute('DELETE FROM file_id_index WHERE sha256 = ?', (sha256,))
+        self._conn.execute('DELETE FROM archives WHERE sha256 = ?', (sha256,))
+        self._conn.execute('DELETE FROM archive_members WHERE sha256 = ?', (sha256,))
+
+    def blob_reference_counts(self):
+        """返回(文件块表中的引用计数, 成功记录实际引用的次数),用于校正引用计数"""
+        with self._lock:
+            stored = {row[0]: row[1] for row in self._conn.execute('SELECT sha256, ref_count FROM blobs')}
+            referenced = {row[0]: row[1] for row in self._conn.execute(
+                'SELECT sha256, COUNT(*) FROM file_records WHERE sha256 IS NOT NULL '
+                'AND download_status = \'success\' GROUP BY sha256'
+            )}
+        return stored, referenced
+
+    def set_blob_ref_count(self, sha256, ref_count):
+        """校正文件块的引用计数,为0时与release_blob一样删除相关索引"""
+        with self._lock, self._conn:
+            if ref_count > 0:
+                self._conn.execute('UPDATE blobs SET ref_count = ? WHERE sha256 = ?', (ref_count, sha256))
+            else:
+                self._drop_blob_rows(sha256)
+
+    def remember_file_id(self, file_id, sha256, file_type, text_encoding=None):
+        """记录平台文件ID对应的文件块"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO file_id_index (file_id, sha256, file_type, text_encoding, last_seen) '
+                'VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT(file_id) DO UPDATE SET sha256 = excluded.sha256, file_type = excluded.file_type, '
+                'text_encoding = excluded.text_encoding, last_seen = excluded.last_seen',
+                (str(file_id), sha256, file_type, text_encoding, time.time())
+            )
+
+    def lookup_file_id(self, file_id):
+        """按平台文件ID查找仍被引用的文件块,返回{'sha256', 'file_type', 'text_encoding', 'size'}"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT f.sha256, f.file_type, f.text_encoding, b.size FROM file_id_index f '
+                'JOIN blobs b ON b.sha256 = f.sha256 WHERE f.file_id = ?',
+                (str(file_id),)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def forget_file_id(self, file_id):
+        """删除失效的文件ID索引"""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM file_id_index WHERE file_id = ?', (str(file_id),))
+
+    def save_archive_index(self, sha256, archive):
+        """保存压缩包成员索引,archive为scan_archive的返回值"""
+        members = archive['members']
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM archive_members WHERE sha256 = ?', (sha256,))
+            self._conn.execute(
+                'INSERT OR REPLACE INTO archives (sha256, format, member_count, total_size, compressed_size, '
+                'truncated, indexed_time) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (sha256, archive['format'], archive['member_count'], archive['total_size'],
+                 archive['compressed_size'], int(archive['truncated']), time.time())
+            )
+            self._conn.executemany(
+                'INSERT INTO archive_members (sha256, member_index, name, size, compressed_size) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(sha256, index, m['name'], m['size'], m['compressed_size']) for index, m in enumerate(members)]
+            )
+
+    def get_archive_index(self, sha256):
+        """读取压缩包索引,未索引时返回None"""
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM archives WHERE sha256 = ?', (sha256,)).fetchone()
+            if row is None:
+                return None
+            members = self._conn.execute(
+                'SELECT name, size, compressed_size FROM archive_members WHERE sha256 = ? ORDER BY member_index',
+                (sha256,)
+            ).fetchall()
+        archive = dict(row)
+        archive['truncated'] = bool(archive['truncated'])
+        archive['members'] = [dict(m) for m in members]
+        return archive
+
+    def blob_stats(self):
+        """文件块数量、实际占用字节数和被引用的逻辑字节数"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(size * ref_count), 0) FROM blobs'
+            ).fetchone()
+        return {'blobs': row[0], 'stored_bytes': row[1], 'referenced_bytes': row[2]}
+
+    def import_legacy_records(self, storage_root):
+        """一次性导入旧版各目录下的.file_records.json
+
+        导入与登记在同一事务中完成,导入成功后原文件重命名为.migrated保留备份;
+        解析失败的文件保持原样,不会清空任何记录,下次启动时重试。
+        """
+        imported_total = 0
+        if not os.path.isdir(storage_root):
+            return imported_total
+
+        for item in os.listdir(storage_root):
+            if not (item.startswith('user_') or item.startswith('group_')):
+                continue
+            record_file = os.path.join(storage_root, item, LEGACY_RECORD_FILE)
+            if not os.path.isfile(record_file):
+                continue
+
+            entity_type, _, entity_id = item.partition('_')
+            try:
+                with open(record_file, 'r', encoding='utf-8') as f:
+                    records = json.load(f)
+                if not isinstance(records, list):
+                    raise ValueError("记录文件格式不是列表")
+            except Exception as e:
+                logger.error(f"[FileStore] 旧记录文件解析失败,已跳过: {record_file}: {e}")
+                continue
+
+            with self._lock, self._conn:
+                already = self._conn.execute(
+                    'SELECT 1 FROM legacy_imports WHERE path = ?', (record_file,)
+                ).fetchone()
+                if not already:
+                    for record in records:
+                        if not isinstance(record, dict):
+                            continue
+                        record = dict(record)
+                        record.setdefault('type', entity_type)
+                        record.setdefault('identifier', entity_id)
+                        self._insert(record)
+                        imported_total += 1
+                    self._conn.execute(
+                        'INSERT INTO legacy_imports (path, imported_at) VALUES (?, ?)',
+                        (record_file, time.time())
+                    )
+
+            try:
+                os.replace(record_file, record_file + '.migrated')
+            except OSError as e:
+                logger.warning(f"[FileStore] 重命名旧记录文件失败: {record_file}: {e}")
+
+        if imported_total:
+            with self._lock:
+                self.cache.clear()
+                self.name_indexes.clear()
+                self._generation += 1
+            logger.info(f"[FileStore] 已从旧版记录文件迁移 {imported_total} 条记录")
+        return imported_total
+
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            try:
+                self._conn.close()
+            except Exception as e:
+                logger.error(f"[FileStore] 关闭记录库时出错: {e}")
+
 # LLM工具定义 - 彻底修复ToolExecResult调用错误
 if LLM_TOOL_SUPPORT:
+    def _list_tool_parameters(id_field, id_description):
+        """列出文件工具的参数: 分页游标、排序与筛选条件"""
+        return {
+            "type": "object",
+            "properties": {
+                id_field: {
+                    "type": "string",
+                    "description": id_description,
+                },
+                "cursor": {
+                    "type": "string",
+                    "description": "上一次结果给出的next_cursor,用于获取下一页;留空从第一页开始",
+                },
+                "page": {
+                    "type": "integer",
+                    "description": "页码,从1开始;提供cursor时忽略",
+                },
+                "page_size": {
+                    "type": "integer",
+                    "description": f"每页文件数,最多{LIST_PAGE_SIZE_MAX}",
+                },
+                "sort": {
+                    "type": "string",
+                    "enum": ["time", "size", "name"],
+                    "description": "排序字段: time接收时间(默认)、size文件大小、name文件名",
+                },
+                "descending": {
+                    "type": "boolean",
+                    "description": "是否倒序,默认按从旧到新、从小到大排列",
+                },
+                "file_type": {
+                    "type": "string",
+                    "description": "只列出此类型的文件,如.pdf",
+                },
+                "since_days": {
+                    "type": "integer",
+                    "description": "只列出最近多少天内接收的文件",
+                },
+                "min_size_kb": {
+                    "type": "integer",
+                    "description": "只列出不小于此大小(KB)的文件",
+                },
+                "max_size_kb": {
+                    "type": "integer",
+                    "description": "只列出不大于此大小(KB)的文件",
+                },
+            },
+            "required": [id_field],
+        }
+
+    def _read_tool_parameters(id_field, id_description, list_tool):
+        """读取文件内容工具的参数: 按序号或文件名指定文件,按字符偏移分段读取"""
+        return {
+            "type": "object",
+            "properties": {
+                id_field: {
+                    "type": "string",
+                    "description": id_description,
+                },
+                "file_index": {
+                    "type": "integer",
+                    "description": f"文件在{list_tool}结果中的序号,从1开始",
+                },
+                "file_name": {
+                    "type": "string",
+                    "description": "文件名,可只写开头或近似名称;提供时优先于file_index",
+                },
+                "offset": {
+                    "type": "integer",
+                    "description": "从第几个字符开始读取,默认0;内容未读完时结果末尾会给出下一段的offset",
+                },
+                "length": {
+                    "type": "integer",
+                    "description": f"本次读取的字符数,最多{TOOL_READ_MAX_CHARS}",
+                },
+            },
+            "required": [id_field],
+        }
+
+    @dataclass
+    class FileListTool(FunctionTool[AstrAgentContext]):
+        name: str = "list_user_files"
+        description: str = "当用户表达想要查看自己发送给机器人文件的意图时,包括但不限于以下表述:'查看文件'、'我的文件'、'文件列表'、'能看到我发送的文件吗'、'检查文件'、'上传的文件'、'文件详情',立即主动调用此工具,分页返回文件信息列表,包含文件名、存储路径、文件大小、类型和上传时间等关键信息。结果末尾给出next_cursor时,把它作为cursor参数再次调用即可获取下一页。"
+        parameters: dict = Field(
+            default_factory=lambda: _list_tool_parameters("user_id", "用户的唯一标识符")
+        )
+
+        async def call(
+            self, context: ContextWrapper[AstrAgentContext], **kwargs
+        ) -> ToolExecResult:
+            user_id = kwargs.get("user_id", "")
+            if not user_id:
+                # 修复ToolExecResult调用错误 - 使用正确的方式创建实例
+                return "错误:缺少用户ID参数"
+            
+            # 获取插件实例以访问配置的存储路径
+            global _plugin_instance
+            if _plugin_instance is None:
+                return "错误:插件实例未初始化"
+            plugin = _plugin_instance
+            
+            error = plugin._tool_access_error(context, 'user', user_id, require_caller=False)
+            if error:
+                return error
+            try:
+                return await plugin._tool_list_files('user', str(user_id), kwargs)
+            except Exception as e:
+                logger.error(f"[FileListTool] 读取文件信息时出错: {e}")
+                # 修复ToolExecResult调用错误
+                return f"读取文件信息时出错: {str(e)}"
+
+    @dataclass
+    class GroupFileListTool(FunctionTool[AstrAgentContext]):
+        name: str = "list_group_files"
+        description: str = "当用户想查看本群收到的文件('群文件'、'群里发过的文件'、'群文件列表')时调用此工具,分页返回群文件列表,包含文件名、大小、类型和接收时间。结果末尾给出next_cursor时,把它作为cursor参数再次调用即可获取下一页。"
+        parameters: dict = Field(
+            default_factory=lambda: _list_tool_parameters("group_id", "群号")
+        )
+
+        async def call(
+            self, context: ContextWrapper[AstrAgentContext], **kwargs
+        ) -> ToolExecResult:
+            group_id = kwargs.get("group_id", "")
+            if not group_id:
+                return "错误:缺少群号参数"
+            
+            if _plugin_instance is None:
+                return "错误:插件实例未初始化"
+            plugin = _plugin_instance
+            
+            error = plugin._tool_access_error(context, 'group', group_id)
+            if error:
+                return error
+            try:
+                return await plugin._tool_list_files('group', str(group_id), kwargs)
+            except Exception as e:
+                logger.error(f"[GroupFileListTool] 读取群文件信息时出错: {e}")
+                return f"读取群文件信息时出错: {str(e)}"
+
+    @dataclass
+    class FileContentTool(FunctionTool[AstrAgentContext]):
+        name: str = "read_user_file"
+        description: str = "当用户想让你阅读、总结或分析自己发送给机器人的某个文件(文本、PDF、Word、Excel、PPT)时调用此工具,返回该文件的一段文本内容。Excel表格以CSV形式返回。内容较长时按结果末尾提示的offset继续读取。"
+        parameters: dict = Field(
+            default_factory=lambda: _read_tool_parameters("user_id", "用户的唯一标识符", "list_user_files")
+        )
+
+        async def call(
+            self, context: ContextWrapper[AstrAgentContext], **kwargs
+        ) -> ToolExecResult:
+            user_id = kwargs.get("user_id", "")
+            if not user_id:
+                return "错误:缺少用户ID参数"
+            
+            if _plugin_instance is None:
+                return "错误:插件实例未初始化"
+            plugin = _plugin_instance
+            
+            error = plugin._tool_access_error(context, 'user', user_id)
+            if error:
+                return error
+            try:
+                return await plugin._tool_read_file('user', str(user_id), kwargs)
+            except Exception as e:
+                logger.error(f"[FileContentTool] 读取文件内容出错: {e}")
+                return f"读取文件内容出错: {str(e)}"
+
+    @dataclass
+    class GroupFileContentTool(FunctionTool[AstrAgentContext]):
+        name: str = "read_group_file"
+        description: str = "当用户想让你阅读、总结或分析本群收到的某个文件(文本、PDF、Word、Excel、PPT)时调用此工具,返回该文件的一段文本内容。内容较长时按结果末尾提示的offset继续读取。"
+        parameters: dict = Field(
+            default_factory=lambda: _read_tool_parameters("group_id", "群号", "list_group_files")
+        )
+
+        async def call(
+            self, context: ContextWrapper[AstrAgentContext], **kwargs
+        ) -> ToolExecResult:
+            group_id = kwargs.get("group_id", "")
+            if not group_id:
+                return "错误:缺少群号参数"
+            
+            if _plugin_instance is None:
+                return "错误:插件实例未初始化"
+            plugin = _plugin_instance
+            
+            error = plugin._tool_access_error(context, 'group', group_id)
+            if error:
+                return error
+            try:
+                return await plugin._tool_read_file('group', str(group_id), kwargs)
+            except Exception as e:
+                logger.error(f"[GroupFileContentTool] 读取群文件内容出错: {e}")
+                return f"读取群文件内容出错: {str(e)}"
+
+    @dataclass
+    class FileSearchTool(FunctionTool[AstrAgentContext]):
+        name: str = "search_files"
+        description: str = "当用户想找某个文件、或想知道哪个文件里提到了某个词时调用此工具。在用户自己(提供user_id)或本群(提供group_id)的文件中按文件名和文本内容搜索,返回匹配的文件序号和内容片段。"
+        parameters: dict = Field(
+            default_factory=lambda: {
+                "type": "object",
+                "properties": {
+                    "user_id": {
+                        "type": "string",
+                        "description": "搜索此用户的私聊文件",
+                    },
+                    "group_id": {
+                        "type": "string",
+                        "description": "搜索此群的文件,提供时忽略user_id",
+                    },
+                    "query": {
+                        "type": "string",
+                        "description": "要搜索的文件名或关键词",
+                    },
+                    "limit": {
+                        "type": "integer",
+                        "description": f"最多返回的匹配数,最多{TOOL_SEARCH_MAX_RESULTS}",
+                    },
+                },
+                "required": ["query"],
+            }
+        )
+
+        async def call(
+            self, context: ContextWrapper[AstrAgentContext], **kwargs
+        ) -> ToolExecResult:
+            query = str(kwargs.get("query", "") or "").strip()
+            if not query:
+                return "错误:缺少query参数"
+            try:
+                limit = int(kwargs.get("limit") or 10)
+            except (TypeError, ValueError):
+                return "错误:limit必须是整数"
+            limit = max(1, min(limit, TOOL_SEARCH_MAX_RESULTS))
+            
+            if _plugin_instance is None:
+                return "错误:插件实例未初始化"
+            plugin = _plugin_instance
+            
+            entity_type, entity_id = plugin._tool_entity(kwargs)
+            if entity_type is None:
+                return "错误:需要提供user_id或group_id"
+            error = plugin._tool_access_error(context, entity_type, entity_id)
+            if error:
+                return error
+            try:
+                return await plugin._tool_search_files(entity_type, entity_id, query, limit)
+            except Exception as e:
+                logger.error(f"[FileSearchTool] 搜索文件出错: {e}")
+                return f"搜索文件出错: {str(e)}"
+
     @dataclass
-    class FileListTool(FunctionTool[AstrAgentContext]):
-        name: str = "list_user_files"
-        description: str = "当用户表达想要查看自己发送给机器人文件的意图时,包括但不限于以下表述:'查看文件'、'我的文件'、'文件列表'、'能看到我发送的文件吗'、'检查文件'、'上传的文件'、'文件详情',立即主动调用此工具,为用户提供完整的文件信息列表,包含文件名、存储路径、文件大小、类型和上传时间等关键信息。"
+    class FileDeleteTool(FunctionTool[AstrAgentContext]):
+        name: str = "delete_file"
+        description: str = "仅当用户明确要求删除某个已保存的文件时调用此工具。删除用户自己(提供user_id)或本群(提供group_id)的一个文件,删除后无法恢复。"
+        parameters: dict = Field(
+            default_factory=lambda: {
+                "type": "object",
+                "properties": {
+                    "user_id": {
+                        "type": "string",
+                        "description": "删除此用户的私聊文件",
+                    },
+                    "group_id": {
+                        "type": "string",
+                        "description": "删除此群的文件,提供时忽略user_id",
+                    },
+                    "file_index": {
+                        "type": "integer",
+                        "description": "文件在list_user_files/list_group_files结果中的序号,从1开始",
+                    },
+                    "file_name": {
+                        "type": "string",
+                        "description": "文件名;提供时优先于file_index",
+                    },
+                },
+            }
+        )
+
+        async def call(
+            self, context: ContextWrapper[AstrAgentContext], **kwargs
+        ) -> ToolExecResult:
+            if _plugin_instance is None:
+                return "错误:插件实例未初始化"
+            plugin = _plugin_instance
+            
+            entity_type, entity_id = plugin._tool_entity(kwargs)
+            if entity_type is None:
+                return "错误:需要提供user_id或group_id"
+            if not kwargs.get("file_name") and not kwargs.get("file_index"):
+                return "错误:需要提供file_index或file_name"
+            error = plugin._tool_access_error(context, entity_type, entity_id)
+            if error:
+                return error
+            try:
+                return await plugin._tool_delete_file(entity_type, entity_id, kwargs)
+            except Exception as e:
+                logger.error(f"[FileDeleteTool] 删除文件出错: {e}")
+                return f"删除文件出错: {str(e)}"
+
+    @dataclass
+    class ArchiveTool(FunctionTool[AstrAgentContext]):
+        name: str = "inspect_archive"
+        description: str = "当用户想了解自己发送的压缩包(zip/tar等)里有哪些文件,或想查看压缩包中某个文件的内容时调用此工具。不指定member时返回成员列表;指定member时返回该成员的文本内容(过长时截断)。"
         parameters: dict = Field(
             default_factory=lambda: {
                 "type": "object",
@@ -48,8 +1921,16 @@ if LLM_TOOL_SUPPORT:
                         "type": "string",
                         "description": "用户的唯一标识符",
                     },
+                    "file_index": {
+                        "type": "integer",
+                        "description": "压缩包在list_user_files结果中的序号,从1开始",
+                    },
+                    "member": {
+                        "type": "string",
+                        "description": "要读取的成员序号或名称,留空则列出成员",
+                    },
                 },
-                "required": ["user_id"],
+                "required": ["user_id", "file_index"],
             }
         )
 
@@ -57,118 +1938,74 @@ if LLM_TOOL_SUPPORT:
             self, context: ContextWrapper[AstrAgentContext], **kwargs
         ) -> ToolExecResult:
             user_id = kwargs.get("user_id", "")
+            member = str(kwargs.get("member", "") or "").strip()
             if not user_id:
-                # 修复ToolExecResult调用错误 - 使用正确的方式创建实例
                 return "错误:缺少用户ID参数"
+            try:
+                file_index = int(kwargs.get("file_index", 0))
+            except (TypeError, ValueError):
+                return "错误:file_index必须是整数"
             
-            # 获取插件实例以访问配置的存储路径
-            global _plugin_instance
             if _plugin_instance is None:
                 return "错误:插件实例未初始化"
+            plugin = _plugin_instance
             
-            # 确保使用最新的配置数据
-            try:
-                # 直接从插件实例获取最新配置
-                storage_path = _plugin_instance.storage_path
-                debug_mode = _plugin_instance.debug_mode
-                if debug_mode:
-                    logger.info(f"[FileListTool] 使用存储路径: {storage_path}")
-            except Exception as e:
-                logger.error(f"[FileListTool] 获取存储路径时出错: {e}")
-                # 修复ToolExecResult调用错误
-                return f"获取存储路径时出错: {str(e)}"
-            
-            user_storage_path = os.path.join(storage_path, f"user_{user_id}")
-            
-            if not os.path.exists(user_storage_path):
-                return "该用户暂无文件"
-            
-            record_file = os.path.join(user_storage_path, '.file_records.json')
-            if not os.path.exists(record_file):
-                return "该用户暂无文件记录"
-            
+            error = plugin._tool_access_error(context, 'user', user_id)
+            if error:
+                return error
             try:
-                with open(record_file, 'r', encoding='utf-8') as f:
-                    records = json.load(f)
-                    success_records = [r for r in records if r.get('download_status') == 'success']
-                
-                if not success_records:
-                    return "该用户暂无文件"
+                # 序号与list_user_files一致,按接收时间从旧到新
+                record, error = await plugin._tool_find_record('user', str(user_id), {"file_index": file_index})
+                if error:
+                    return error
                 
-                # 格式化文件信息
-                file_info_list = []
-                for record in success_records:
-                    filename = record.get('final_filename', 'unknown')
-                    filepath = record.get('file_path', 'unknown')
-                    filesize = record.get('file_size', 0)
-                    filetype = record.get('file_type', 'unknown')
-                    receive_time = record.get('receive_time', 0)
-                    
-                    # 格式化文件大小
-                    if filesize < 1024:
-                        size_str = f"{filesize} B"
-                    elif filesize < 1024 * 1024:
-                        size_str = f"{filesize / 1024:.1f} KB"
-                    elif filesize < 1024 * 1024 * 1024:
-                        size_str = f"{filesize / (1024 * 1024):.1f} MB"
-                    else:
-                        size_str = f"{filesize / (1024 * 1024 * 1024):.1f} GB"
-                    
-                    # 格式化时间
-                    time_str = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(receive_time))
-                    
-                    file_info_list.append({
-                        "filename": filename,
-                        "filepath": filepath,
-                        "size": size_str,
-                        "type": filetype,
-                        "receive_time": time_str
-                    })
-                
-                # 返回格式化的字符串而不是JSON
-                result_str = "用户文件列表:\n"
-                for i, file_info in enumerate(file_info_list, 1):
-                    result_str += f"{i}. 文件名: {file_info['filename']}\n"
-                    result_str += f"   路径: {file_info['filepath']}\n"
-                    result_str += f"   大小: {file_info['size']}\n"
-                    result_str += f"   类型: {file_info['type']}\n"
-                    result_str += f"   时间: {file_info['receive_time']}\n\n"
-                
-                # 修复ToolExecResult调用错误
-                return result_str.strip()
+                archive = await plugin._load_archive(record)
+                if archive is None:
+                    return "该文件不是可识别的压缩包"
+                if not member:
+                    return plugin._format_archive_listing(record, archive)
                 
+                archive_member = plugin._find_archive_member(archive, member)
+                if not archive_member:
+                    return f"压缩包中未找到成员: {member}"
+                content = await plugin._run_io(
+                    plugin._read_archive_member, record['file_path'], archive, archive_member['name']
+                )
+                if content is None:
+                    return f"成员 {archive_member['name']} 不是文本文件"
+                return f"{archive_member['name']} 的内容:\n{content}"
+            except ArchiveGuardError as e:
+                return f"拒绝读取: {e}"
             except Exception as e:
-                logger.error(f"[FileListTool] 读取文件信息时出错: {e}")
-                # 修复ToolExecResult调用错误
-                return f"读取文件信息时出错: {str(e)}"
+                logger.error(f"[ArchiveTool] 读取压缩包出错: {e}")
+                return f"读取压缩包出错: {str(e)}"
 
 @register("auto_file_handler", "Noctfom", "自动文件处理器", "1.6.2", "")
 class PluginMain(Star):
-    def _find_target_record(self, records, file_identifier):
-        """通用文件记录查找方法"""
-        try:
-            # 尝试按序号查找
-            if file_identifier.isdigit():
-                index = int(file_identifier) - 1
-                if 0 <= index < len(records):
-                    return records[index], index
-
-            # 按文件名模糊查找
-            for i, record in enumerate(records):
-                if file_identifier in record.get('final_filename', ''):
-                    return record, i
-
-            # 按文件名精确查找
-            for i, record in enumerate(records):
-                final_name = record.get('final_filename', '').lower()
-                if final_name == file_identifier.lower():
-                    return record, i
-
-            return None, -1
+    def _find_target_record(self, index, file_identifier):
+        """按序号或文件名在文件名索引中查找记录,返回(记录, 错误提示)
 
-        except Exception as e:
-            logger.error(f"[1.6.2] 查找文件记录时出错: {e}")
-            return None, -1
+        纯数字优先按显示序号查找,超出范围时再当作文件名;文件名依次精确、前缀、模糊匹配。
+        """
+        records = index.records
+        if file_identifier.isdigit():
+            position = int(file_identifier) - 1
+            if 0 <= position < len(records):
+                return records[position], None
+        
+        mode, positions = index.lookup(file_identifier)
+        if positions:
+            if self.debug_mode:
+                logger.info(f"[1.6.2] 文件查找({mode}): {file_identifier} -> {records[positions[0]].get('final_filename')}")
+            return records[positions[0]], None
+        
+        if file_identifier.isdigit():
+            return None, f"❌ 序号超出范围 (1-{len(records)})"
+        message = f"❌ 未找到文件: {file_identifier}"
+        suggestions = index.suggest(file_identifier)
+        if suggestions:
+            message += "\n你要找的是不是: " + ", ".join(r.get('final_filename', '未知文件') for r in suggestions)
+        return None, message
 
     def __init__(self, context, config: AstrBotConfig = None):
         super().__init__(context)
@@ -192,10 +2029,44 @@ class PluginMain(Star):
             self.group_whitelist = config.get('group_whitelist', '')
             self.auto_receive_group_files = config.get('auto_receive_group_files', True)
             self.max_files_per_group = config.get('max_files_per_group', 10)
+            self.max_storage_mb_per_user = config.get('max_storage_mb_per_user', 500)
+            self.max_storage_mb_per_group = config.get('max_storage_mb_per_group', 2048)
+            self.max_storage_mb_total = config.get('max_storage_mb_total', 0)
+            self.eviction_policy = config.get('eviction_policy', 'oldest')
+            self.blocked_file_types = config.get('blocked_file_types', '')
             self.group_file_receive_timeout = config.get('group_file_receive_timeout', 60)
             self.debug_mode = config.get('debug_mode', False)  # 新增调试模式
             self.auto_read_content = config.get('auto_read_content', False)
             self.max_auto_read_size = config.get('max_auto_read_size', 2000)  # 默认100KB
+            self.record_cache_size = config.get('record_cache_size', 256)
+            self.list_page_size = config.get('list_page_size', 10)
+            self.io_worker_threads = config.get('io_worker_threads', 4)
+            self.io_queue_limit = config.get('io_queue_limit', 256)
+            self.http_pool_limit = config.get('http_pool_limit', 32)
+            self.http_pool_limit_per_host = config.get('http_pool_limit_per_host', 8)
+            self.http_keepalive_timeout = config.get('http_keepalive_timeout', 30)
+            self.http_dns_cache_ttl = config.get('http_dns_cache_ttl', 300)
+            self.download_max_concurrent = config.get('download_max_concurrent', 4)
+            self.download_per_entity_limit = config.get('download_per_entity_limit', 2)
+            self.download_queue_limit = config.get('download_queue_limit', 100)
+            self.download_chunk_size_kb = config.get('download_chunk_size_kb', 64)
+            self.download_max_retries = config.get('download_max_retries', 3)
+            self.download_retry_backoff = config.get('download_retry_backoff', 1.0)
+            self.download_read_timeout = config.get('download_read_timeout', 30)
+            self.download_parallel_segments = config.get('download_parallel_segments', 1)
+            self.download_parallel_min_size_mb = config.get('download_parallel_min_size_mb', 32)
+            self.auto_read_chunk_tokens = config.get('auto_read_chunk_tokens', 1500)
+            self.auto_read_max_chunks = config.get('auto_read_max_chunks', 5)
+            self.extract_text_enabled = config.get('extract_text_enabled', True)
+            self.analysis_workers = config.get('analysis_workers', 2)
+            self.analysis_timeout = config.get('analysis_timeout', 60)
+            self.extract_max_chars = config.get('extract_max_chars', 200000)
+            self.reconcile_interval_hours = config.get('reconcile_interval_hours', 6)
+            self.reconcile_temp_max_age_hours = config.get('reconcile_temp_max_age_hours', 24)
+            self.archive_index_enabled = config.get('archive_index_enabled', True)
+            self.archive_max_members = config.get('archive_max_members', 10000)
+            self.archive_max_total_mb = config.get('archive_max_total_mb', 1024)
+            self.archive_max_ratio = config.get('archive_max_ratio', 100)
         else:
             self.storage_path = '/app/storage/auto_file_handler'
             self.auto_cleanup_enabled = True
@@ -206,15 +2077,105 @@ class PluginMain(Star):
             self.group_whitelist = ''
             self.auto_receive_group_files = True
             self.max_files_per_group = 10
+            self.max_storage_mb_per_user = 500
+            self.max_storage_mb_per_group = 2048
+            self.max_storage_mb_total = 0
+            self.eviction_policy = 'oldest'
+            self.blocked_file_types = ''
             self.group_file_receive_timeout = 60
             self.debug_mode = False  # 默认关闭调试模式
             self.auto_read_content = True
             self.max_auto_read_size = 2000  # 默认100KB
+            self.record_cache_size = 256
+            self.list_page_size = 10
+            self.io_worker_threads = 4
+            self.io_queue_limit = 256
+            self.http_pool_limit = 32
+            self.http_pool_limit_per_host = 8
+            self.http_keepalive_timeout = 30
+            self.http_dns_cache_ttl = 300
+            self.download_max_concurrent = 4
+            self.download_per_entity_limit = 2
+            self.download_queue_limit = 100
+            self.download_chunk_size_kb = 64
+            self.download_max_retries = 3
+            self.download_retry_backoff = 1.0
+            self.download_read_timeout = 30
+            self.download_parallel_segments = 1
+            self.download_parallel_min_size_mb = 32
+            self.auto_read_chunk_tokens = 1500
+            self.auto_read_max_chunks = 5
+            self.extract_text_enabled = True
+            self.analysis_workers = 2
+            self.analysis_timeout = 60
+            self.extract_max_chars = 200000
+            self.reconcile_interval_hours = 6
+            self.reconcile_temp_max_age_hours = 24
+            self.archive_index_enabled = True
+            self.archive_max_members = 10000
+            self.archive_max_total_mb = 1024
+            self.archive_max_ratio = 100
         
         os.makedirs(self.storage_path, exist_ok=True)
         
+        # 磁盘I/O线程池,阻塞的文件操作都在这里执行
+        self.io_executor = DiskIOExecutor(self.io_worker_threads, self.io_queue_limit)
+        
+        # 共享的HTTP会话,在首次下载时创建
+        self._http_session = None
+        
+        # 下载调度器,消息处理只负责入队
+        self.download_scheduler = DownloadScheduler(
+            self.download_max_concurrent, self.download_per_entity_limit,
+            self.download_queue_limit, self.debug_mode
+        )
+        self.download_scheduler.start()
+        # 文件块与用户/群目录之间的链接、引用计数变化需要串行执行;删除记录时会嵌套获取
+        self._storage_lock = threading.RLock()
+        # 同一用户/群的记录变更(准入淘汰、保存、删除、重置、清理、对账)按用户/群串行,不同用户/群之间并发
+        self._entity_locks = KeyedLock()
+        # 查看文件指令翻页用的游标,按(用户/群, 排序与筛选条件)保存每页的起点
+        self._list_cursors = OrderedDict()
+        # 分段下载进度文件的写入锁,以及正在使用的临时文件
+        self._segment_state_lock = threading.Lock()
+        self._active_temp_paths = set()
+        # 文件ID复用统计,只在事件循环中更新
+        self.file_id_stats = {'hits': 0, 'misses': 0, 'stale': 0, 'oversize': 0}
+        # 已增加引用计数但记录尚未保存的文件块,对账时计入引用
+        self._pending_blob_refs = defaultdict(int)
+        # 准入时为下载中文件预留的配额,{缓存键: [文件数, 字节数]},检查与预留在同一把锁内完成
+        self._admission_lock = threading.Lock()
+        self._reserved = defaultdict(lambda: [0, 0])
+        self._reserved_total = 0
+        # 已选中但尚未删除的淘汰记录,{记录ID: (缓存键, 字节数)},删除在锁外进行,期间不计入用量也不会被重复选中
+        self._evicting = {}
+        self._evicting_usage = defaultdict(lambda: [0, 0])
+        self._evicting_total = 0
+        # 最近一次存储对账的结果和记录库快照时间
+        self.reconcile_stats = None
+        self.snapshot_time = None
+        # CPU密集的分析任务在进程池中执行,进程在首次使用时创建;同一文档同时只提取一次
+        self.analysis_pool = AnalysisPool(self.analysis_workers, self.analysis_timeout)
+        self._extract_tasks = {}
+        self.extract_stats = {'extracted': 0, 'hits': 0, 'failed': 0}
+        
+        # 初始化SQLite记录库,并迁移旧版JSON记录
+        self.store = FileRecordStore(
+            os.path.join(self.storage_path, RECORD_DB_FILE), self.debug_mode, self.record_cache_size
+        )
+        try:
+            self.store.import_legacy_records(self.storage_path)
+        except Exception as e:
+            logger.error(f"[FileHandler-1.6.2] 迁移旧版记录文件时出错: {e}")
+        
+        # 过期清理任务按最早记录的到期时间休眠,新记录保存时唤醒重新计算
+        self._cleanup_wakeup = asyncio.Event()
+        self._cleanup_runner = None
         if self.auto_cleanup_enabled:
-            asyncio.create_task(self._cleanup_task())
+            self._cleanup_runner = asyncio.create_task(self._cleanup_task())
+        
+        # 后台存储对账任务
+        self._reconcile_runner = asyncio.create_task(self._reconcile_task())
         
         # 启动超时检查任务
         asyncio.create_task(self._check_pending_timeouts())
@@ -222,7 +2183,10 @@ class PluginMain(Star):
         # 注册LLM工具
         if LLM_TOOL_SUPPORT:
             try:
-                self.context.add_llm_tools(FileListTool())
+                self.context.add_llm_tools(
+                    FileListTool(), GroupFileListTool(), FileContentTool(), GroupFileContentTool(),
+                    FileSearchTool(), FileDeleteTool(), ArchiveTool()
+                )
                 if self.debug_mode:
                     logger.info("[FileHandler-1.6.2] LLM工具已注册")
                     logger.info(f"[FileHandler-1.6.2] 当前存储路径配置: {self.storage_path}")
@@ -234,6 +2198,24 @@ class PluginMain(Star):
             logger.info(f"[FileHandler-1.6.2] 存储路径: {self.storage_path}")
             logger.info(f"[FileHandler-1.6.2] 调试模式: {'开启' if self.debug_mode else '关闭'}")
     
+    async def terminate(self):
+        """插件卸载时释放资源"""
+        if self._cleanup_runner is not None:
+            self._cleanup_runner.cancel()
+        self._reconcile_runner.cancel()
+        await self.download_scheduler.shutdown()
+        if self._http_session is not None and not self._http_session.closed:
+            await self._http_session.close()
+        self.analysis_pool.shutdown()
+        self.io_executor.shutdown()
+        self.store.close()
+        if self.debug_mode:
+            logger.info("[FileHandler-1.6.2] 插件已卸载,资源已释放")
+    
+    async def _run_io(self, func, *args, **kwargs):
+        """在磁盘I/O线程池中执行阻塞操作"""
+        return await self.io_executor.run(func, *args, **kwargs)
+    
     async def _check_pending_timeouts(self):
         """定期检查等待接收的请求是否超时"""
         while True:
@@ -409,166 +2391,184 @@ class PluginMain(Star):
                                 user_id in self.pending_group_receives[group_id]):
                                 # 有等待的接收请求,处理文件
                                 del self.pending_group_receives[group_id][user_id]  # 清理等待状态
-                                await self._handle_group_file_v159(event, component, group_id)
+                                await self._submit_file_download(
+                                    event, component, "group", group_id,
+                                    functools.partial(self._handle_group_file_v159, event, component, group_id)
+                                )
                             elif self.auto_receive_group_files:
                                 # 自动接收模式
-                                await self._handle_group_file_v159(event, component, group_id)
+                                await self._submit_file_download(
+                                    event, component, "group", group_id,
+                                    functools.partial(self._handle_group_file_v159, event, component, group_id)
+                                )
                             # 否则忽略文件(没有等待请求且未开启自动接收)
                         else:
                             # 私聊文件处理
-                            await self._handle_private_file_v159(event, component)
+                            await self._submit_file_download(
+                                event, component, "user", self._get_user_id(event),
+                                functools.partial(self._handle_private_file_v159, event, component)
+                            )
                         
         except Exception as e:
             logger.error(f"[FileHandler-1.6.2] 处理消息时出错: {e}")
             logger.exception(e)
     
-    async def _handle_private_file_v159(self, event: AstrMessageEvent, file_component):
+    async def _submit_file_download(self, event: AstrMessageEvent, file_component, entity_type, entity_id, handler):
+        """准入检查通过后把下载任务交给调度器,预留的配额随任务传递并由任务释放"""
+        reservation = await self._admit_file(event, file_component, entity_type, entity_id, check_queue=True)
+        if reservation is None:
+            return
+        try:
+            await self.download_scheduler.submit(f"{entity_type}_{entity_id}", functools.partial(handler, reservation=reservation))
+        except BaseException:
+            await self._run_io(self._release_reservation, reservation)
+            raise
+    
+    def _declared_file_info(self, file_component):
+        """从文件组件中取出(原始文件名, 下载URL, 文件ID, 声明大小)"""
+        file_attrs = self._extract_file_attributes(file_component)
+        file_size = file_attrs.get('size') or file_attrs.get('file_size', 0)
+        try:
+            file_size = int(file_size or 0)
+        except (TypeError, ValueError):
+            file_size = 0
+        return (self._extract_filename(file_attrs), self._extract_file_url(file_attrs),
+                file_attrs.get('id') or file_attrs.get('file_id'), file_size)
+    
+    def _blocked_type(self, *file_types):
+        """返回命中类型黑名单的扩展名,都不在黑名单中时返回None"""
+        blocked = {ext.strip().lower() if ext.strip().startswith('.') else f".{ext.strip().lower()}"
+                   for ext in self.blocked_file_types.split(',') if ext.strip()}
+        for file_type in file_types:
+            if file_type and file_type.lower() in blocked:
+                return file_type.lower()
+        return None
+    
+    async def _admit_file(self, event: AstrMessageEvent, file_component, entity_type, entity_id, check_queue=False):
+        """下载前的准入检查:文件类型、声明大小、下载队列和存储配额,不下载任何数据
+
+        通过时返回预留了配额的StorageReservation;拒绝时发送原因并返回None。
+        """
+        original_name, _, _, file_size = self._declared_file_info(file_component)
+        
+        blocked = self._blocked_type(os.path.splitext(original_name or '')[1])
+        if blocked:
+            if self.send_completion_message:
+                await event.send(event.plain_result(f"❌ 不接收此类型的文件: {blocked}"))
+            return None
+        
+        # 平台声明的大小超限时直接拒绝;大小未知时由下载过程按Content-Length和实际字节数把关
+        if self.max_file_size_mb > 0 and file_size > self.max_file_size_mb * 1024 * 1024:
+            await self._send_oversize_message(event, file_size)
+            return None
+        
+        if check_queue and self.download_scheduler.is_full():
+            logger.warning(f"[1.6.2] 下载队列已满,拒绝接收文件: {original_name}")
+            if self.send_completion_message:
+                await event.send(event.plain_result("❌ 当前待下载的文件过多,请稍后重新发送"))
+            return None
+        
+        # 按声明的大小检查存储配额并预留,必要时按淘汰策略删除旧文件腾出空间
+        async with self._entity_lock(entity_type, entity_id):
+            admitted, evicted, reservation = await self._run_io(
+                self._enforce_storage_quota, entity_type, entity_id, file_size
+            )
+        if not admitted:
+            await self._send_quota_message(event, entity_type, evicted, admitted)
+            return None
+        evicted += await self._evict_pending(reservation)
+        reservation.evicted = evicted
+        return reservation
+    
+    async def _handle_private_file_v159(self, event: AstrMessageEvent, file_component, reservation=None):
         """处理私聊文件"""
         try:
             user_id = self._get_user_id(event)
             user_storage_path = os.path.join(self.storage_path, f"user_{user_id}")
-            os.makedirs(user_storage_path, exist_ok=True)
+            await self._run_io(os.makedirs, user_storage_path, exist_ok=True)
             
             if self.debug_mode:
                 logger.info(f"[1.6.2] 处理私聊文件 - 用户: {user_id}, 存储路径: {user_storage_path}")
             
-            # 检查用户文件数量限制并提醒删除
-            removed_file = None
-            if not self._check_file_limit(user_id, user_storage_path, self.max_files_per_user, "user"):
-                record_file = os.path.join(user_storage_path, '.file_records.json')
-                if os.path.exists(record_file):
-                    with open(record_file, 'r', encoding='utf-8') as f:
-                        try:
-                            records = json.load(f)
-                            if records:
-                                removed_file = records[0].get('final_filename', '未知文件')
-                        except:
-                            pass
-                
-                if self.send_completion_message:
-                    if self.send_completion_message:
-                        msg = "❌ 文件存储数量已达上限!"
-                        msg += "\n📥 检测到文件数量超限,正在自动删除最旧文件..." 
-                        if removed_file:
-                            msg += f"\n🗑️ 已自动删除最旧文件: {removed_file}"
-                        msg += "\n✅ 文件删除完成,现在可以接收新文件了。"
-                        await event.send(event.plain_result(msg))
-            
-            await self._process_file_download(event, file_component, user_storage_path, "user", user_id)
+            await self._process_file_download(event, file_component, user_storage_path, "user", user_id, reservation)
             
         except Exception as e:
             logger.error(f"[FileHandler-1.6.2] 处理私聊文件时出错: {e}")
             logger.exception(e)
     
-    async def _handle_group_file_v159(self, event: AstrMessageEvent, file_component, group_id):
+    async def _handle_group_file_v159(self, event: AstrMessageEvent, file_component, group_id, reservation=None):
         """处理群聊文件"""
         try:
             group_storage_path = os.path.join(self.storage_path, f"group_{group_id}")
-            os.makedirs(group_storage_path, exist_ok=True)
+            await self._run_io(os.makedirs, group_storage_path, exist_ok=True)
             
             if self.debug_mode:
                 logger.info(f"[1.6.2] 处理群聊文件 - 群: {group_id}, 存储路径: {group_storage_path}")
             
-            # 检查群文件数量限制并提醒删除
-            removed_file = None
-            if not self._check_file_limit(group_id, group_storage_path, self.max_files_per_group, "group"):
-                record_file = os.path.join(group_storage_path, '.file_records.json')
-                if os.path.exists(record_file):
-                    with open(record_file, 'r', encoding='utf-8') as f:
-                        try:
-                            records = json.load(f)
-                            if records:
-                                removed_file = records[0].get('final_filename', '未知文件')
-                        except:
-                            pass
-                
-                if self.send_completion_message:
-                    if self.send_completion_message:
-                        msg = "❌ 群文件存储数量已达上限!"
-                        msg += "\n📥 检测到群文件数量超限,正在自动删除最旧文件..." 
-                        if removed_file:
-                            msg += f"\n🗑️ 已自动删除最旧文件: {removed_file}"
-                        msg += "\n✅ 文件删除完成,现在可以接收新文件了。"
-                        await event.send(event.plain_result(msg))
-            
-            await self._process_file_download(event, file_component, group_storage_path, "group", group_id)
+            await self._process_file_download(event, file_component, group_storage_path, "group", group_id, reservation)
             
         except Exception as e:
             logger.error(f"[FileHandler-1.6.2] 处理群聊文件时出错: {e}")
             logger.exception(e)
     
-    async def _process_file_download(self, event: AstrMessageEvent, file_component, storage_path, file_type, identifier):
-        """处理文件下载的通用方法"""
+    async def _process_file_download(self, event: AstrMessageEvent, file_component, storage_path, file_type, identifier, reservation=None):
+        """处理文件下载的通用方法
+
+        reservation为准入时预留的配额,未经准入直接调用时在这里补做准入;
+        无论成功与否,结束时都会释放预留。
+        """
+        temp_filepath = None
         try:
-            file_attrs = self._extract_file_attributes(file_component)
-            original_name = self._extract_filename(file_attrs)
-            file_url = self._extract_file_url(file_attrs)
-            file_id = file_attrs.get('id') or file_attrs.get('file_id')
-            file_size = file_attrs.get('size') or file_attrs.get('file_size', 0)
+            original_name, file_url, file_id, file_size = self._declared_file_info(file_component)
             
             if self.debug_mode:
                 logger.info(f"[1.6.2] {file_type}文件信息 - 名称: '{original_name}', 大小: {file_size} bytes")
                 logger.info(f"[1.6.2] 文件URL: {file_url}")
                 logger.info(f"[1.6.2] 文件ID: {file_id}")
             
-            if self.max_file_size_mb > 0:
-                max_size_bytes = self.max_file_size_mb * 1024 * 1024
-                if file_size <= 0 and file_url:
-                    if 'large' in file_url.lower() or 'video' in file_url.lower():
-                        file_size = max_size_bytes + 1
-                
-                if file_size > max_size_bytes:
-                    size_mb = file_size / (1024 * 1024) if file_size > 0 else "未知"
-                    max_mb = self.max_file_size_mb
-                    if self.send_completion_message:
-                        await event.send(event.plain_result(
-                            f"❌ 文件过大无法下载!\n"
-                            f"文件大小: {size_mb}MB\n"
-                            f"大小限制: {max_mb}MB"
-                        ))
+            if reservation is None:
+                reservation = await self._admit_file(event, file_component, file_type, identifier)
+                if reservation is None:
+                    return
+            max_size_bytes = self.max_file_size_mb * 1024 * 1024 if self.max_file_size_mb > 0 else None
+            
+            # 已知的平台文件ID直接链接已存储的内容,不再访问网络
+            if file_id:
+                outcome, stored = await self._run_io(
+                    self._link_known_file_id, str(file_id), original_name, storage_path, max_size_bytes
+                )
+                self.file_id_stats[outcome] += 1
+                if stored:
+                    await self._store_received_file(event, identifier, file_type, original_name, file_url, file_id, stored, reservation)
                     return
             
-            temp_filename = f"temp_file_{int(time.time())}"
-            temp_filepath = os.path.join(storage_path, temp_filename)
+            # 临时文件名由文件ID/URL决定,同一文件再次下载时可以续传未完成的部分
+            download_key = hashlib.sha1(str(file_id or file_url or '').encode('utf-8')).hexdigest()[:16]
+            temp_filepath = os.path.join(storage_path, f"temp_file_{download_key}")
+            if temp_filepath in self._active_temp_paths:
+                temp_filepath = os.path.join(storage_path, f"temp_file_{download_key}_{uuid.uuid4().hex[:8]}")
+            self._active_temp_paths.add(temp_filepath)
             
             if file_url:
-                download_success = await self._download_to_temp(file_url, temp_filepath)
-                if download_success:
-                    detected_type = self._detect_file_type_detailed(temp_filepath)
-                    final_filename = self._smart_filename_handling(original_name, detected_type, temp_filepath)
-                    final_filepath = os.path.join(storage_path, final_filename)
-                    final_filepath = self._ensure_unique_filename(final_filepath)
-                    
-                    os.rename(temp_filepath, final_filepath)
+                try:
+                    download_result = await self._download_to_temp(file_url, temp_filepath, max_size_bytes)
+                except DownloadSizeExceeded as e:
+                    await self._run_io(self._remove_file_quietly, temp_filepath)
+                    await self._run_io(self._remove_file_quietly, temp_filepath + DOWNLOAD_SEGMENTS_SUFFIX)
+                    await self._run_io(self._remove_file_quietly, temp_filepath + DOWNLOAD_VALIDATOR_SUFFIX)
                     if self.debug_mode:
-                        logger.info(f"[1.6.2] 文件已保存: {final_filepath}")
-                    
-                    record_info = {
-                        'identifier': identifier,
-                        'type': file_type,
-                        'original_name': original_name,
-                        'final_filename': final_filename,
-                        'file_path': final_filepath,
-                        'file_url': file_url,
-                        'file_id': file_id,
-                        'file_size': os.path.getsize(final_filepath),
-                        'file_type': detected_type,
-                        'receive_time': time.time(),
-                        'sender': event.get_sender_name() if hasattr(event, 'get_sender_name') else 'unknown',
-                        'platform': event.get_platform_name() if hasattr(event, 'get_platform_name') else 'unknown',
-                        'download_status': 'success'
-                    }
-                    
-                    record_file = os.path.join(storage_path, '.file_records.json')
-                    await self._save_record(record_file, record_info)
-                    
-                    if self.send_completion_message:
-                        actual_size = os.path.getsize(final_filepath)
-                        await self._send_completion_message(event, final_filename, final_filepath, actual_size, detected_type, original_name, file_type)
+                        logger.info(f"[1.6.2] 已中止超限文件的下载: {original_name}")
+                    await self._send_oversize_message(event, e.size)
+                    return
+                if download_result:
+                    stored = await self._run_io(
+                        self._finalize_temp_file, temp_filepath, original_name, storage_path,
+                        download_result['sha256'], file_id, download_result['sniff']
+                    )
+                    await self._store_received_file(event, identifier, file_type, original_name, file_url, file_id, stored, reservation)
                         
                 else:
-                    if os.path.exists(temp_filepath):
-                        os.remove(temp_filepath)
+                    # 保留未完成的临时文件,同一文件再次发送时断点续传
                     
                     record_info = {
                         'identifier': identifier,
@@ -583,8 +2583,7 @@ class PluginMain(Star):
                         'download_status': 'failed'
                     }
                     
-                    record_file = os.path.join(storage_path, '.file_records.json')
-                    await self._save_record(record_file, record_info)
+                    await self._save_record(record_info)
                     
                     if self.send_completion_message:
                         await event.send(event.plain_result(f"❌ 文件 {original_name} 下载失败!"))
@@ -602,57 +2601,657 @@ class PluginMain(Star):
                     'download_status': 'no_url'
                 }
                 
-                record_file = os.path.join(storage_path, '.file_records.json')
-                await self._save_record(record_file, record_info)
+                await self._save_record(record_info)
             
         except Exception as e:
             logger.error(f"[FileHandler-1.6.2] 处理文件下载时出错: {e}")
             logger.exception(e)
+        finally:
+            self._active_temp_paths.discard(temp_filepath)
+            if reservation is not None:
+                await self._run_io(self._release_reservation, reservation)
     
-    # ==================== 私聊指令 ====================
-    @filter.command("查看文件", alias={'/fileinfo'})
-    async def view_files(self, event: AstrMessageEvent):
-        """查看私聊文件"""
-        user_id = self._get_user_id(event)
-        user_storage_path = os.path.join(self.storage_path, f"user_{user_id}")
+    async def _store_received_file(self, event: AstrMessageEvent, identifier, file_type, original_name, file_url, file_id, stored, reservation=None):
+        """保存接收成功的文件记录并发送完成消息,stored为已落盘文件的信息
+
+        按识别出的类型和实际大小再做一次准入,不通过时释放已落盘的文件。
+        """
+        record_info = {
+            'identifier': identifier,
+            'type': file_type,
+            'original_name': original_name,
+            'file_url': file_url,
+            'file_id': file_id,
+            'receive_time': time.time(),
+            'sender': event.get_sender_name() if hasattr(event, 'get_sender_name') else 'unknown',
+            'platform': event.get_platform_name() if hasattr(event, 'get_platform_name') else 'unknown',
+            'download_status': 'success',
+        }
+        record_info.update(stored)
+        
+        evicted = list(reservation.evicted) if reservation is not None else []
+        blocked = self._blocked_type(stored['file_type'])
+        try:
+            async with self._entity_lock(file_type, identifier):
+                # 平台未声明大小或声明不准时,按实际大小调整预留
+                admitted = False
+                if not blocked:
+                    admitted, more_evicted, reservation = await self._run_io(
+                        self._enforce_storage_quota, file_type, identifier, stored['file_size'], reservation
+                    )
+                    evicted += more_evicted
+                if admitted:
+                    await self._save_record(record_info)
+                else:
+                    await self._run_io(self._delete_record_file, stored)
+                # 记录已计入用量,在锁内释放预留,避免下一个文件把它重复计算
+                if reservation is not None:
+                    await self._run_io(self._release_reservation, reservation)
+        finally:
+            await self._run_io(self._settle_blob_ref, stored['sha256'])
+            if reservation is not None:
+                await self._run_io(self._release_reservation, reservation)
+                # 其他用户/群的淘汰记录在释放本用户/群的锁之后删除
+                evicted += await self._evict_pending(reservation)
+        if blocked:
+            if self.send_completion_message:
+                await event.send(event.plain_result(f"❌ 不接收此类型的文件: {blocked}"))
+            return
+        await self._send_quota_message(event, file_type, evicted, admitted)
+        if not admitted:
+            return
+        
+        if self.archive_index_enabled and stored['file_type'] in ARCHIVE_TYPES:
+            try:
+                await self._load_archive(stored)
+            except Exception as e:
+                logger.warning(f"[1.6.2] 建立压缩包索引失败: {e}")
+        
+        if self.send_completion_message:
+            await self._send_completion_message(
+                event, stored['final_filename'], stored['file_path'], stored['file_size'],
+                stored['file_type'], original_name, file_type, stored.get('text_encoding'), stored['sha256']
+            )
+    
+    def _settle_blob_ref(self, sha256):
+        """文件块的新引用已写入记录(或保存失败),不再计入待确认引用"""
+        with self._storage_lock:
+            self._pending_blob_refs[sha256] -= 1
+            if self._pending_blob_refs[sha256] <= 0:
+                del self._pending_blob_refs[sha256]
+    
+    async def _send_quota_message(self, event: AstrMessageEvent, entity_type, evicted, admitted=True):
+        """发送存储配额淘汰或拒绝接收的提示"""
+        if not self.send_completion_message or (admitted and not evicted):
+            return
+        entity_desc = "文件" if entity_type == "user" else "群文件"
+        msg = f"📥 {entity_desc}存储空间已达上限!"
+        if evicted:
+            policy_desc = EVICTION_POLICY_NAMES.get(self.eviction_policy, self.eviction_policy)
+            names = ", ".join(r.get('final_filename') or '未知文件' for r in evicted[:5])
+            if len(evicted) > 5:
+                names += f" 等{len(evicted)}个文件"
+            msg += f"\n🗑️ 已按{policy_desc}自动删除: {names}"
+        if admitted:
+            msg += "\n✅ 现在可以接收新文件了。"
+        else:
+            msg += "\n❌ 无法腾出足够空间,文件未保存。"
+        await event.send(event.plain_result(msg))
+    
+    async def _send_oversize_message(self, event: AstrMessageEvent, file_size=None):
+        """发送文件超过大小限制的提示"""
+        if not self.send_completion_message:
+            return
+        size_str = self._format_file_size(file_size) if file_size else f"超过 {self.max_file_size_mb}MB"
+        await event.send(event.plain_result(
+            f"❌ 文件过大无法下载!\n"
+            f"文件大小: {size_str}\n"
+            f"大小限制: {self.max_file_size_mb}MB"
+        ))
+    
+    def _blob_path(self, sha256):
+        """内容哈希对应的文件块路径"""
+        return os.path.join(self.storage_path, BLOB_DIR, sha256[:2], sha256)
+    
+    def _link_blob(self, blob_path, final_filepath):
+        """在用户/群目录下为文件块建立硬链接;文件系统不支持时直接使用文件块路径"""
+        try:
+            os.link(blob_path, final_filepath)
+            return final_filepath
+        except OSError as e:
+            if self.debug_mode:
+                logger.info(f"[1.6.2] 无法创建硬链接,记录直接指向文件块: {e}")
+            return blob_path
+    
+    def _finalize_temp_file(self, temp_filepath, original_name, storage_path, sha256, file_id=None, sniff=None):
+        """把临时文件存入按内容哈希寻址的文件块目录并链接到用户/群目录
+
+        相同内容的文件只保存一份,各记录通过引用计数共享,在I/O线程池中执行。
+        sniff为下载后的类型识别结果,缺省时才读取文件识别。
+        返回记录中与存储相关的字段。
+        """
+        if sniff is None:
+            sniff = self._sniff_file(temp_filepath)
+        detected_type = sniff['file_type']
+        text_encoding = sniff['encoding']
+        final_filename = self._smart_filename_handling(original_name, detected_type, temp_filepath)
+        blob_path = self._blob_path(sha256)
+        with self._storage_lock:
+            if os.path.exists(blob_path):
+                os.remove(temp_filepath)
+                if self.debug_mode:
+                    logger.info(f"[1.6.2] 文件内容已存在,复用文件块: {sha256}")
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(temp_filepath, blob_path)
+            final_filepath = self._ensure_unique_filename(os.path.join(storage_path, final_filename))
+            final_filepath = self._link_blob(blob_path, final_filepath)
+            file_size = os.path.getsize(blob_path)
+            self.store.acquire_blob(sha256, file_size)
+            self._pending_blob_refs[sha256] += 1
+            if file_id:
+                self.store.remember_file_id(file_id, sha256, detected_type, text_encoding)
+        if self.debug_mode:
+            logger.info(f"[1.6.2] 文件已保存: {final_filepath}")
+        return {
+            'final_filename': final_filename,
+            'file_path': final_filepath,
+            'file_type': detected_type,
+            'file_size': file_size,
+            'sha256': sha256,
+            'text_encoding': text_encoding,
+        }
+    
+    def _link_known_file_id(self, file_id, original_name, storage_path, max_size_bytes=None):
+        """平台文件ID已有对应文件块时直接链接到用户/群目录,在I/O线程池中执行
+
+        返回(查询结果, 存储字段):查询结果为hits/misses/stale/oversize,对应file_id_stats的键,
+        由调用方在事件循环中计数;未命中、文件块已丢失或超过大小限制时存储字段为None。
+        """
+        known = self.store.lookup_file_id(file_id)
+        if not known:
+            return 'misses', None
+        if max_size_bytes and known['size'] > max_size_bytes:
+            return 'oversize', None
+        
+        sha256 = known['sha256']
+        blob_path = self._blob_path(sha256)
+        with self._storage_lock:
+            if not os.path.exists(blob_path):
+                # 文件块已丢失,索引作废后按正常流程下载
+                self.store.forget_file_id(file_id)
+                return 'stale', None
+            detected_type = known['file_type'] or os.path.splitext(original_name)[1] or '.bin'
+            final_filename = self._smart_filename_handling(original_name, detected_type, blob_path)
+            final_filepath = self._ensure_unique_filename(os.path.join(storage_path, final_filename))
+            final_filepath = self._link_blob(blob_path, final_filepath)
+            self.store.acquire_blob(sha256, known['size'])
+            self._pending_blob_refs[sha256] += 1
+            self.store.remember_file_id(file_id, sha256, detected_type, known['text_encoding'])
+        
+        if self.debug_mode:
+            logger.info(f"[1.6.2] 文件ID命中,跳过下载: {file_id} -> {final_filepath}")
+        return 'hits', {
+            'final_filename': final_filename,
+            'file_path': final_filepath,
+            'file_type': detected_type,
+            'file_size': known['size'],
+            'sha256': sha256,
+            'text_encoding': known['text_encoding'],
+        }
+    
+    def _delete_record_file(self, record):
+        """删除记录对应的文件并释放其引用的文件块,在I/O线程池中执行
+
+        文件删除失败时抛出异常且不释放引用;文件块在最后一个引用释放后才删除。
+        """
+        file_path = record.get('file_path', '')
+        sha256 = record.get('sha256')
+        with self._storage_lock:
+            blob_path = self._blob_path(sha256) if sha256 else None
+            if file_path and file_path != blob_path and os.path.exists(file_path):
+                os.remove(file_path)
+            if sha256 and self.store.release_blob(sha256) == 0:
+                self._remove_file_quietly(blob_path)
+                self._remove_file_quietly(blob_path + EXTRACTED_TEXT_SUFFIX)
+                if self.debug_mode:
+                    logger.info(f"[1.6.2] 文件块已无引用,已删除: {sha256}")
+    
+    def _discard_record(self, record):
+        """删除记录对应的文件、释放文件块并删除记录,在I/O线程池中执行
+
+        在存储锁内先确认记录仍然存在,同一条记录被淘汰、清理和删除指令同时处理时只释放一次文件块引用。
+        返回是否由本次调用删除;文件删除失败时抛出异常并保留记录。
+        """
+        with self._storage_lock:
+            if not self.store.has_record(record['id']):
+                return False
+            self._delete_record_file(record)
+            self.store.delete_record(record['id'])
+            return True
+    
+    def _entity_lock(self, entity_type, entity_id):
+        """某个用户/群的记录变更锁"""
+        return self._entity_locks(self.store.entity_key(entity_type, entity_id))
+    
+    def _reset_entity_storage(self, entity_type, entity_id, storage_dir):
+        """删除某个用户/群的全部文件与记录,返回(删除文件数, 删除记录数)"""
+        deleted_count = 0
+        for record in self.store.list_records(entity_type, entity_id, status=None):
+            if not record.get('file_path'):
+                continue
+            try:
+                self._delete_record_file(record)
+                deleted_count += 1
+            except Exception as e:
+                logger.error(f"[1.6.2] 删除文件时出错: {e}")
+        # 清理没有记录的残留文件(如未完成的临时文件)
+        deleted_count += self._clear_storage_dir(storage_dir)
+        return deleted_count, self.store.delete_entity_records(entity_type, entity_id)
+    
+    def _remove_file_quietly(self, file_path):
+        """删除文件,文件不存在时忽略"""
+        try:
+            if file_path and os.path.exists(file_path):
+                os.remove(file_path)
+                return True
+        except Exception as e:
+            logger.error(f"[1.6.2] 删除文件时出错: {e}")
+        return False
+    
+    @staticmethod
+    def _parse_size_text(text):
+        """解析 1MB、512KB、100 这样的大小写法,返回字节数,无法解析时返回None"""
+        match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*(b|k|kb|m|mb|g|gb)?', text.strip().lower())
+        if not match:
+            return None
+        unit = (match.group(2) or 'b')[0]
+        return int(float(match.group(1)) * {'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}[unit])
+    
+    def _parse_list_options(self, text):
+        """解析查看文件指令的参数,返回(选项, 错误提示)
+
+        支持: 页码(2)、排序(按时间/按大小/按名称、正序/倒序)、类型(.pdf)、大小(>1MB、<500KB)、最近天数(7天)。
+        """
+        options = {
+            'page': 1, 'sort': 'time', 'descending': True, 'file_type': None,
+            'since_days': None, 'min_size': None, 'max_size': None,
+        }
+        # 第一个词是指令本身
+        for token in (text or '').split()[1:]:
+            lowered = token.lower()
+            days = re.fullmatch(r'(\d+)(天|d)', lowered)
+            if lowered in ('-h', '--help', '帮助'):
+                return options, "用法: /查看文件 [页码] [按时间/按大小/按名称] [正序] [.类型] [>1MB] [<500KB] [7天]"
+            elif token.isdigit():
+                options['page'] = max(1, int(token))
+            elif lowered in LIST_SORT_ALIASES:
+                options['sort'] = LIST_SORT_ALIASES[lowered]
+            elif lowered in ('正序', 'asc'):
+                options['descending'] = False
+            elif lowered in ('倒序', 'desc'):
+                options['descending'] = True
+            elif lowered.startswith('.') and len(lowered) > 1:
+                options['file_type'] = lowered
+            elif days:
+                options['since_days'] = int(days.group(1))
+            elif lowered[0] in '<>' and self._parse_size_text(lowered[1:]) is not None:
+                options['min_size' if lowered[0] == '>' else 'max_size'] = self._parse_size_text(lowered[1:])
+            else:
+                return options, f"❌ 无法识别的参数: {token}\n可用参数: 页码、按时间/按大小/按名称、正序、.类型、>1MB、<500KB、7天"
+        return options, None
+    
+    @staticmethod
+    def _is_default_listing(options):
+        """未筛选且按时间从新到旧排列时,列表序号与发送/删除指令的序号一致"""
+        return (options['sort'] == 'time' and options['descending'] and not options['file_type']
+                and options['since_days'] is None and options['min_size'] is None and options['max_size'] is None)
+    
+    def _describe_list_options(self, options):
+        """列表标题中展示的排序与筛选条件"""
+        parts = []
+        if options['file_type']:
+            parts.append(f"类型{options['file_type']}")
+        if options['min_size'] is not None:
+            parts.append(f">{self._format_file_size(options['min_size'])}")
+        if options['max_size'] is not None:
+            parts.append(f"<{self._format_file_size(options['max_size'])}")
+        if options['since_days'] is not None:
+            parts.append(f"最近{options['since_days']}天")
+        if options['sort'] != 'time' or not options['descending']:
+            parts.append(LIST_SORT_NAMES.get(options['sort'], options['sort']) + ('' if options['descending'] else '正序'))
+        return ', '.join(parts)
+    
+    @staticmethod
+    def _list_cursor_after(record, sort):
+        """记录在排序字段上的取值与记录ID,作为下一页的起点"""
+        value = record.get(LIST_SORT_FIELDS.get(sort, 'receive_time'))
+        if value is None:
+            value = '' if sort == 'name' else 0
+        return value, record['id']
+    
+    @staticmethod
+    def _encode_list_cursor(state):
+        """把翻页状态编码为不透明的游标字符串"""
+        raw = json.dumps(state, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+    
+    @staticmethod
+    def _decode_list_cursor(cursor):
+        """解析游标字符串,无效时返回None"""
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            state = json.loads(raw.decode('utf-8'))
+            if isinstance(state, dict) and isinstance(state.get('i'), int) and 'v' in state:
+                return state
+        except (ValueError, TypeError, UnicodeDecodeError):
+            pass
+        return None
+    
+    async def _page_files(self, entity_type, entity_id, options, page_size, after=None, offset=0):
+        """按排序与筛选条件读取一页成功记录,返回(本页记录, 是否还有下一页)"""
+        since = time.time() - options['since_days'] * 86400 if options['since_days'] is not None else None
+        return await self._run_io(
+            self.store.page_records, entity_type, entity_id,
+            sort=options['sort'], descending=options['descending'], limit=page_size,
+            after=after, offset=offset, file_type=options['file_type'], since=since,
+            min_size=options['min_size'], max_size=options['max_size']
+        )
+    
+    async def _list_files_command(self, event, entity_type, entity_id, title, command, send_command, delete_command, empty_message):
+        """查看文件/查看群文件指令: 按页列出文件,顺序翻页时从上一页的游标继续读取
+
+        游标与记录变更代数一起保存,期间有文件接收、删除或重置时游标作废,改按偏移量读取,
+        显示的序号始终与发送/删除指令使用的序号一致。
+        """
+        options, error = self._parse_list_options(event.message_str)
+        if error:
+            await event.send(event.plain_result(error))
+            return
+        
+        page_size = max(1, min(int(self.list_page_size or 10), LIST_PAGE_SIZE_MAX))
+        page = options['page']
+        cursor_key = (entity_type, str(entity_id)) + tuple(v for k, v in sorted(options.items()) if k != 'page')
+        
+        try:
+            generation = await self._run_io(self.store.entity_generation, entity_type, entity_id)
+            cursors = self._list_cursors.get(cursor_key)
+            if cursors is not None and cursors['generation'] != generation:
+                del self._list_cursors[cursor_key]
+                cursors = None
+            after = cursors['pages'].get(page) if cursors and page > 1 else None
+            records, has_more = await self._page_files(
+                entity_type, entity_id, options, page_size,
+                after=after, offset=0 if after else (page - 1) * page_size
+            )
+            usage = await self._run_io(self.store.entity_usage, entity_type, entity_id)
+        except Exception as e:
+            logger.error(f"[1.6.2] 读取文件记录出错: {e}")
+            await event.send(event.plain_result("❌ 读取记录文件出错"))
+            return
+        
+        if not records:
+            if page == 1 and usage['files'] == 0:
+                await event.send(event.plain_result(empty_message))
+            elif page == 1:
+                await event.send(event.plain_result(f"📁 没有符合条件的文件: {self._describe_list_options(options)}"))
+            else:
+                await event.send(event.plain_result(f"📁 第{page}页没有文件"))
+            return
+        
+        if has_more:
+            if cursors is None:
+                cursors = self._list_cursors[cursor_key] = {'generation': generation, 'pages': {}}
+            cursors['pages'][page + 1] = self._list_cursor_after(records[-1], options['sort'])
+        if cursors is not None:
+            self._list_cursors.move_to_end(cursor_key)
+            while len(self._list_cursors) > LIST_CURSOR_CACHE_SIZE:
+                self._list_cursors.popitem(last=False)
+        
+        numbered = self._is_default_listing(options)
+        if numbered:
+            total_pages = max(1, -(-usage['files'] // page_size))
+            msg_lines = [f"📄 {title} (共{usage['files']}个文件, 第{page}/{total_pages}页):"]
+        else:
+            msg_lines = [f"📄 {title} ({self._describe_list_options(options)}, 第{page}页):"]
+        msg_lines.append("序号 | 文件名 | 大小 | 类型 | 时间" if numbered else "文件名 | 大小 | 类型 | 时间")
+        msg_lines.append("-" * 50)
+        
+        for i, record in enumerate(records, (page - 1) * page_size + 1):
+            filename = record.get('final_filename', 'unknown')[:20]
+            size = self._format_file_size(record.get('file_size', 0))
+            filetype = record.get('file_type', 'unknown')
+            time_str = time.strftime('%m-%d %H:%M', time.localtime(record.get('receive_time', 0)))
+            prefix = f"{i}." if numbered else "•"
+            msg_lines.append(f"{prefix} {filename} | {size} | {filetype} | {time_str}")
+        
+        if has_more:
+            rest = [token for token in (event.message_str or '').split()[1:] if not token.isdigit()]
+            msg_lines.append(f"下一页: /{command} {' '.join([str(page + 1)] + rest)}")
+        
+        identifier_hint = "<序号/文件名>" if numbered else "<文件名>"
+        msg_lines.append(f"\n指令: /{send_command} {identifier_hint}  /{delete_command} {identifier_hint}")
+        msg_lines.append(f"筛选: /{command} [页码] [按大小/按名称] [.类型] [>1MB] [7天]")
+        
+        await event.send(event.plain_result('\n'.join(msg_lines)))
+    
+    # ==================== LLM工具 ====================
+    def _tool_access_error(self, context, entity_type, entity_id, require_caller=True):
+        """只允许访问发送者自己或当前群的文件
+
+        无法从工具上下文取得消息、也就无法确认调用者时默认拒绝;require_caller为False时不限制,
+        仅用于只列出私聊文件名的list_user_files,保持其原有行为。
+        """
+        event = getattr(getattr(context, 'context', None), 'event', None)
+        if event is None:
+            return "错误:无法确认调用者,拒绝访问文件" if require_caller else None
+        if entity_type == 'group':
+            group_id = getattr(getattr(event, 'message_obj', None), 'group_id', '') or ''
+            if str(group_id) != str(entity_id):
+                return "错误:只能访问当前群的文件"
+        elif self._get_user_id(event) != str(entity_id):
+            return "错误:只能访问当前用户自己的文件"
+        return None
+    
+    @staticmethod
+    def _tool_entity(kwargs):
+        """从工具参数中取出(类型, 用户ID/群号),group_id优先"""
+        group_id = str(kwargs.get("group_id") or '').strip()
+        if group_id:
+            return 'group', group_id
+        user_id = str(kwargs.get("user_id") or '').strip()
+        if user_id:
+            return 'user', user_id
+        return None, None
+    
+    async def _tool_list_files(self, entity_type, entity_id, kwargs):
+        """list_user_files/list_group_files: 按页列出文件,返回带next_cursor的文本"""
+        try:
+            page_size = int(kwargs.get("page_size") or self.list_page_size or 10)
+            page = int(kwargs.get("page") or 1)
+            since_days = kwargs.get("since_days")
+            min_size_kb = kwargs.get("min_size_kb")
+            max_size_kb = kwargs.get("max_size_kb")
+            options = {
+                'sort': kwargs.get("sort") if kwargs.get("sort") in LIST_SORT_FIELDS else 'time',
+                'descending': str(kwargs.get("descending", False)).lower() in ('true', '1'),
+                'file_type': (kwargs.get("file_type") or '').strip().lower() or None,
+                'since_days': int(since_days) if since_days not in (None, '') else None,
+                'min_size': int(min_size_kb) * 1024 if min_size_kb not in (None, '') else None,
+                'max_size': int(max_size_kb) * 1024 if max_size_kb not in (None, '') else None,
+            }
+        except (TypeError, ValueError):
+            return "错误:page、page_size、since_days、min_size_kb、max_size_kb必须是整数"
+        page_size = max(1, min(page_size, LIST_PAGE_SIZE_MAX))
+        if options['file_type'] and not options['file_type'].startswith('.'):
+            options['file_type'] = '.' + options['file_type']
+        
+        # 游标记录上一页最后一条记录、已列出的数量和记录变更代数,排序方式以游标为准;
+        # 期间文件有增删时游标作废,按已列出的数量改用偏移量,序号仍与其他工具一致
+        cursor = str(kwargs.get("cursor") or '').strip()
+        after = None
+        start = (max(1, page) - 1) * page_size
+        generation = list(await self._run_io(self.store.entity_generation, entity_type, entity_id))
+        if cursor:
+            state = self._decode_list_cursor(cursor)
+            if state is None:
+                return "错误:cursor无效,请不带cursor重新获取第一页"
+            options['sort'] = state.get('s', options['sort'])
+            options['descending'] = bool(state.get('d', options['descending']))
+            if state.get('g') == generation:
+                after = (state['v'], state['i'])
+            start = int(state.get('n', 0))
+        
+        records, has_more = await self._page_files(
+            entity_type, entity_id, options, page_size, after=after, offset=0 if after else start
+        )
+        if not records:
+            return ("该用户暂无文件" if entity_type == 'user' else "该群暂无文件") if start == 0 else "没有更多文件了"
         
-        record_file = os.path.join(user_storage_path, '.file_records.json')
-        if not os.path.exists(record_file):
-            await event.send(event.plain_result("📁 暂无文件记录"))
-            return
+        # 未筛选且按时间从旧到新时,序号与读取、搜索、删除等工具的file_index一致
+        numbered = (options['sort'] == 'time' and not options['descending'] and not options['file_type']
+                    and options['since_days'] is None and options['min_size'] is None
+                    and options['max_size'] is None)
+        title = "用户文件列表" if entity_type == 'user' else "群文件列表"
+        lines = [f"{title}(第{start + 1}-{start + len(records)}个):"]
+        for i, record in enumerate(records, start + 1):
+            receive_time = record.get('receive_time', 0)
+            lines.append(f"{f'{i}.' if numbered else '-'} 文件名: {record.get('final_filename', 'unknown')}")
+            lines.append(f"   路径: {record.get('file_path', 'unknown')}")
+            lines.append(f"   大小: {self._format_file_size(record.get('file_size', 0))}")
+            lines.append(f"   类型: {record.get('file_type', 'unknown')}")
+            lines.append(f"   时间: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(receive_time))}")
+            lines.append("")
         
-        try:
-            with open(record_file, 'r', encoding='utf-8') as f:
-                records = json.load(f)
-                success_records = [r for r in records if r.get('download_status') == 'success']
-        except:
-            await event.send(event.plain_result("❌ 读取记录文件出错"))
-            return
+        if has_more:
+            value, record_id = self._list_cursor_after(records[-1], options['sort'])
+            next_cursor = self._encode_list_cursor({
+                's': options['sort'], 'd': options['descending'],
+                'v': value, 'i': record_id, 'n': start + len(records), 'g': generation,
+            })
+            lines.append(f"next_cursor: {next_cursor}")
+        else:
+            lines.append("已是最后一页")
+        return '\n'.join(lines).strip()
+    
+    async def _tool_find_record(self, entity_type, entity_id, kwargs):
+        """按file_index(按接收时间从旧到新,从1开始)或file_name查找记录,返回(记录, 错误提示)"""
+        index = await self._run_io(self.store.name_index, entity_type, entity_id)
+        records = index.records
+        if not records:
+            return None, "该用户暂无文件" if entity_type == 'user' else "该群暂无文件"
         
-        if not success_records:
-            await event.send(event.plain_result("📁 暂无文件记录"))
-            return
+        file_name = str(kwargs.get("file_name") or '').strip()
+        if file_name:
+            mode, positions = index.lookup(file_name)
+            if positions:
+                return records[positions[0]], None
+            suggestions = index.suggest(file_name)
+            hint = f",相近的文件: {', '.join(r.get('final_filename', '') for r in suggestions)}" if suggestions else ''
+            return None, f"错误:未找到文件 {file_name}{hint}"
         
-        success_records.sort(key=lambda x: x.get('receive_time', 0), reverse=True)
+        try:
+            file_index = int(kwargs.get("file_index", 0))
+        except (TypeError, ValueError):
+            return None, "错误:file_index必须是整数"
+        # 文件名索引按从新到旧排列,工具序号按从旧到新
+        if not 1 <= file_index <= len(records):
+            return None, f"错误:序号超出范围 (1-{len(records)})"
+        return records[len(records) - file_index], None
+    
+    async def _tool_read_file(self, entity_type, entity_id, kwargs):
+        """read_user_file/read_group_file: 按offset/length分段读取文件的文本内容"""
+        try:
+            offset = max(0, int(kwargs.get("offset") or 0))
+            length = int(kwargs.get("length") or self.max_auto_read_size or TOOL_READ_MAX_CHARS)
+        except (TypeError, ValueError):
+            return "错误:offset、length必须是整数"
+        length = max(1, min(length, TOOL_READ_MAX_CHARS))
         
-        msg_lines = [f"📄 您的私聊文件 (共{len(success_records)}个文件):"]
-        msg_lines.append("序号 | 文件名 | 大小 | 类型 | 时间")
-        msg_lines.append("-" * 50)
+        record, error = await self._tool_find_record(entity_type, entity_id, kwargs)
+        if error:
+            return error
+        filename = record.get('final_filename', '')
+        source = await self._record_text_source(record)
+        if source is None:
+            return f"无法读取文件 {filename} 的文本内容"
+        content, has_more = await self._run_io(self._read_text_range, source[0], source[1], offset, length)
+        if content is None:
+            return f"无法读取文件 {filename} 的文本内容"
+        if not content:
+            return f"{filename} 在第{offset}个字符之后没有更多内容"
         
-        for i, record in enumerate(success_records[:10], 1):
-            filename = record.get('final_filename', 'unknown')[:20]
-            size = self._format_file_size(record.get('file_size', 0))
-            filetype = record.get('file_type', 'unknown')
-            time_str = time.strftime('%m-%d %H:%M', time.localtime(record.get('receive_time', 0)))
-            
-            msg_lines.append(f"{i}. {filename} | {size} | {filetype} | {time_str}")
+        end = offset + len(content)
+        footer = f"\n[还有更多内容,使用offset={end}继续读取]" if has_more else "\n[已读取到文件末尾]"
+        return f"{filename} 的内容(第{offset}-{end}个字符):\n{content}{footer}"
+    
+    async def _tool_search_files(self, entity_type, entity_id, query, limit):
+        """search_files: 按文件名和文本内容搜索,只扫描最近的文件且总扫描字符数有上限"""
+        index = await self._run_io(self.store.name_index, entity_type, entity_id)
+        records = index.records
+        if not records:
+            return "该用户暂无文件" if entity_type == 'user' else "该群暂无文件"
+        total = len(records)
         
-        if len(success_records) > 10:
-            msg_lines.append(f"... 还有{len(success_records) - 10}个文件")
+        lines = []
+        mode, positions = index.lookup(query)
+        if positions:
+            lines.append(f"文件名匹配({FILE_NAME_MATCH_NAMES.get(mode, mode)}):")
+            for position in positions[:limit]:
+                record = records[position]
+                lines.append(f"{total - position}. {record.get('final_filename', '')} "
+                             f"({self._format_file_size(record.get('file_size', 0))})")
         
-        msg_lines.append("\n指令: /发送文件 <序号/文件名>  /删除文件 <序号/文件名>")
+        # 只读取已有的文本(文本文件或已提取的文档),不为搜索触发提取
+        content_lines = []
+        budget = TOOL_SEARCH_SCAN_CHARS
+        scanned_files = 0
+        for position, record in enumerate(records[:TOOL_SEARCH_MAX_FILES]):
+            if len(content_lines) >= limit or budget <= 0:
+                break
+            source = await self._record_text_source(record, extract=False)
+            if source is None:
+                continue
+            matches, scanned = await self._run_io(
+                self._scan_text_matches, source[0], source[1], query, limit - len(content_lines), budget
+            )
+            budget -= scanned
+            scanned_files += 1
+            for char_offset, snippet in matches:
+                content_lines.append(f"{total - position}. {record.get('final_filename', '')} "
+                                     f"第{char_offset}个字符: …{snippet}…")
+        if content_lines:
+            lines.append("内容匹配:")
+            lines.extend(content_lines)
         
-        await event.send(event.plain_result('\n'.join(msg_lines)))
+        if not lines:
+            return f"未找到与 {query} 相关的文件(已搜索文件名及最近{scanned_files}个文本文件的内容)"
+        if budget <= 0 or total > TOOL_SEARCH_MAX_FILES:
+            lines.append("[内容只搜索了最近的文件,更早的文件可按序号用read工具读取]")
+        lines.append("序号可作为file_index传给读取或删除工具")
+        return '\n'.join(lines)
+    
+    async def _tool_delete_file(self, entity_type, entity_id, kwargs):
+        """delete_file: 删除一个文件及其记录"""
+        record, error = await self._tool_find_record(entity_type, entity_id, kwargs)
+        if error:
+            return error
+        filename = record.get('final_filename', '')
+        async with self._entity_lock(entity_type, entity_id):
+            removed = await self._run_io(self._discard_record, record)
+        if not removed:
+            return f"文件已被删除: {filename}"
+        logger.info(f"[1.6.2] AI工具删除文件: {entity_type}_{entity_id}/{filename}")
+        return f"已删除文件: {filename}(其余文件的序号可能已变化,请重新列出后再操作)"
+    
+    # ==================== 私聊指令 ====================
+    @filter.command("查看文件", alias={'/fileinfo'})
+    async def view_files(self, event: AstrMessageEvent):
+        """查看私聊文件"""
+        user_id = self._get_user_id(event)
+        await self._list_files_command(
+            event, 'user', user_id, "您的私聊文件", "查看文件", "发送文件", "删除文件", "📁 暂无文件记录"
+        )
     
     @filter.command("发送文件")
     async def send_file(self, event: AstrMessageEvent, file_identifier: str = ""):
@@ -662,56 +3261,25 @@ class PluginMain(Star):
             return
         
         user_id = self._get_user_id(event)
-        user_storage_path = os.path.join(self.storage_path, f"user_{user_id}")
-        
-        record_file = os.path.join(user_storage_path, '.file_records.json')
-        if not os.path.exists(record_file):
-            await event.send(event.plain_result("❌ 暂无文件记录"))
-            return
         
         try:
-            with open(record_file, 'r', encoding='utf-8') as f:
-                records = json.load(f)
-                success_records = [r for r in records if r.get('download_status') == 'success']
-        except:
+            index = await self._run_io(self.store.name_index, 'user', user_id)
+        except Exception as e:
+            logger.error(f"[1.6.2] 读取文件记录出错: {e}")
             await event.send(event.plain_result("❌ 读取记录文件出错"))
             return
         
-        if not success_records:
+        if not index.records:
             await event.send(event.plain_result("❌ 暂无文件记录"))
             return
         
-        success_records.sort(key=lambda x: x.get('receive_time', 0), reverse=True)
-        
-        target_record = None
-        
-        if file_identifier.isdigit():
-            index = int(file_identifier) - 1
-            if 0 <= index < len(success_records):
-                target_record = success_records[index]
-            else:
-                await event.send(event.plain_result(f"❌ 序号超出范围 (1-{len(success_records)})"))
-                return
-        else:
-            for record in success_records:
-                if file_identifier in record.get('final_filename', ''):
-                    target_record = record
-                    break
-            
-            if not target_record:
-                for record in success_records:
-                    final_name = record.get('final_filename', '').lower()
-                    orig_name = record.get('original_name', '').lower()
-                    if file_identifier.lower() in final_name or file_identifier.lower() in orig_name:
-                        target_record = record
-                        break
-            
-            if not target_record:
-                await event.send(event.plain_result(f"❌ 未找到文件: {file_identifier}"))
-                return
+        target_record, error = self._find_target_record(index, file_identifier)
+        if not target_record:
+            await event.send(event.plain_result(error))
+            return
         
         file_path = target_record.get('file_path', '')
-        if not file_path or not os.path.exists(file_path):
+        if not file_path or not await self._run_io(os.path.exists, file_path):
             await event.send(event.plain_result("❌ 文件不存在或已被删除"))
             return
         
@@ -732,6 +3300,8 @@ class PluginMain(Star):
                 await event.send(event.file_result(file_path, filename))
             else:
                 await event.send(event.plain_result(f"📁 文件: {filename}\n路径: {file_path}"))
+        
+        await self._run_io(self.store.mark_sent, target_record['id'])
     
     @filter.command("删除文件")
     async def delete_file(self, event: AstrMessageEvent, file_identifier: str = ""):
@@ -741,73 +3311,39 @@ class PluginMain(Star):
             return
         
         user_id = self._get_user_id(event)
-        user_storage_path = os.path.join(self.storage_path, f"user_{user_id}")
-        
-        record_file = os.path.join(user_storage_path, '.file_records.json')
-        if not os.path.exists(record_file):
-            await event.send(event.plain_result("❌ 暂无文件记录"))
-            return
         
         try:
-            with open(record_file, 'r', encoding='utf-8') as f:
-                records = json.load(f)
-        except:
+            index = await self._run_io(self.store.name_index, 'user', user_id)
+        except Exception as e:
+            logger.error(f"[1.6.2] 读取文件记录出错: {e}")
             await event.send(event.plain_result("❌ 读取记录文件出错"))
             return
         
-        if not records:
+        if not index.records:
             await event.send(event.plain_result("❌ 暂无文件记录"))
             return
         
-        records.sort(key=lambda x: x.get('receive_time', 0), reverse=True)
-        
-        target_record = None
-        target_index = -1
-        
-        if file_identifier.isdigit():
-            index = int(file_identifier) - 1
-            if 0 <= index < len(records):
-                target_record = records[index]
-                target_index = index
-            else:
-                await event.send(event.plain_result(f"❌ 序号超出范围 (1-{len(records)})"))
-                return
-        else:
-            for i, record in enumerate(records):
-                if file_identifier in record.get('final_filename', ''):
-                    target_record = record
-                    target_index = i
-                    break
-            
-            if not target_record:
-                for i, record in enumerate(records):
-                    final_name = record.get('final_filename', '').lower()
-                    orig_name = record.get('original_name', '').lower()
-                    if file_identifier.lower() in final_name or file_identifier.lower() in orig_name:
-                        target_record = record
-                        target_index = i
-                        break
-            
-            if not target_record:
-                await event.send(event.plain_result(f"❌ 未找到文件: {file_identifier}"))
-                return
+        target_record, error = self._find_target_record(index, file_identifier)
+        if not target_record:
+            await event.send(event.plain_result(error))
+            return
         
         file_path = target_record.get('file_path', '')
         filename = target_record.get('final_filename', 'unknown')
         
-        if file_path and os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-                if self.debug_mode:
-                    logger.info(f"[1.6.2] 已删除文件: {file_path}")
-            except Exception as e:
-                logger.error(f"[1.6.2] 删除文件时出错: {e}")
-                await event.send(event.plain_result(f"❌ 删除文件失败: {filename}"))
-                return
+        try:
+            async with self._entity_lock('user', user_id):
+                removed = await self._run_io(self._discard_record, target_record)
+            if self.debug_mode:
+                logger.info(f"[1.6.2] 已删除文件: {file_path}")
+        except Exception as e:
+            logger.error(f"[1.6.2] 删除文件时出错: {e}")
+            await event.send(event.plain_result(f"❌ 删除文件失败: {filename}"))
+            return
         
-        records.pop(target_index)
-        with open(record_file, 'w', encoding='utf-8') as f:
-            json.dump(records, f, ensure_ascii=False, indent=2)
+        if not removed:
+            await event.send(event.plain_result(f"❌ 文件已被删除: {filename}"))
+            return
         
         await event.send(event.plain_result(f"✅ 文件删除成功!\n文件名: {filename}"))
         if self.debug_mode:
@@ -819,33 +3355,21 @@ class PluginMain(Star):
         user_id = self._get_user_id(event)
         user_storage_path = os.path.join(self.storage_path, f"user_{user_id}")
         
-        if not os.path.exists(user_storage_path):
+        if not await self._run_io(os.path.exists, user_storage_path):
             await event.send(event.plain_result("📁 暂无文件记录"))
             return
         
-        # 删除所有文件
+        # 删除所有文件及文件记录,释放共享的文件块引用
         deleted_count = 0
-        if os.path.exists(user_storage_path):
-            for file in os.listdir(user_storage_path):
-                file_path = os.path.join(user_storage_path, file)
-                if os.path.isfile(file_path) and not file.startswith('.'):
-                    try:
-                        os.remove(file_path)
-                        deleted_count += 1
-                        if self.debug_mode:
-                            logger.info(f"[1.6.2] 已删除文件: {file_path}")
-                    except Exception as e:
-                        logger.error(f"[1.6.2] 删除文件时出错: {e}")
-        
-        # 删除记录文件
-        record_file = os.path.join(user_storage_path, '.file_records.json')
-        if os.path.exists(record_file):
-            try:
-                os.remove(record_file)
-                if self.debug_mode:
-                    logger.info(f"[1.6.2] 已删除记录文件: {record_file}")
-            except Exception as e:
-                logger.error(f"[1.6.2] 删除记录文件时出错: {e}")
+        try:
+            async with self._entity_lock('user', user_id):
+                deleted_count, removed_records = await self._run_io(
+                    self._reset_entity_storage, 'user', user_id, user_storage_path
+                )
+            if self.debug_mode:
+                logger.info(f"[1.6.2] 已删除文件记录: {removed_records}条")
+        except Exception as e:
+            logger.error(f"[1.6.2] 删除文件记录时出错: {e}")
         
         await event.send(event.plain_result(f"✅ 私聊文件重置完成!\n共删除 {deleted_count} 个文件"))
         if self.debug_mode:
@@ -860,45 +3384,9 @@ class PluginMain(Star):
             return
         
         group_id = str(event.message_obj.group_id)
-        group_storage_path = os.path.join(self.storage_path, f"group_{group_id}")
-        
-        record_file = os.path.join(group_storage_path, '.file_records.json')
-        if not os.path.exists(record_file):
-            await event.send(event.plain_result("📁 暂无群文件记录"))
-            return
-        
-        try:
-            with open(record_file, 'r', encoding='utf-8') as f:
-                records = json.load(f)
-                success_records = [r for r in records if r.get('download_status') == 'success']
-        except:
-            await event.send(event.plain_result("❌ 读取记录文件出错"))
-            return
-        
-        if not success_records:
-            await event.send(event.plain_result("📁 暂无群文件记录"))
-            return
-        
-        success_records.sort(key=lambda x: x.get('receive_time', 0), reverse=True)
-        
-        msg_lines = [f"📄 群 {group_id} 的文件 (共{len(success_records)}个文件):"]
-        msg_lines.append("序号 | 文件名 | 大小 | 类型 | 时间")
-        msg_lines.append("-" * 50)
-        
-        for i, record in enumerate(success_records[:10], 1):
-            filename = record.get('final_filename', 'unknown')[:20]
-            size = self._format_file_size(record.get('file_size', 0))
-            filetype = record.get('file_type', 'unknown')
-            time_str = time.strftime('%m-%d %H:%M', time.localtime(record.get('receive_time', 0)))
-            
-            msg_lines.append(f"{i}. {filename} | {size} | {filetype} | {time_str}")
-        
-        if len(success_records) > 10:
-            msg_lines.append(f"... 还有{len(success_records) - 10}个文件")
-        
-        msg_lines.append("\n指令: /发送群文件 <序号/文件名>  /删除群文件 <序号/文件名>")
-        
-        await event.send(event.plain_result('\n'.join(msg_lines)))
+        await self._list_files_command(
+            event, 'group', group_id, f"群 {group_id} 的文件", "查看群文件", "发送群文件", "删除群文件", "📁 暂无群文件记录"
+        )
     
     @filter.command("发送群文件")
     async def send_group_file(self, event: AstrMessageEvent, file_identifier: str = ""):
@@ -912,56 +3400,25 @@ class PluginMain(Star):
             return
         
         group_id = str(event.message_obj.group_id)
-        group_storage_path = os.path.join(self.storage_path, f"group_{group_id}")
-        
-        record_file = os.path.join(group_storage_path, '.file_records.json')
-        if not os.path.exists(record_file):
-            await event.send(event.plain_result("❌ 暂无群文件记录"))
-            return
         
         try:
-            with open(record_file, 'r', encoding='utf-8') as f:
-                records = json.load(f)
-                success_records = [r for r in records if r.get('download_status') == 'success']
-        except:
+            index = await self._run_io(self.store.name_index, 'group', group_id)
+        except Exception as e:
+            logger.error(f"[1.6.2] 读取文件记录出错: {e}")
             await event.send(event.plain_result("❌ 读取记录文件出错"))
             return
         
-        if not success_records:
+        if not index.records:
             await event.send(event.plain_result("❌ 暂无群文件记录"))
             return
         
-        success_records.sort(key=lambda x: x.get('receive_time', 0), reverse=True)
-        
-        target_record = None
-        
-        if file_identifier.isdigit():
-            index = int(file_identifier) - 1
-            if 0 <= index < len(success_records):
-                target_record = success_records[index]
-            else:
-                await event.send(event.plain_result(f"❌ 序号超出范围 (1-{len(success_records)})"))
-                return
-        else:
-            for record in success_records:
-                if file_identifier in record.get('final_filename', ''):
-                    target_record = record
-                    break
-            
-            if not target_record:
-                for record in success_records:
-                    final_name = record.get('final_filename', '').lower()
-                    orig_name = record.get('original_name', '').lower()
-                    if file_identifier.lower() in final_name or file_identifier.lower() in orig_name:
-                        target_record = record
-                        break
-            
-            if not target_record:
-                await event.send(event.plain_result(f"❌ 未找到文件: {file_identifier}"))
-                return
+        target_record, error = self._find_target_record(index, file_identifier)
+        if not target_record:
+            await event.send(event.plain_result(error))
+            return
         
         file_path = target_record.get('file_path', '')
-        if not file_path or not os.path.exists(file_path):
+        if not file_path or not await self._run_io(os.path.exists, file_path):
             await event.send(event.plain_result("❌ 文件不存在或已被删除"))
             return
         
@@ -982,6 +3439,8 @@ class PluginMain(Star):
                 await event.send(event.file_result(file_path, filename))
             else:
                 await event.send(event.plain_result(f"📁 文件: {filename}\n路径: {file_path}"))
+        
+        await self._run_io(self.store.mark_sent, target_record['id'])
     
     @filter.command("删除群文件")
     async def delete_group_file(self, event: AstrMessageEvent, file_identifier: str = ""):
@@ -995,73 +3454,39 @@ class PluginMain(Star):
             return
         
         group_id = str(event.message_obj.group_id)
-        group_storage_path = os.path.join(self.storage_path, f"group_{group_id}")
-        
-        record_file = os.path.join(group_storage_path, '.file_records.json')
-        if not os.path.exists(record_file):
-            await event.send(event.plain_result("❌ 暂无群文件记录"))
-            return
         
         try:
-            with open(record_file, 'r', encoding='utf-8') as f:
-                records = json.load(f)
-        except:
+            index = await self._run_io(self.store.name_index, 'group', group_id)
+        except Exception as e:
+            logger.error(f"[1.6.2] 读取文件记录出错: {e}")
             await event.send(event.plain_result("❌ 读取记录文件出错"))
             return
         
-        if not records:
+        if not index.records:
             await event.send(event.plain_result("❌ 暂无群文件记录"))
             return
         
-        records.sort(key=lambda x: x.get('receive_time', 0), reverse=True)
-        
-        target_record = None
-        target_index = -1
-        
-        if file_identifier.isdigit():
-            index = int(file_identifier) - 1
-            if 0 <= index < len(records):
-                target_record = records[index]
-                target_index = index
-            else:
-                await event.send(event.plain_result(f"❌ 序号超出范围 (1-{len(records)})"))
-                return
-        else:
-            for i, record in enumerate(records):
-                if file_identifier in record.get('final_filename', ''):
-                    target_record = record
-                    target_index = i
-                    break
-            
-            if not target_record:
-                for i, record in enumerate(records):
-                    final_name = record.get('final_filename', '').lower()
-                    orig_name = record.get('original_name', '').lower()
-                    if file_identifier.lower() in final_name or file_identifier.lower() in orig_name:
-                        target_record = record
-                        target_index = i
-                        break
-            
-            if not target_record:
-                await event.send(event.plain_result(f"❌ 未找到文件: {file_identifier}"))
-                return
+        target_record, error = self._find_target_record(index, file_identifier)
+        if not target_record:
+            await event.send(event.plain_result(error))
+            return
         
         file_path = target_record.get('file_path', '')
         filename = target_record.get('final_filename', 'unknown')
         
-        if file_path and os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-                if self.debug_mode:
-                    logger.info(f"[1.6.2] 已删除群文件: {file_path}")
-            except Exception as e:
-                logger.error(f"[1.6.2] 删除群文件时出错: {e}")
-                await event.send(event.plain_result(f"❌ 删除群文件失败: {filename}"))
-                return
+        try:
+            async with self._entity_lock('group', group_id):
+                removed = await self._run_io(self._discard_record, target_record)
+            if self.debug_mode:
+                logger.info(f"[1.6.2] 已删除群文件: {file_path}")
+        except Exception as e:
+            logger.error(f"[1.6.2] 删除群文件时出错: {e}")
+            await event.send(event.plain_result(f"❌ 删除群文件失败: {filename}"))
+            return
         
-        records.pop(target_index)
-        with open(record_file, 'w', encoding='utf-8') as f:
-            json.dump(records, f, ensure_ascii=False, indent=2)
+        if not removed:
+            await event.send(event.plain_result(f"❌ 群文件已被删除: {filename}"))
+            return
         
         await event.send(event.plain_result(f"✅ 群文件删除成功!\n文件名: {filename}"))
         if self.debug_mode:
@@ -1077,33 +3502,21 @@ class PluginMain(Star):
         group_id = str(event.message_obj.group_id)
         group_storage_path = os.path.join(self.storage_path, f"group_{group_id}")
         
-        if not os.path.exists(group_storage_path):
+        if not await self._run_io(os.path.exists, group_storage_path):
             await event.send(event.plain_result("📁 暂无群文件记录"))
             return
         
-        # 删除所有文件
+        # 删除所有文件及文件记录,释放共享的文件块引用
         deleted_count = 0
-        if os.path.exists(group_storage_path):
-            for file in os.listdir(group_storage_path):
-                file_path = os.path.join(group_storage_path, file)
-                if os.path.isfile(file_path) and not file.startswith('.'):
-                    try:
-                        os.remove(file_path)
-                        deleted_count += 1
-                        if self.debug_mode:
-                            logger.info(f"[1.6.2] 已删除群文件: {file_path}")
-                    except Exception as e:
-                        logger.error(f"[1.6.2] 删除群文件时出错: {e}")
-        
-        # 删除记录文件
-        record_file = os.path.join(group_storage_path, '.file_records.json')
-        if os.path.exists(record_file):
-            try:
-                os.remove(record_file)
-                if self.debug_mode:
-                    logger.info(f"[1.6.2] 已删除群记录文件: {record_file}")
-            except Exception as e:
-                logger.error(f"[1.6.2] 删除群记录文件时出错: {e}")
+        try:
+            async with self._entity_lock('group', group_id):
+                deleted_count, removed_records = await self._run_io(
+                    self._reset_entity_storage, 'group', group_id, group_storage_path
+                )
+            if self.debug_mode:
+                logger.info(f"[1.6.2] 已删除群文件记录: {removed_records}条")
+        except Exception as e:
+            logger.error(f"[1.6.2] 删除群文件记录时出错: {e}")
         
         await event.send(event.plain_result(f"✅ 群 {group_id} 文件重置完成!\n共删除 {deleted_count} 个文件"))
         if self.debug_mode:
@@ -1137,6 +3550,187 @@ class PluginMain(Star):
         if self.debug_mode:
             logger.info(f"[1.6.2] 群 {group_id} 用户 {user_id} 开始等待文件接收,超时时间: {timeout_msg}秒")
     
+    @filter.command("压缩包", alias={'/archive'})
+    async def archive_members(self, event: AstrMessageEvent, file_identifier: str = "", member: str = ""):
+        """查看压缩包成员列表,或读取其中一个文本成员交给AI处理"""
+        if not file_identifier:
+            await event.send(event.plain_result(
+                "❌ 请指定压缩包\n用法: /压缩包 <序号/文件名> 查看成员\n      /压缩包 <序号/文件名> <成员序号/成员名> 读取成员"
+            ))
+            return
+        
+        group_id = getattr(event.message_obj, 'group_id', None)
+        if group_id:
+            entity_type, entity_id = 'group', str(group_id)
+        else:
+            entity_type, entity_id = 'user', self._get_user_id(event)
+        
+        try:
+            index = await self._run_io(self.store.name_index, entity_type, entity_id)
+        except Exception as e:
+            logger.error(f"[1.6.2] 读取文件记录出错: {e}")
+            await event.send(event.plain_result("❌ 读取记录文件出错"))
+            return
+        
+        target_record, error = self._find_target_record(index, file_identifier)
+        if not target_record:
+            await event.send(event.plain_result(error))
+            return
+        
+        archive = await self._load_archive(target_record)
+        if archive is None:
+            await event.send(event.plain_result("❌ 该文件不是可识别的压缩包"))
+            return
+        
+        if not member:
+            await event.send(event.plain_result(self._format_archive_listing(target_record, archive)))
+            return
+        
+        archive_member = self._find_archive_member(archive, member)
+        if not archive_member:
+            await event.send(event.plain_result(f"❌ 压缩包中未找到成员: {member}"))
+            return
+        
+        try:
+            content = await self._run_io(
+                self._read_archive_member, target_record['file_path'], archive, archive_member['name']
+            )
+        except ArchiveGuardError as e:
+            await event.send(event.plain_result(f"❌ {e}"))
+            return
+        except Exception as e:
+            logger.error(f"[1.6.2] 读取压缩包成员出错: {e}")
+            await event.send(event.plain_result("❌ 读取压缩包成员出错"))
+            return
+        
+        if content is None:
+            await event.send(event.plain_result("❌ 该成员不是文本文件"))
+            return
+        
+        display_name = f"{target_record.get('final_filename', 'archive')}/{archive_member['name']}"
+        await self._submit_auto_read(event, content, display_name)
+    
+    async def _load_archive(self, record):
+        """读取记录对应压缩包的成员索引,尚未索引时在分析进程池中建立;不是压缩包时返回None"""
+        sha256 = record.get('sha256')
+        if sha256:
+            archive = await self._run_io(self.store.get_archive_index, sha256)
+            if archive is not None:
+                return archive
+        try:
+            archive = await self.analysis_pool.run(
+                'archive_index', scan_archive, record.get('file_path', ''), self.archive_max_members
+            )
+        except (zipfile.BadZipFile, tarfile.TarError, OSError, EOFError) as e:
+            if self.debug_mode:
+                logger.info(f"[1.6.2] 无法读取压缩包: {e}")
+            return None
+        if sha256:
+            await self._run_io(self.store.save_archive_index, sha256, archive)
+        if self.debug_mode:
+            logger.info(f"[1.6.2] 已建立压缩包索引: {archive['format']}, {archive['member_count']} 个成员")
+        return archive
+    
+    @staticmethod
+    def _find_archive_member(archive, identifier):
+        """按序号、完整路径、文件名或部分名称查找压缩包成员"""
+        members = archive['members']
+        if identifier.isdigit():
+            index = int(identifier) - 1
+            return members[index] if 0 <= index < len(members) else None
+        for member in members:
+            if member['name'] == identifier:
+                return member
+        for member in members:
+            if os.path.basename(member['name']) == identifier:
+                return member
+        lowered = identifier.lower()
+        for member in members:
+            if lowered in member['name'].lower():
+                return member
+        return None
+    
+    def _check_archive_guards(self, archive, member):
+        """解压前检查成员数、解压后总大小和压缩比,防止压缩炸弹"""
+        if archive['truncated']:
+            raise ArchiveGuardError(f"压缩包成员数超过上限 {self.archive_max_members},拒绝解压")
+        max_total_bytes = self.archive_max_total_mb * 1024 * 1024
+        if max_total_bytes > 0 and archive['total_size'] > max_total_bytes:
+            raise ArchiveGuardError(
+                f"压缩包解压后总大小 {self._format_file_size(archive['total_size'])} "
+                f"超过上限 {self.archive_max_total_mb}MB,拒绝解压"
+            )
+        if self.archive_max_ratio > 0:
+            # ZIP成员单独压缩,按成员计算;tar.gz只能按整个压缩包计算
+            if member.get('compressed_size') is not None:
+                ratio = member['size'] / max(member['compressed_size'], 1)
+            else:
+                ratio = archive['total_size'] / max(archive['compressed_size'], 1)
+            if ratio > self.archive_max_ratio:
+                raise ArchiveGuardError(f"压缩比 {ratio:.0f}:1 超过上限 {self.archive_max_ratio}:1,疑似压缩炸弹")
+    
+    def _read_archive_member(self, file_path, archive, member_name):
+        """流式读取压缩包中一个成员的开头并解码为文本,不解压到磁盘;不是文本时返回None"""
+        member = next(m for m in archive['members'] if m['name'] == member_name)
+        self._check_archive_guards(archive, member)
+        
+        # 最多保留max_auto_read_size个字符,按每个字符至多4字节读取
+        max_chars = max(1, int(self.max_auto_read_size))
+        limit = max_chars * 4
+        if archive['format'] == 'zip':
+            with zipfile.ZipFile(file_path) as zf, zf.open(member_name) as f:
+                data = f.read(limit + 1)
+        else:
+            with tarfile.open(file_path, 'r:*') as tf:
+                f = tf.extractfile(member_name)
+                if f is None:
+                    return None
+                with f:
+                    data = f.read(limit + 1)
+        
+        truncated = len(data) > limit
+        data = data[:limit]
+        encoding = self._detect_text_encoding(data, whole_file=not truncated)
+        if encoding is None:
+            return None
+        content = data.decode(encoding, errors='ignore')
+        if truncated or len(content) > max_chars:
+            content = content[:max_chars] + "\n[内容已截断,原文过长]"
+        return content
+    
+    def _format_archive_listing(self, record, archive, limit=50):
+        """格式化压缩包成员列表"""
+        filename = record.get('final_filename', 'unknown')
+        msg_lines = [
+            f"📦 {filename} ({archive['format']}, 共{archive['member_count']}个文件, "
+            f"解压后 {self._format_file_size(archive['total_size'])})"
+        ]
+        msg_lines.append("序号 | 成员 | 大小")
+        msg_lines.append("-" * 50)
+        for i, member in enumerate(archive['members'][:limit], 1):
+            msg_lines.append(f"{i}. {member['name']} | {self._format_file_size(member['size'])}")
+        if archive['member_count'] > limit:
+            msg_lines.append(f"... 还有{archive['member_count'] - limit}个文件")
+        if archive['truncated']:
+            msg_lines.append(f"⚠️ 成员数超过上限 {self.archive_max_members},仅索引了前{len(archive['members'])}个")
+        msg_lines.append("\n指令: /压缩包 <文件序号> <成员序号/成员名> 读取成员内容")
+        return '\n'.join(msg_lines)
+    
+    def _clear_storage_dir(self, storage_dir):
+        """删除目录下所有非隐藏文件,返回删除数量"""
+        deleted_count = 0
+        for file in os.listdir(storage_dir):
+            file_path = os.path.join(storage_dir, file)
+            if os.path.isfile(file_path) and not file.startswith('.'):
+                try:
+                    os.remove(file_path)
+                    deleted_count += 1
+                    if self.debug_mode:
+                        logger.info(f"[1.6.2] 已删除文件: {file_path}")
+                except Exception as e:
+                    logger.error(f"[1.6.2] 删除文件时出错: {e}")
+        return deleted_count
+    
     def _get_user_id(self, event: AstrMessageEvent):
         """获取用户ID"""
         try:
@@ -1156,59 +3750,185 @@ class PluginMain(Star):
             return "unknown_user"
     
 
-    def _check_file_limit(self, entity_id, storage_path, max_files, entity_type="user"):
-        """通用文件数量限制检查"""
-        try:
-            record_file = os.path.join(storage_path, '.file_records.json')
-            if not os.path.exists(record_file):
-                return True
-
-            with open(record_file, 'r', encoding='utf-8') as f:
-                try:
-                    records = json.load(f)
-                    success_records = [r for r in records if r.get('download_status') == 'success']
-
-                    if len(success_records) >= max_files:
-                        entity_desc = "用户" if entity_type == "user" else "群"
-                        logger.warning(f"[1.6.2] 检测到{entity_desc}文件数量已达上限({max_files})")
-                        logger.info(f"[1.6.2] 准备删除最旧文件以腾出空间")
-                        logger.warning(f"[1.6.2] {entity_desc}文件数量已达上限({max_files}),将自动删除最旧文件")
-                        self._remove_oldest_file(success_records, storage_path, record_file)
-                        logger.info(f"[1.6.2] 已自动删除最旧文件,为新文件腾出空间")
-                        logger.info(f"[1.6.2] 文件删除完成,允许接收新文件")
-                        return True
-                    else:
-                        return True
+    def _storage_limits(self, entity_type):
+        """某类用户/群的(最大文件数, 最大字节数),0表示不限制"""
+        if entity_type == "user":
+            return self.max_files_per_user, self.max_storage_mb_per_user * 1024 * 1024
+        return self.max_files_per_group, self.max_storage_mb_per_group * 1024 * 1024
 
-                except:
-                    return True
+    def _enforce_storage_quota(self, entity_type, entity_id, incoming_size=0, reservation=None):
+        """接收新文件前按数量、字节配额和全局上限淘汰文件并预留配额,在I/O线程池中执行
 
-        except Exception as e:
+        用量来自记录库增量维护的计数加上其他下载中文件的预留,不遍历目录;淘汰顺序由eviction_policy决定。
+        锁内只挑选要淘汰的记录并登记预留,同时到达的多个文件不会超出配额;删除文件在释放锁之后进行,
+        一个用户/群的删除不会阻塞其他用户/群的准入。
+        reservation为None时通过后新建预留,否则把已有预留调整为incoming_size。
+        返回(是否允许接收, 被淘汰的记录列表, 预留);新文件本身或加上其他下载中文件的预留就超过配额时,
+        淘汰也腾不出空间,不淘汰文件直接拒绝。
+        调用方持有本用户/群的记录锁,这里只删除本用户/群的记录;按全局上限选中的其他用户/群的记录
+        放入reservation.pending_evictions,由调用方释放锁后通过_evict_pending删除。
+        """
+        with self._admission_lock:
+            admitted, victims = self._plan_eviction(entity_type, entity_id, incoming_size, reservation)
+            if not admitted:
+                return False, [], reservation
+            if reservation is None:
+                reservation = StorageReservation(self.store.entity_key(entity_type, entity_id), 0)
+                self._reserved[reservation.entity_key][0] += 1
+            self._reserved[reservation.entity_key][1] += incoming_size - reservation.size
+            self._reserved_total += incoming_size - reservation.size
+            reservation.size = incoming_size
+            for record in victims:
+                self._mark_evicting(record)
+        
+        evicted = []
+        for record in victims:
+            if self._record_entity_key(record) != reservation.entity_key:
+                reservation.pending_evictions.append(record)
+            elif self._evict_record(record):
+                evicted.append(record)
+        if evicted:
             entity_desc = "用户" if entity_type == "user" else "群"
-            logger.error(f"[1.6.2] 检查{entity_desc}文件限制时出错: {e}")
-            return True
-            # [v1.6.2] 删除旧文件后继续处理新文件\n
-    def _remove_oldest_file(self, records, storage_path, record_file):
-        """删除最旧的文件"""
+            logger.info(f"[1.6.2] {entity_desc}{entity_id}存储空间已达上限,已删除 {len(evicted)} 个文件")
+        return True, evicted, reservation
+    
+    def _evict_record(self, record):
+        """删除一条已登记为淘汰中的记录,结束后取消登记,返回是否删除,在I/O线程池中执行"""
         try:
-            records.sort(key=lambda x: x.get('receive_time', 0))
-            oldest_record = records[0]
-            
-            file_path = oldest_record.get('file_path', '')
-            if file_path and os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                    if self.debug_mode:
-                        logger.info(f"[1.6.2] 已删除最旧文件: {file_path}")
-                except Exception as e:
-                    logger.error(f"[1.6.2] 删除文件时出错: {e}")
-            
-            remaining_records = records[1:]
-            with open(record_file, 'w', encoding='utf-8') as f:
-                json.dump(remaining_records, f, ensure_ascii=False, indent=2)
-                
+            if self._discard_record(record):
+                if self.debug_mode:
+                    logger.info(f"[1.6.2] 存储空间超限,已删除文件: {record.get('file_path', '')}")
+                return True
         except Exception as e:
-            logger.error(f"[1.6.2] 删除最旧文件时出错: {e}")
+            # 文件未删除时保留记录,避免文件块引用计数与记录不一致;下次准入会重新挑选
+            logger.error(f"[1.6.2] 删除文件时出错: {e}")
+        finally:
+            with self._admission_lock:
+                self._unmark_evicting(record)
+        return False
+    
+    async def _evict_pending(self, reservation):
+        """删除准入时从其他用户/群挑选的淘汰记录,逐条持有所属用户/群的记录锁,返回被删除的记录
+
+        调用方不能持有任何用户/群的记录锁,否则两个用户/群同时互相淘汰时会死锁。
+        """
+        evicted = []
+        try:
+            while reservation.pending_evictions:
+                record = reservation.pending_evictions[-1]
+                async with self._entity_lock(record.get('type') or 'user', record.get('identifier') or ''):
+                    if await self._run_io(self._evict_record, record):
+                        evicted.append(record)
+                reservation.pending_evictions.pop()
+        finally:
+            # 被取消时未处理的记录取消登记,重新计入用量
+            with self._admission_lock:
+                for record in reservation.pending_evictions:
+                    self._unmark_evicting(record)
+            reservation.pending_evictions.clear()
+        if evicted:
+            logger.info(f"[1.6.2] 存储总量已达上限,已删除其他用户/群的 {len(evicted)} 个文件")
+        return evicted
+    
+    def _record_entity_key(self, record):
+        """记录所属用户/群的键"""
+        return self.store.entity_key(record.get('type') or 'user', record.get('identifier') or '')
+    
+    def _release_reservation(self, reservation):
+        """释放准入时预留的配额,可重复调用"""
+        with self._admission_lock:
+            if reservation.released:
+                return
+            reservation.released = True
+            reserved = self._reserved[reservation.entity_key]
+            reserved[0] -= 1
+            reserved[1] -= reservation.size
+            self._reserved_total -= reservation.size
+            if reserved[0] <= 0:
+                del self._reserved[reservation.entity_key]
+    
+    def _mark_evicting(self, record):
+        """登记已选中待删除的淘汰记录,调用方需持有_admission_lock"""
+        key = self._record_entity_key(record)
+        size = int(record.get('file_size') or 0)
+        self._evicting[record['id']] = (key, size)
+        self._evicting_usage[key][0] += 1
+        self._evicting_usage[key][1] += size
+        self._evicting_total += size
+    
+    def _unmark_evicting(self, record):
+        """淘汰记录删除结束(成功或失败)后取消登记,调用方需持有_admission_lock"""
+        entry = self._evicting.pop(record['id'], None)
+        if entry is None:
+            return
+        key, size = entry
+        pending = self._evicting_usage[key]
+        pending[0] -= 1
+        pending[1] -= size
+        self._evicting_total -= size
+        if pending[0] <= 0:
+            del self._evicting_usage[key]
+    
+    def _plan_eviction(self, entity_type, entity_id, incoming_size, reservation):
+        """按淘汰策略挑选要删除的记录直到新文件能放下,不删除任何文件,调用方需持有_admission_lock
+
+        返回(是否放得下, 要淘汰的记录列表);放不下时列表为空。
+        """
+        max_files, max_bytes = self._storage_limits(entity_type)
+        max_total = self.max_storage_mb_total * 1024 * 1024
+        if (max_bytes and incoming_size > max_bytes) or (max_total and incoming_size > max_total):
+            return False, []
+        
+        # 其他下载中文件的预留,调整已有预留时不计自身
+        key = self.store.entity_key(entity_type, entity_id)
+        reserved_files, reserved_bytes = self._reserved.get(key, (0, 0))
+        reserved_total = self._reserved_total
+        if reservation is not None:
+            reserved_files -= 1
+            reserved_bytes -= reservation.size
+            reserved_total -= reservation.size
+        
+        # 下载中文件的预留无法通过淘汰腾出,只算预留就放不下时直接拒绝,不删除任何文件
+        if ((max_files and reserved_files + 1 > max_files)
+                or (max_bytes and reserved_bytes + incoming_size > max_bytes)
+                or (max_total and reserved_total + incoming_size > max_total)):
+            return False, []
+        
+        # 正在被其他准入删除的记录已不计入用量
+        usage = self.store.entity_usage(entity_type, entity_id)
+        pending_files, pending_bytes = self._evicting_usage.get(key, (0, 0))
+        files = usage['files'] - pending_files
+        used_bytes = usage['bytes'] - pending_bytes
+        total = self.store.total_usage()['bytes'] - self._evicting_total if max_total else 0
+        
+        victims = []
+        chosen = set(self._evicting)
+        
+        def next_victim(scope_type, scope_id):
+            candidates = self.store.eviction_candidates(
+                self.eviction_policy, scope_type, scope_id, limit=len(chosen) + 20
+            )
+            return next((r for r in candidates if r['id'] not in chosen), None)
+        
+        while ((max_files and files + reserved_files >= max_files)
+               or (max_bytes and used_bytes + reserved_bytes + incoming_size > max_bytes)):
+            record = next_victim(entity_type, entity_id)
+            if record is None:
+                return False, []
+            victims.append(record)
+            chosen.add(record['id'])
+            files -= 1
+            used_bytes -= int(record.get('file_size') or 0)
+            total -= int(record.get('file_size') or 0)
+        
+        while max_total and total + reserved_total + incoming_size > max_total:
+            record = next_victim(None, None)
+            if record is None:
+                return False, []
+            victims.append(record)
+            chosen.add(record['id'])
+            total -= int(record.get('file_size') or 0)
+        return True, victims
     
     def _smart_filename_handling(self, original_name, detected_type, file_path):
         """智能文件名处理"""
@@ -1244,8 +3964,8 @@ class PluginMain(Star):
             timestamp = int(time.time())
             return f"file_{timestamp}{detected_type}"
     
-    async def _send_completion_message(self, event: AstrMessageEvent, filename, filepath, filesize, filetype, original_name, file_type):
-        """发送完成消息"""
+    async def _send_completion_message(self, event: AstrMessageEvent, filename, filepath, filesize, filetype, original_name, file_type, text_encoding=None, sha256=None):
+        """发送完成消息,text_encoding为下载时识别出的文本编码,sha256用于查找文档提取文本的缓存"""
         try:
             size_str = self._format_file_size(filesize)
             
@@ -1271,49 +3991,185 @@ class PluginMain(Star):
                 logger.info(f"[1.6.2] 已发送完成消息: {filename}")
             # 自动读取文本文件内容功能
             if self.auto_read_content:
-                # 检查文件大小限制
                 try:
-                    file_size = os.path.getsize(filepath)
-                    max_size = self.max_auto_read_size
-
-                    if file_size <= max_size:
-                        # 检查是否为文本文件
-                        if self._is_plain_text_file(filename):
-                            # 读取文件内容
-                            content = self._read_text_file_safely(filepath)
-                            if content:
-                                logger.info(f"[AutoRead] 自动读取文本文件内容: {filename}")
-                                
-                                # 核心功能:将文件内容作为用户消息处理,触发AI自然回复
-                                try:
-                                    clean_content = content.strip()
-                                    if len(clean_content) > self.max_auto_read_size:
-                                        clean_content = clean_content[:self.max_auto_read_size] + "\n[内容已截断,原文过长]"
-                                    
-                                    await self._handle_file_as_user_message(event, clean_content, filename)
-                                    logger.info(f"[AutoRead-AI] 已提交AI处理文件内容")
-                                except Exception as ai_error:
-                                    logger.error(f"[AutoRead-AI] AI处理失败: {ai_error}")
-                                    # AI处理失败时的降级处理
-                                    try:
-                                        await self._send_reply(event, f"📄 文件内容:\n{content[:500]}...")
-                                    except:
-                                        try:
-                                            from astrbot.api.event import MessageChain
-                                            message_chain = MessageChain().message(f"📄 文件已读取并提交AI分析")
-                                            await self.context.send_message(event.unified_msg_origin, message_chain)
-                                        except:
-                                            pass
-                            else:
-                                logger.info(f"[AutoRead] 文件格式不正确")
+                    # 检查是否为文本文件,内容按行/段落流式分块读取,不受文件大小限制
+                    if self._is_plain_text_file(filename):
+                        await self._auto_read_text_file(event, filename, filepath, text_encoding)
+                    elif self.extract_text_enabled and filetype in TEXT_EXTRACTORS:
+                        # PDF/Office文档先提取文本(结果按内容哈希缓存),再按文本文件分块读取
+                        text_path = await self._get_extracted_text_path(sha256, filepath, filetype)
+                        if text_path:
+                            await self._auto_read_text_file(event, filename, text_path, 'utf-8')
+                        else:
+                            logger.info(f"[AutoRead] 无法提取文档文本,跳过自动读取: {filename}")
                     else:
-                        logger.info(f"[AutoRead] 文件过大或格式不对,跳过自动读取: {file_size} bytes > {max_size} bytes")
-                except Exception as size_error:
-                    logger.error(f"[AutoRead] 检查文件时出错: {size_error}")
+                        logger.info(f"[AutoRead] 文件格式不对,跳过自动读取: {filename}")
+                except Exception as read_error:
+                    logger.error(f"[AutoRead] 读取文件时出错: {read_error}")
 
         except Exception as e:
             logger.error(f"[1.6.2] 发送完成消息出错: {e}")
     
+    async def _auto_read_text_file(self, event, filename, filepath, text_encoding=None):
+        """流式分块读取文本文件,按顺序提交AI处理
+
+        每块不超过auto_read_chunk_tokens个估算token,最多提交auto_read_max_chunks块;
+        内存中只保留当前和下一块,与文件大小无关。
+        """
+        chunks = self._iter_text_chunks(filepath, text_encoding, self.auto_read_chunk_tokens)
+        max_chunks = max(1, int(self.auto_read_max_chunks))
+        try:
+            current = await self._run_io(next, chunks, None)
+            if current is None:
+                logger.info(f"[AutoRead] 文件内容为空: {filename}")
+                return
+            logger.info(f"[AutoRead] 自动读取文本文件内容: {filename}")
+            
+            index = 1
+            while current is not None:
+                following = await self._run_io(next, chunks, None)
+                if index == 1 and following is None:
+                    # 只有一块时与普通消息一致,不加分块标记
+                    await self._submit_auto_read(event, current, filename)
+                    break
+                label = f"{filename} (第{index}部分)"
+                await self._submit_auto_read(event, f"[{label}]\n{current}", label)
+                if following is not None and index >= max_chunks:
+                    await self._send_reply(event, f"📄 文件较长,已自动读取前{index}部分,其余内容未提交")
+                    break
+                current = following
+                index += 1
+        finally:
+            await self._run_io(chunks.close)
+    
+    async def _get_extracted_text_path(self, sha256, file_path, file_type):
+        """返回文档提取文本的缓存文件路径,首次访问时在进程池中提取;无法提取时返回None
+
+        缓存与文件块放在一起并按内容哈希命名,重复读取、AI工具调用和转发同一文档都不会再次提取。
+        """
+        if not sha256 or file_type not in TEXT_EXTRACTORS:
+            return None
+        cache_path = self._blob_path(sha256) + EXTRACTED_TEXT_SUFFIX
+        if await self._run_io(os.path.exists, cache_path):
+            self.extract_stats['hits'] += 1
+            return cache_path
+        
+        task = self._extract_tasks.get(sha256)
+        if task is None:
+            task = asyncio.ensure_future(self._extract_to_cache(file_path, file_type, cache_path))
+            self._extract_tasks[sha256] = task
+            task.add_done_callback(lambda _: self._extract_tasks.pop(sha256, None))
+        return await asyncio.shield(task)
+    
+    async def _extract_to_cache(self, file_path, file_type, cache_path):
+        """在进程池中提取文档文本并写入缓存文件"""
+        try:
+            text = await self.analysis_pool.run(
+                'extract', extract_document_text, file_type, file_path, int(self.extract_max_chars)
+            )
+        except Exception as e:
+            self.extract_stats['failed'] += 1
+            logger.warning(f"[1.6.2] 提取文档文本失败: {e}")
+            return None
+        if text is None:
+            # 缺少可选依赖(如pypdf)时不写缓存,安装后即可提取
+            if self.debug_mode:
+                logger.info(f"[1.6.2] 暂不支持提取{file_type}文本")
+            return None
+        await self._run_io(self._write_text_cache, cache_path, text)
+        self.extract_stats['extracted'] += 1
+        if self.debug_mode:
+            logger.info(f"[1.6.2] 已提取文档文本: {len(text)} 字符 -> {cache_path}")
+        return cache_path
+    
+    @staticmethod
+    def _write_text_cache(cache_path, text):
+        """原子地写入提取文本缓存"""
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, cache_path)
+    
+    async def _record_text_source(self, record, extract=True):
+        """记录对应的(文本文件路径, 编码): 文档为提取文本缓存,文本文件为文件本身;不支持时返回None
+
+        extract为False时只使用已有的提取缓存,不触发提取。
+        """
+        file_type = record.get('file_type', '')
+        file_path = record.get('file_path', '')
+        if file_type in TEXT_EXTRACTORS:
+            if not self.extract_text_enabled:
+                return None
+            if extract:
+                text_path = await self._get_extracted_text_path(record.get('sha256'), file_path, file_type)
+            elif record.get('sha256'):
+                text_path = self._blob_path(record['sha256']) + EXTRACTED_TEXT_SUFFIX
+                if not await self._run_io(os.path.exists, text_path):
+                    text_path = None
+            else:
+                text_path = None
+            return (text_path, 'utf-8') if text_path else None
+        if file_type == '.txt' or self._is_plain_text_file(record.get('final_filename', '')):
+            return file_path, record.get('text_encoding')
+        return None
+    
+    async def _submit_auto_read(self, event, content, label):
+        """将一段文件内容提交AI处理,失败时降级为直接发送内容摘要"""
+        # 核心功能:将文件内容作为用户消息处理,触发AI自然回复
+        try:
+            await self._handle_file_as_user_message(event, content, label)
+            logger.info(f"[AutoRead-AI] 已提交AI处理文件内容: {label}")
+        except Exception as ai_error:
+            logger.error(f"[AutoRead-AI] AI处理失败: {ai_error}")
+            # AI处理失败时的降级处理
+            try:
+                await self._send_reply(event, f"📄 文件内容:\n{content[:500]}...")
+            except:
+                try:
+                    from astrbot.api.event import MessageChain
+                    message_chain = MessageChain().message(f"📄 文件已读取并提交AI分析")
+                    await self.context.send_message(event.unified_msg_origin, message_chain)
+                except:
+                    pass
+    
+    @staticmethod
+    def _estimate_tokens(text):
+        """粗略估算token数:中日韩字符约1个token,其余字符约4个一个token"""
+        wide = sum(1 for c in text if ord(c) >= 0x2E80)
+        return wide + (len(text) - wide + 3) // 4
+    
+    def _iter_text_chunks(self, file_path, encoding=None, chunk_tokens=1500):
+        """增量解码文本文件,在行/段落边界切分为不超过chunk_tokens的分块
+
+        超长的单行按字符数硬切分;只包含空白的分块会被跳过。
+        """
+        if not encoding:
+            head, whole_file = self._read_file_head(file_path)
+            encoding = self._detect_text_encoding(head, whole_file) or 'utf-8'
+        chunk_tokens = max(1, int(chunk_tokens))
+        parts = []
+        tokens = 0
+        with open(file_path, 'r', encoding=encoding, errors='replace') as f:
+            # readline带长度上限,没有换行的超大文件也不会一次读入内存
+            for line in iter(lambda: f.readline(chunk_tokens), ''):
+                line_tokens = self._estimate_tokens(line)
+                if parts and tokens + line_tokens > chunk_tokens:
+                    chunk = ''.join(parts).strip()
+                    if chunk:
+                        yield chunk
+                    parts, tokens = [], 0
+                parts.append(line)
+                tokens += line_tokens
+                # 已过半时遇到空行(段落结束)就切分
+                if not line.strip() and tokens >= chunk_tokens // 2:
+                    chunk = ''.join(parts).strip()
+                    if chunk:
+                        yield chunk
+                    parts, tokens = [], 0
+        chunk = ''.join(parts).strip()
+        if chunk:
+            yield chunk
+    
     def _is_plain_text_file(self, filename):
         """判断是否为纯文本文件"""
         text_extensions = {'.txt', '.py', '.js', '.html', '.css', '.json', '.xml', '.md', '.log', '.csv', '.ini', '.cfg', '.yml', '.yaml'}
@@ -1331,31 +4187,72 @@ class PluginMain(Star):
         else:
             return f"{size_bytes / (1024 * 1024 * 1024):.1f} GB"
     
-    def _detect_file_type_detailed(self, filepath):
+    @staticmethod
+    def _format_quota(quota_mb):
+        """格式化存储配额,0表示不限制"""
+        return f"{quota_mb}MB" if quota_mb > 0 else "不限大小"
+    
+    def _read_file_head(self, filepath):
+        """读取文件开头用于类型识别,返回(开头字节, 是否已读到完整文件)"""
+        with open(filepath, 'rb') as f:
+            head = f.read(SNIFF_HEAD_BYTES + 1)
+        return head[:SNIFF_HEAD_BYTES], len(head) <= SNIFF_HEAD_BYTES
+    
+    def _refine_container_type(self, filepath, sniff):
+        """文件头识别为ZIP容器时,读取中央目录确定具体类型,更新并返回sniff"""
+        if sniff['file_type'] in ZIP_CONTAINER_TYPES:
+            container_type = detect_zip_container(filepath)
+            if container_type:
+                sniff['file_type'] = container_type
+        return sniff
+    
+    def _sniff_file(self, filepath):
+        """对已存在的文件做类型识别,只读取一次文件开头(ZIP容器另读中央目录)"""
+        if not os.path.exists(filepath):
+            return {'file_type': '.bin', 'encoding': None, 'is_text': False}
+        try:
+            head, whole_file = self._read_file_head(filepath)
+        except Exception as e:
+            if self.debug_mode:
+                logger.warning(f"[1.6.2] 读取文件头失败: {e}")
+            return {'file_type': '.bin', 'encoding': None, 'is_text': False}
+        return self._refine_container_type(filepath, self._sniff_head(head, whole_file))
+    
+    def _sniff_head(self, head, whole_file=False):
+        """根据文件开头的字节一次给出类型、文本编码和文本/二进制判断
+
+        whole_file表示head就是完整文件,此时末尾不完整的多字节字符视为解码失败。
+        """
+        encoding = self._detect_text_encoding(head, whole_file)
+        file_type = self._detect_type_from_head(head, encoding)
+        if file_type != '.txt':
+            # 按文件头识别为二进制格式时不再视为文本
+            encoding = None
+        return {
+            'file_type': file_type,
+            'encoding': encoding,
+            'is_text': encoding is not None
+        }
+    
+    def _detect_type_from_head(self, header, encoding=None):
         """增强的文件类型检测 - 修复PPTX识别问题和文本文件识别问题
         
         支持五层检测机制:
         1. filetype库检测
-        2. 文本文件检测
-        3. 文件头特征分析
+        2. 文件头特征分析
+        3. 文本文件检测(encoding为已识别的文本编码)
         4. 二进制文件判断
         5. 默认类型返回
         """
-        import os
-        
-        # 检查文件是否存在
-        if not os.path.exists(filepath):
-            return ".bin"
-        
         # [v1.6.2] 第一层检测:使用filetype库(如果可用)
         try:
             import filetype
-            kind = filetype.guess(filepath)
+            kind = filetype.guess(header)
             if kind is not None:
                 detected_ext = f".{kind.extension}"
                 if self.debug_mode:
                     logger.info(f"[1.6.2] filetype库检测结果: {kind.mime} -> {detected_ext}")
-                    return detected_ext
+                return detected_ext
         except ImportError:
             if self.debug_mode:
                 logger.debug("[1.6.2] filetype库未安装,跳过第一层检测")
@@ -1365,9 +4262,6 @@ class PluginMain(Star):
                 
         # [v1.6.2] 第二层检测:文件头特征分析
         try:
-            with open(filepath, 'rb') as f:
-                header = f.read(2048)  # 读取前2048字节以获得更多信息
-            
             # 检查常见的文件头特征
             if header.startswith(b'\x89PNG\r\n\x1a\n'):
                 return ".png"
@@ -1383,33 +4277,13 @@ class PluginMain(Star):
                 return ".rar"
             elif header.startswith(b'7z\xbc\xaf\'\x27\x1c'):
                 return ".7z"
+            elif header[257:262] == b'ustar':
+                return ".tar"
             
-            # 特别处理ZIP文件(重点优化Office文档识别)
+            # ZIP容器(Office文档、jar、apk、epub等)的具体类型需要读取中央目录,
+            # 由_refine_container_type在拿到完整文件后识别
             elif header.startswith(b'PK'):
-                # 对于ZIP文件，进一步检查内部结构来判断是否为Office文档
-                try:
-                    # 读取更多内容来分析ZIP内部结构
-                    with open(filepath, 'rb') as f:
-                        zip_content = f.read(8192)  # 读取更多内容
-                    
-                    # 检查Office Open XML文档的特征文件
-                    if b'[Content_Types].xml' in zip_content:
-                        # 进一步区分具体的Office文档类型
-                        if b'word/' in zip_content and b'document.xml' in zip_content:
-                            return ".docx"
-                        elif b'xl/' in zip_content and b'workbook.xml' in zip_content:
-                            return ".xlsx"
-                        elif b'ppt/' in zip_content and b'presentation.xml' in zip_content:
-                            return ".pptx"
-                        else:
-                            # 无法确定具体类型，但仍确认是Office文档
-                            return ".docx"  # 默认返回docx作为Office文档代表
-                    else:
-                        # 普通ZIP文件
-                        return ".zip"
-                except:
-                    # 如果分析失败，仍然返回ZIP
-                    return ".zip"
+                return ".zip"
             
             # 添加更多格式支持
             elif header.startswith(b'RIFF') and b'WEBP' in header[8:16]:
@@ -1430,33 +4304,22 @@ class PluginMain(Star):
                 logger.warning(f"[1.6.2] 文件头检测异常: {e}")        
                 
         # [v1.6.2] 第三层检测:文本文件检测
-        try:
-            is_text, encoding = self._is_text_file_safe(filepath)
-            if is_text:
-                if self.debug_mode:
-                    logger.info(f"[1.6.2] 检测到文本文件,编码: {encoding}")
-                return ".txt"
-        except Exception as e:
+        if encoding:
             if self.debug_mode:
-                logger.warning(f"[1.6.2] 文本文件检测异常: {e}")
+                logger.info(f"[1.6.2] 检测到文本文件,编码: {encoding}")
+            return ".txt"
         
         # [v1.6.2] 第四层检测:二进制文件判断
-        try:
-            with open(filepath, 'rb') as f:
-                sample = f.read(1024)
+        sample = header[:1024]
+        # 检查是否包含大量不可打印字符
+        if sample:
+            non_printable = sum(1 for byte in sample if byte < 32 and byte not in [9, 10, 13])
+            printable_ratio = 1 - (non_printable / len(sample))
             
-            # 检查是否包含大量不可打印字符
-            if sample:
-                non_printable = sum(1 for byte in sample if byte < 32 and byte not in [9, 10, 13])
-                printable_ratio = 1 - (non_printable / len(sample))
-                
-                if printable_ratio < 0.7:  # 如果可打印字符少于70%,认为是二进制文件
-                    if self.debug_mode:
-                        logger.info(f"[1.6.2] 检测到二进制文件,可打印字符比例: {printable_ratio:.2f}")
-                    return ".bin"
-        except Exception as e:
-            if self.debug_mode:
-                logger.warning(f"[1.6.2] 二进制文件检测异常: {e}")
+            if printable_ratio < 0.7:  # 如果可打印字符少于70%,认为是二进制文件
+                if self.debug_mode:
+                    logger.info(f"[1.6.2] 检测到二进制文件,可打印字符比例: {printable_ratio:.2f}")
+                return ".bin"
         
         # [v1.6.2] 第五层检测:默认返回策略
         # 如果前面都无法确定,优先返回.txt而不是.bin
@@ -1501,90 +4364,746 @@ class PluginMain(Star):
             logger.info(f"[1.6.2] 提取文件URL: {url[:100]}...")  # 只显示前100字符
         return url
     
-    async def _download_to_temp(self, url, temp_path):
-        """下载到临时文件"""
+    async def _get_http_session(self):
+        """获取插件共享的HTTP会话,首次使用时创建,复用连接和DNS缓存"""
+        if self._http_session is None or self._http_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.http_pool_limit,
+                limit_per_host=self.http_pool_limit_per_host,
+                keepalive_timeout=self.http_keepalive_timeout,
+                ttl_dns_cache=self.http_dns_cache_ttl,
+                use_dns_cache=True,
+            )
+            self._http_session = aiohttp.ClientSession(connector=connector)
+            if self.debug_mode:
+                logger.info(f"[1.6.2] HTTP连接池已创建: 总连接 {self.http_pool_limit}, 单主机 {self.http_pool_limit_per_host}")
+        return self._http_session
+    
+    def _download_timeout(self):
+        """下载超时:不限制总时长,只限制连接建立和单次读取的空闲时间"""
+        return aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=self.download_read_timeout)
+    
+    @staticmethod
+    def _parse_content_range_total(content_range):
+        """从Content-Range头中解析文件总大小"""
+        if not content_range or '/' not in content_range:
+            return None
+        total = content_range.rsplit('/', 1)[1].strip()
+        return int(total) if total.isdigit() else None
+    
+    @staticmethod
+    def _parse_content_range_start(content_range):
+        """从Content-Range头中解析本次响应的起始字节,无法解析时返回None"""
+        match = re.match(r'\s*bytes\s+(\d+)-\d+/', content_range or '')
+        return int(match.group(1)) if match else None
+    
+    @staticmethod
+    def _response_validator(headers):
+        """取出可用于If-Range的校验值:强ETag优先,其次Last-Modified,都没有时返回None"""
+        etag = headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return headers.get('Last-Modified') or None
+    
+    @staticmethod
+    def _load_download_validator(validator_file):
+        """读取单连接续传保存的校验值,不存在或损坏时返回None"""
+        try:
+            with open(validator_file, 'r', encoding='utf-8') as f:
+                validator = json.load(f).get('validator')
+            return validator if isinstance(validator, str) and validator else None
+        except (OSError, ValueError, AttributeError):
+            return None
+    
+    def _save_download_validator(self, validator_file, validator):
+        """保存校验值;服务器没有给出校验值时删除旁路文件,之后的残留将不会被续传"""
+        if not validator:
+            self._remove_file_quietly(validator_file)
+            return
+        tmp_file = validator_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'validator': validator}, f, ensure_ascii=False)
+        os.replace(tmp_file, validator_file)
+    
+    async def _probe_download(self, session, url):
+        """HEAD探测文件大小、服务器是否支持Range请求以及用于If-Range的校验值"""
+        try:
+            async with session.head(url, timeout=self._download_timeout(), allow_redirects=True) as response:
+                if response.status != 200:
+                    return None, False, None
+                accepts_ranges = 'bytes' in response.headers.get('Accept-Ranges', '').lower()
+                return response.content_length, accepts_ranges, self._response_validator(response.headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if self.debug_mode:
+                logger.info(f"[1.6.2] HEAD探测失败,按普通方式下载: {e}")
+            return None, False, None
+    
+    async def _with_retries(self, attempt, description):
+        """执行下载尝试,网络错误时按指数退避重试"""
+        retries = max(0, int(self.download_max_retries))
+        for attempt_no in range(retries + 1):
+            try:
+                return await attempt()
+            except (aiohttp.ClientError, asyncio.TimeoutError, DownloadRetryError) as e:
+                if attempt_no >= retries:
+                    logger.error(f"[1.6.2] {description}失败,已重试{retries}次: {e}")
+                    return False
+                delay = min(self.download_retry_backoff * (2 ** attempt_no), 60)
+                delay += random.uniform(0, delay / 2)
+                if self.debug_mode:
+                    logger.info(f"[1.6.2] {description}出错: {e},{delay:.1f}秒后第{attempt_no + 1}次重试")
+                await asyncio.sleep(delay)
+        return False
+    
+    @staticmethod
+    def _write_batch(f, data, hasher=None, sniffer=None):
+        """写入一批数据并同步更新哈希和类型识别缓冲,在I/O线程池中执行"""
+        f.write(data)
+        if hasher is not None:
+            hasher.update(data)
+        if sniffer is not None:
+            sniffer.feed(data)
+    
+    @staticmethod
+    def _hash_file(file_path, sniffer=None):
+        """计算已有文件内容的SHA-256,返回哈希对象以便继续追加;顺带收集文件开头供类型识别"""
+        hasher = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(block)
+                if sniffer is not None:
+                    sniffer.feed(block)
+        return hasher
+    
+    async def _stream_to_file(self, response, f, on_batch=None, max_bytes=None, offset=0, hasher=None, sniffer=None):
+        """把响应体写入已打开的文件,写盘在I/O线程池中按批进行,返回写入字节数
+
+        max_bytes为文件大小上限,offset为本次写入之前文件已有的字节数;
+        累计字节数一旦超过上限立即中止,超出部分不会写盘。
+        传入hasher/sniffer时随写盘一起计算内容哈希、收集文件开头。
+        """
+        written = 0
+        buffer = bytearray()
+        chunk_size = max(1, int(self.download_chunk_size_kb)) * 1024
+        batch_size = max(DOWNLOAD_WRITE_BATCH, chunk_size)
+        async for chunk in response.content.iter_chunked(chunk_size):
+            if max_bytes and offset + written + len(buffer) + len(chunk) > max_bytes:
+                raise DownloadSizeExceeded()
+            buffer.extend(chunk)
+            if len(buffer) >= batch_size:
+                await self._run_io(self._write_batch, f, bytes(buffer), hasher, sniffer)
+                written += len(buffer)
+                if on_batch:
+                    await on_batch(len(buffer))
+                buffer.clear()
+        if buffer:
+            await self._run_io(self._write_batch, f, bytes(buffer), hasher, sniffer)
+            written += len(buffer)
+            if on_batch:
+                await on_batch(len(buffer))
+        return written
+    
+    def _check_declared_size(self, response, offset, max_bytes):
+        """写入任何数据之前,根据响应头声明的大小检查是否超限"""
+        if not max_bytes:
+            return
+        total = self._parse_content_range_total(response.headers.get('Content-Range'))
+        if total is None and response.content_length is not None:
+            total = offset + response.content_length
+        if total is not None and total > max_bytes:
+            raise DownloadSizeExceeded(total)
+    
+    async def _download_single_attempt(self, session, url, temp_path, max_bytes=None, ctx=None):
+        """单连接下载,本地已有部分内容时用Range续传
+
+        续传时带上首次下载保存的校验值作为If-Range,服务器文件已变化时会返回200,
+        此时丢弃残留从头写入;没有保存校验值的残留无法确认是否过期,直接从头下载。
+        完整读到文件末尾时把边下载边计算的哈希对象放入ctx['hasher'],
+        收集到的文件开头放入ctx['sniffer']。
+        """
+        if ctx is not None:
+            ctx['hasher'] = None
+            ctx['sniffer'] = None
+        validator_file = temp_path + DOWNLOAD_VALIDATOR_SUFFIX
+        offset = await self._run_io(self._file_size_or_zero, temp_path)
+        validator = None
+        if offset:
+            validator = await self._run_io(self._load_download_validator, validator_file)
+            if validator is None:
+                if self.debug_mode:
+                    logger.info("[1.6.2] 残留的临时文件缺少校验值,从头下载")
+                await self._run_io(self._remove_file_quietly, temp_path)
+                offset = 0
+        headers = {'Range': f'bytes={offset}-', 'If-Range': validator} if offset else {}
+        async with session.get(url, headers=headers, timeout=self._download_timeout()) as response:
+            if response.status == 416 and offset:
+                total = self._parse_content_range_total(response.headers.get('Content-Range'))
+                if total == offset:
+                    return True
+                # 本地残留与服务器文件不一致,丢弃后从头下载
+                await self._run_io(self._remove_file_quietly, temp_path)
+                await self._run_io(self._remove_file_quietly, validator_file)
+                raise DownloadRetryError("续传位置无效")
+            if response.status == 206 and offset:
+                current = self._response_validator(response.headers)
+                if current and current != validator:
+                    # 服务器忽略了If-Range,但返回的校验值表明文件已变化
+                    await self._run_io(self._remove_file_quietly, temp_path)
+                    await self._run_io(self._remove_file_quietly, validator_file)
+                    raise DownloadRetryError("服务器文件已变化")
+                start = self._parse_content_range_start(response.headers.get('Content-Range'))
+                if start != offset:
+                    # 返回的区间与请求的续传位置不符,追加会损坏文件,丢弃后从头下载
+                    await self._run_io(self._remove_file_quietly, temp_path)
+                    await self._run_io(self._remove_file_quietly, validator_file)
+                    raise DownloadRetryError(f"续传位置不符: 请求 {offset},返回 {start}")
+                mode = 'ab'
+                if self.debug_mode:
+                    logger.info(f"[1.6.2] 从 {offset} 字节处续传")
+            elif response.status == 200:
+                if offset and self.debug_mode:
+                    logger.info("[1.6.2] 服务器文件已变化,丢弃已下载部分从头下载")
+                mode = 'wb'
+                offset = 0
+                # 先保存校验值再写入,中断后的残留才能在下次续传时校验
+                await self._run_io(
+                    self._save_download_validator, validator_file, self._response_validator(response.headers)
+                )
+            elif response.status >= 500 or response.status == 429:
+                raise DownloadRetryError(f"HTTP {response.status}")
+            else:
+                if self.debug_mode:
+                    logger.error(f"[1.6.2] 下载失败 HTTP {response.status}")
+                return False
+            
+            self._check_declared_size(response, offset, max_bytes)
+            expected = response.content_length
+            # 续传时先对已有部分计算哈希,之后随写盘继续累加
+            sniffer = HeadSniffer()
+            if mode == 'ab':
+                hasher = await self._run_io(self._hash_file, temp_path, sniffer)
+            else:
+                hasher = hashlib.sha256()
+            f = await self._run_io(open, temp_path, mode)
+            try:
+                written = await self._stream_to_file(
+                    response, f, max_bytes=max_bytes, offset=offset, hasher=hasher, sniffer=sniffer
+                )
+            finally:
+                await self._run_io(f.close)
+            if expected is not None and written < expected:
+                raise DownloadRetryError(f"连接中断,已接收 {written}/{expected} 字节")
+            if ctx is not None:
+                ctx['hasher'] = hasher
+                ctx['sniffer'] = sniffer
+            return True
+    
+    def _plan_segments(self, total_size, validator):
+        """把文件按字节区间均分为若干段,每段记录[起点, 终点, 已完成字节数]"""
+        count = max(1, int(self.download_parallel_segments))
+        segment_size = -(-total_size // count)
+        segments = []
+        for start in range(0, total_size, segment_size):
+            segments.append([start, min(start + segment_size, total_size) - 1, 0])
+        return {'size': total_size, 'validator': validator, 'segments': segments}
+    
+    @staticmethod
+    def _segment_state_valid(state, temp_size):
+        """检查分段进度与临时文件是否一致:需有校验值,临时文件不短于声明的大小,各段进度不越界"""
+        size, segments = state.get('size'), state.get('segments')
+        if not isinstance(size, int) or not isinstance(segments, list) or not state.get('validator'):
+            return False
+        if temp_size is None or temp_size < size:
+            return False
+        for segment in segments:
+            if not (isinstance(segment, list) and len(segment) == 3 and all(isinstance(v, int) for v in segment)):
+                return False
+            start, end, done = segment
+            if start < 0 or end >= size or not 0 <= done <= end - start + 1:
+                return False
+        return True
+    
+    def _load_segment_state(self, segments_file, temp_path):
+        """读取分段下载进度,不存在时返回None
+
+        进度文件损坏、缺少校验值,或对应的临时文件不存在、比进度声明的短时,
+        进度已不可信,连同临时文件一起删除后返回None。
+        """
+        try:
+            with open(segments_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            try:
+                temp_size = os.path.getsize(temp_path)
+            except OSError:
+                temp_size = None
+            if isinstance(state, dict) and self._segment_state_valid(state, temp_size):
+                return state
+            logger.warning("[1.6.2] 分段下载进度与临时文件不一致,重新下载")
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"[1.6.2] 分段下载进度文件损坏,重新下载: {e}")
+        self._remove_file_quietly(segments_file)
+        self._remove_file_quietly(temp_path)
+        return None
+    
+    def _save_segment_state(self, segments_file, payload):
+        """原子地保存分段下载进度"""
+        with self._segment_state_lock:
+            tmp_file = segments_file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(payload)
+            os.replace(tmp_file, segments_file)
+    
+    def _prepare_segment_file(self, temp_path, total_size):
+        """创建分段下载的目标文件并设置为最终大小"""
+        mode = 'r+b' if os.path.exists(temp_path) else 'wb'
+        with open(temp_path, mode) as f:
+            f.truncate(total_size)
+    
+    @staticmethod
+    def _file_size_or_zero(file_path):
+        try:
+            return os.path.getsize(file_path)
+        except OSError:
+            return 0
+    
+    async def _download_segment_attempt(self, session, url, temp_path, segments_file, state, segment):
+        """下载一个分段中尚未完成的部分"""
+        start, end, done = segment
+        length = end - start + 1
+        if done >= length:
+            return True
+        # 服务器文件已变化时If-Range不匹配,服务器返回200,整体回退为从头下载
+        headers = {'Range': f'bytes={start + done}-{end}', 'If-Range': state['validator']}
+        async with session.get(url, headers=headers, timeout=self._download_timeout()) as response:
+            if response.status >= 500 or response.status == 429:
+                raise DownloadRetryError(f"HTTP {response.status}")
+            if response.status != 206:
+                if self.debug_mode:
+                    logger.info(f"[1.6.2] 服务器未按Range返回分段(HTTP {response.status})")
+                return False
+            current = self._response_validator(response.headers)
+            if current and current != state['validator']:
+                if self.debug_mode:
+                    logger.info("[1.6.2] 服务器文件已变化,放弃已下载的分段")
+                return False
+            if self._parse_content_range_start(response.headers.get('Content-Range')) != start + done:
+                if self.debug_mode:
+                    logger.info(f"[1.6.2] 服务器返回的区间与请求不符: {response.headers.get('Content-Range')}")
+                return False
+            
+            async def on_batch(size):
+                segment[2] += size
+                await self._run_io(self._save_segment_state, segments_file, json.dumps(state))
+            
+            f = await self._run_io(open, temp_path, 'r+b')
+            try:
+                await self._run_io(f.seek, start + segment[2])
+                # 写入不超过本段剩余长度,过长的响应不会覆盖下一段
+                await self._stream_to_file(response, f, on_batch, max_bytes=length, offset=done)
+            except DownloadSizeExceeded:
+                if self.debug_mode:
+                    logger.info(f"[1.6.2] 分段 {start}-{end} 的响应超出分段长度")
+                return False
+            finally:
+                await self._run_io(f.close)
+            if segment[2] < length:
+                raise DownloadRetryError(f"分段中断,已接收 {segment[2]}/{length} 字节")
+            return True
+    
+    async def _download_segmented(self, session, url, temp_path, segments_file, state):
+        """多段并行下载,各段独立重试,进度写入旁路文件以便重启后续传"""
+        await self._run_io(self._prepare_segment_file, temp_path, state['size'])
+        await self._run_io(self._save_segment_state, segments_file, json.dumps(state))
+        
+        async def fetch(segment):
+            return await self._with_retries(
+                lambda: self._download_segment_attempt(session, url, temp_path, segments_file, state, segment),
+                f"分段 {segment[0]}-{segment[1]} 下载"
+            )
+        
+        results = await asyncio.gather(*(fetch(segment) for segment in state['segments']))
+        if all(results):
+            await self._run_io(self._remove_file_quietly, segments_file)
+            return True
+        return False
+    
+    async def _download_to_temp(self, url, temp_path, max_bytes=None):
+        """下载到临时文件
+
+        支持失败重试(指数退避)、基于Range的断点续传;服务器声明支持Range且文件较大时
+        按配置分段并行下载。下载失败时保留已下载的部分,同一文件再次发送时继续下载。
+        设置max_bytes时,先按HEAD/响应头的大小检查,下载中累计字节超限立即中止,
+        并抛出DownloadSizeExceeded。
+        成功时返回{'sha256': 内容哈希, 'size': 字节数, 'sniff': 类型识别结果},失败时返回None。
+        """
         try:
             if self.debug_mode:
                 logger.info(f"[1.6.2] 开始下载: {url[:100]}...")  # 只显示前100字符
             
-            timeout = aiohttp.ClientTimeout(total=120)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        with open(temp_path, 'wb') as f:
-                            async for chunk in response.content.iter_chunked(8192):
-                                f.write(chunk)
-                        if self.debug_mode:
-                            logger.info(f"[1.6.2] 下载成功: {temp_path}")
-                        return True
-                    else:
-                        if self.debug_mode:
-                            logger.error(f"[1.6.2] 下载失败 HTTP {response.status}")
-                        return False
-                        
+            session = await self._get_http_session()
+            segments_file = temp_path + DOWNLOAD_SEGMENTS_SUFFIX
+            validator_file = temp_path + DOWNLOAD_VALIDATOR_SUFFIX
+            ctx = {'hasher': None, 'sniffer': None}
+            
+            state = await self._run_io(self._load_segment_state, segments_file, temp_path)
+            if state is None and self.download_parallel_segments > 1:
+                if not await self._run_io(os.path.exists, temp_path):
+                    total_size, accepts_ranges, validator = await self._probe_download(session, url)
+                    if max_bytes and total_size and total_size > max_bytes:
+                        raise DownloadSizeExceeded(total_size)
+                    min_size = self.download_parallel_min_size_mb * 1024 * 1024
+                    # 没有校验值时无法确认各段来自同一版本的文件,不分段
+                    if accepts_ranges and validator and total_size and total_size >= min_size:
+                        state = self._plan_segments(total_size, validator)
+            
+            if state is not None:
+                if max_bytes and state['size'] > max_bytes:
+                    raise DownloadSizeExceeded(state['size'])
+                if self.debug_mode:
+                    logger.info(f"[1.6.2] 分段并行下载: {state['size']} bytes, {len(state['segments'])} 段")
+                if await self._download_segmented(session, url, temp_path, segments_file, state):
+                    success = True
+                else:
+                    # 分段失败时回退为单连接下载
+                    await self._run_io(self._remove_file_quietly, segments_file)
+                    await self._run_io(self._remove_file_quietly, temp_path)
+                    success = await self._with_retries(
+                        lambda: self._download_single_attempt(session, url, temp_path, max_bytes, ctx), "下载"
+                    )
+            else:
+                success = await self._with_retries(
+                    lambda: self._download_single_attempt(session, url, temp_path, max_bytes, ctx), "下载"
+                )
+            
+            if not success:
+                return None
+            await self._run_io(self._remove_file_quietly, validator_file)
+            
+            # 分段下载或续传判定已完成时没有流式哈希,下载后补算
+            hasher, sniffer = ctx['hasher'], ctx['sniffer']
+            if hasher is None:
+                sniffer = HeadSniffer()
+                hasher = await self._run_io(self._hash_file, temp_path, sniffer)
+            sniff = await self._run_io(self._sniff_head, sniffer.head, sniffer.whole_file)
+            if sniff['file_type'] in ZIP_CONTAINER_TYPES:
+                # ZIP容器的中央目录可能很大,在分析进程池中解析
+                try:
+                    container_type = await self.analysis_pool.run('sniff', detect_zip_container, temp_path)
+                    if container_type:
+                        sniff['file_type'] = container_type
+                except Exception as e:
+                    logger.warning(f"[1.6.2] 识别ZIP容器类型失败: {e}")
+            if self.debug_mode:
+                logger.info(f"[1.6.2] 下载成功: {temp_path}, 识别结果: {sniff}")
+            return {
+                'sha256': hasher.hexdigest(),
+                'size': await self._run_io(os.path.getsize, temp_path),
+                'sniff': sniff
+            }
+        
+        except DownloadSizeExceeded:
+            raise
         except Exception as e:
             if self.debug_mode:
                 logger.error(f"[1.6.2] 下载出错: {e}")
-            return False
+            return None
     
     async def _cleanup_task(self):
-        """自动清理任务"""
+        """自动清理任务
+
+        按最早一条记录的到期时间(接收时间 + 保留天数)休眠,到期后在I/O线程池中分批删除,
+        没有到期记录时不做任何文件操作。
+        """
         while True:
             try:
-                if self.auto_cleanup_enabled:
-                    await asyncio.sleep(3600)
-                    self._cleanup_expired_files()
+                ttl = self.cleanup_days * 24 * 3600
+                earliest = await self._run_io(self.store.earliest_receive_time)
+                delay = CLEANUP_MAX_SLEEP if earliest is None else earliest + ttl - time.time()
+                if delay > 0:
+                    self._cleanup_wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._cleanup_wakeup.wait(), min(delay, CLEANUP_MAX_SLEEP))
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                
+                expired_count, removed_count = await self._cleanup_expired_files(CLEANUP_BATCH_SIZE)
+                if expired_count and not removed_count:
+                    # 这一批全部删除失败,稍后重试,避免空转
+                    await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 logger.error(f"[1.6.2] 清理任务出错: {e}")
                 await asyncio.sleep(60)
     
-    def _cleanup_expired_files(self):
-        """清理过期文件"""
+    async def _cleanup_expired_files(self, batch_size=CLEANUP_BATCH_SIZE):
+        """清理一批过期文件,按用户/群分组并持有对应的记录变更锁,返回(到期记录数, 成功删除数)"""
+        cutoff_time = time.time() - self.cleanup_days * 24 * 3600
+        expired_records = await self._run_io(self.store.list_records_before, cutoff_time, batch_size)
+        if not expired_records:
+            return 0, 0
+        
+        by_entity = defaultdict(list)
+        for record in expired_records:
+            by_entity[(record.get('type') or 'user', record.get('identifier') or '')].append(record)
+        removed_count = 0
+        for (entity_type, entity_id), records in by_entity.items():
+            async with self._entity_lock(entity_type, entity_id):
+                removed_count += await self._run_io(self._discard_records, records)
+        
+        if self.debug_mode:
+            logger.info(f"[1.6.2] 共清理了 {removed_count} 个过期文件")
+        return len(expired_records), removed_count
+    
+    def _discard_records(self, records):
+        """逐条删除记录及其文件,返回成功删除数;删除失败的记录保留到下次清理"""
+        removed_count = 0
+        for record in records:
+            try:
+                if self._discard_record(record):
+                    removed_count += 1
+                    if self.debug_mode and record.get('file_path'):
+                        logger.info(f"[1.6.2] 已删除过期文件: {record.get('file_path')}")
+            except Exception as e:
+                logger.error(f"[1.6.2] 删除文件出错: {e}")
+        return removed_count
+    
+    async def _reconcile_task(self):
+        """定期对账存储目录与记录库并生成记录库快照,启动1分钟后执行第一次"""
+        await asyncio.sleep(60)
+        while True:
+            try:
+                await self._reconcile_storage()
+                await self._run_io(self._snapshot_records)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[1.6.2] 存储对账出错: {e}")
+            await asyncio.sleep(max(0.1, self.reconcile_interval_hours) * 3600)
+    
+    async def _reconcile_storage(self):
+        """对账存储目录与记录库,逐个用户/群目录在I/O线程池中执行,返回汇总结果
+
+        修复两个方向的不一致:磁盘上没有记录的文件移入.orphans隔离,记录指向的文件缺失时
+        从文件块重新链接或删除记录;回收长时间未完成的临时文件;校正文件块引用计数。
+        """
+        started = time.time()
+        totals = defaultdict(int)
+        # 记录库刚从快照恢复时,快照之后接收的文件重新登记,不当作孤立文件删除
+        adopt_orphans = self.store.adopt_orphans_pending
+        entity_dirs = await self._run_io(self._list_entity_dirs)
+        for entity_type, entity_id, storage_dir in entity_dirs:
+            async with self._entity_lock(entity_type, entity_id):
+                result = await self._run_io(self._reconcile_entity_dir, entity_type, entity_id, storage_dir, adopt_orphans)
+            for key, value in result.items():
+                totals[key] += value
+        for key, value in (await self._run_io(self._reconcile_blobs)).items():
+            totals[key] += value
+        # 修复后按记录重新统计各用户/群用量
+        await self._run_io(self.store.reset_usage)
+        self.store.restored_from_snapshot = False
+        self.store.adopt_orphans_pending = False
+        
+        self.reconcile_stats = dict(totals, entities=len(entity_dirs), time=started, duration=time.time() - started)
+        if self.debug_mode or any(v for k, v in totals.items() if k not in ('temp_bytes',)):
+            logger.info(f"[1.6.2] 存储对账完成: {dict(totals)}")
+        return self.reconcile_stats
+    
+    def _list_entity_dirs(self):
+        """用os.scandir列出存储根目录下的用户/群目录,返回[(类型, ID, 路径)]"""
+        entity_dirs = []
+        with os.scandir(self.storage_path) as it:
+            for entry in it:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                for entity_type in ('user', 'group'):
+                    prefix = f"{entity_type}_"
+                    if entry.name.startswith(prefix):
+                        entity_dirs.append((entity_type, entry.name[len(prefix):], entry.path))
+        return entity_dirs
+    
+    def _reconcile_entity_dir(self, entity_type, entity_id, storage_dir, adopt_orphans=False):
+        """对账一个用户/群目录,返回各类修复的数量
+
+        没有记录的文件在adopt_orphans为True时补登记录,否则移入.orphans隔离;
+        目录中还有未迁移的旧版记录文件时,文件的记录尚未导入,不处理没有记录的文件。
+        """
+        result = defaultdict(int)
+        now = time.time()
+        temp_max_age = self.reconcile_temp_max_age_hours * 3600
+        records = self.store.list_records(entity_type, entity_id, status=None)
+        known_paths = {r.get('file_path') for r in records if r.get('file_path')}
+        legacy_pending = os.path.isfile(os.path.join(storage_dir, LEGACY_RECORD_FILE))
+        if legacy_pending:
+            result['legacy_pending_dirs'] += 1
+        
+        # 磁盘 -> 记录:孤立文件与残留的临时文件
+        with os.scandir(storage_dir) as it:
+            entries = [entry for entry in it if not entry.name.startswith('.') and entry.is_file(follow_symlinks=False)]
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if entry.name.startswith('temp_file_'):
+                base_path = entry.path.split(DOWNLOAD_SEGMENTS_SUFFIX)[0].split(DOWNLOAD_VALIDATOR_SUFFIX)[0]
+                if base_path in self._active_temp_paths or now - st.st_mtime < temp_max_age:
+                    result['temp_bytes'] += st.st_size
+                elif self._remove_file_quietly(entry.path):
+                    result['stale_temps'] += 1
+                    result['reclaimed_bytes'] += st.st_size
+                continue
+            # 建立硬链接会更新ctime,刚链接的旧文件块也不会被误判
+            if (legacy_pending or entry.path in known_paths
+                    or now - max(st.st_mtime, st.st_ctime) < RECONCILE_GRACE_SECONDS):
+                continue
+            if adopt_orphans:
+                try:
+                    self._adopt_orphan_file(entity_type, entity_id, entry.path, st)
+                    result['adopted_files'] += 1
+                except Exception as e:
+                    logger.error(f"[1.6.2] 补登文件记录出错: {entry.path}: {e}")
+                continue
+            with self._storage_lock:
+                quarantined = self._quarantine_orphan_file(storage_dir, entry)
+            if quarantined:
+                result['orphan_files'] += 1
+                result['quarantined_bytes'] += st.st_size
+                logger.warning(f"[1.6.2] 没有记录的文件已移入隔离目录: {entry.path} -> {quarantined}")
+        
+        # 记录 -> 磁盘:文件缺失时从文件块恢复,无法恢复则删除记录;过时的失败记录一并删除
+        failed_ids = []
+        for record in records:
+            file_path = record.get('file_path')
+            if record.get('download_status') != 'success':
+                if now - float(record.get('receive_time') or 0) >= temp_max_age:
+                    failed_ids.append(record['id'])
+                continue
+            if not file_path or os.path.exists(file_path):
+                continue
+            sha256 = record.get('sha256')
+            blob_path = self._blob_path(sha256) if sha256 else None
+            with self._storage_lock:
+                relinked = (blob_path and os.path.exists(blob_path) and os.path.isdir(os.path.dirname(file_path))
+                            and self._link_blob(blob_path, file_path) == file_path)
+            if relinked:
+                result['relinked'] += 1
+                continue
+            try:
+                if self._discard_record(record):
+                    result['missing_records'] += 1
+            except Exception as e:
+                logger.error(f"[1.6.2] 释放缺失文件的记录出错: {e}")
+        if failed_ids:
+            self.store.delete_records(failed_ids)
+            result['failed_records'] += len(failed_ids)
+        return result
+    
+    def _quarantine_orphan_file(self, storage_dir, entry):
+        """把没有记录的文件移入用户/群目录下的.orphans,重名时追加序号,返回新路径;失败时返回None"""
+        orphan_dir = os.path.join(storage_dir, ORPHAN_DIR)
         try:
-            if not os.path.exists(self.storage_path):
-                return
-                
-            for item in os.listdir(self.storage_path):
-                item_path = os.path.join(self.storage_path, item)
-                if os.path.isdir(item_path):
-                    record_file = os.path.join(item_path, '.file_records.json')
-                    if not os.path.exists(record_file):
+            os.makedirs(orphan_dir, exist_ok=True)
+            target = os.path.join(orphan_dir, entry.name)
+            name, ext = os.path.splitext(entry.name)
+            counter = 1
+            while os.path.exists(target):
+                target = os.path.join(orphan_dir, f"{name}_{counter}{ext}")
+                counter += 1
+            os.rename(entry.path, target)
+            return target
+        except OSError as e:
+            logger.error(f"[1.6.2] 隔离没有记录的文件出错: {entry.path}: {e}")
+            return None
+    
+    def _adopt_orphan_file(self, entity_type, entity_id, file_path, st):
+        """为没有记录的文件补登记录,文件内容并入按哈希寻址的文件块"""
+        sniff = self._sniff_file(file_path)
+        sha256 = self._hash_file(file_path).hexdigest()
+        blob_path = self._blob_path(sha256)
+        filename = os.path.basename(file_path)
+        with self._storage_lock:
+            if not os.path.exists(blob_path):
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                try:
+                    os.link(file_path, blob_path)
+                except OSError:
+                    shutil.copyfile(file_path, blob_path)
+            self.store.acquire_blob(sha256, st.st_size)
+            self.store.add_record({
+                'identifier': entity_id,
+                'type': entity_type,
+                'original_name': filename,
+                'final_filename': filename,
+                'file_path': file_path,
+                'file_size': st.st_size,
+                'file_type': sniff['file_type'],
+                'receive_time': st.st_mtime,
+                'sender': 'unknown',
+                'platform': 'unknown',
+                'download_status': 'success',
+                'sha256': sha256,
+                'text_encoding': sniff['encoding'],
+            })
+        if self.debug_mode:
+            logger.info(f"[1.6.2] 已为没有记录的文件补登记录: {file_path}")
+    
+    def _snapshot_records(self):
+        """把WAL写回主库并生成记录库快照,在I/O线程池中执行"""
+        pages = self.store.checkpoint()
+        self.store.snapshot()
+        self.snapshot_time = time.time()
+        if self.debug_mode:
+            logger.info(f"[1.6.2] 记录库快照已更新,写回 {pages} 页")
+    
+    def _reconcile_blobs(self):
+        """校正文件块引用计数,删除没有引用的文件块、缓存和残留的临时文件"""
+        result = defaultdict(int)
+        blob_root = os.path.join(self.storage_path, BLOB_DIR)
+        now = time.time()
+        with self._storage_lock:
+            stored, referenced = self.store.blob_reference_counts()
+            for sha256 in set(stored) | set(referenced):
+                expected = referenced.get(sha256, 0) + self._pending_blob_refs.get(sha256, 0)
+                if stored.get(sha256, 0) == expected:
+                    continue
+                blob_path = self._blob_path(sha256)
+                if sha256 not in stored:
+                    if not os.path.exists(blob_path):
                         continue
-                    
-                    with open(record_file, 'r', encoding='utf-8') as f:
+                    self.store.acquire_blob(sha256, os.path.getsize(blob_path))
+                self.store.set_blob_ref_count(sha256, expected)
+                result['blob_refs_fixed'] += 1
+                if expected == 0:
+                    self._remove_file_quietly(blob_path)
+                    self._remove_file_quietly(blob_path + EXTRACTED_TEXT_SUFFIX)
+            live_blobs = {sha256 for sha256 in set(stored) | set(referenced)
+                          if referenced.get(sha256, 0) + self._pending_blob_refs.get(sha256, 0) > 0}
+        
+        if not os.path.isdir(blob_root):
+            return result
+        with os.scandir(blob_root) as shards:
+            shard_paths = [entry.path for entry in shards if entry.is_dir(follow_symlinks=False)]
+        for shard_path in shard_paths:
+            with self._storage_lock:
+                with os.scandir(shard_path) as it:
+                    for entry in it:
+                        sha256 = entry.name.split('.', 1)[0]
+                        if sha256 in live_blobs or sha256 in self._pending_blob_refs:
+                            continue
                         try:
-                            records = json.load(f)
-                        except:
-                            records = []
-                    
-                    current_time = time.time()
-                    expired_records = []
-                    valid_records = []
-                    
-                    for record in records:
-                        receive_time = record.get('receive_time', 0)
-                        file_path = record.get('file_path', '')
-                        
-                        if current_time - receive_time > self.cleanup_days * 24 * 3600:
-                            expired_records.append(record)
-                            if file_path and os.path.exists(file_path):
-                                try:
-                                    os.remove(file_path)
-                                    if self.debug_mode:
-                                        logger.info(f"[1.6.2] 已删除过期文件: {file_path}")
-                                except Exception as e:
-                                    logger.error(f"[1.6.2] 删除文件出错: {e}")
-                        else:
-                            valid_records.append(record)
-                    
-                    with open(record_file, 'w', encoding='utf-8') as f:
-                        json.dump(valid_records, f, ensure_ascii=False, indent=2)
-                    
-                    if expired_records and self.debug_mode:
-                        logger.info(f"[1.6.2] 目录 {item} 清理了 {len(expired_records)} 个过期文件")
-                        
-        except Exception as e:
-            logger.error(f"[1.6.2] 清理过期文件出错: {e}")
+                            st = entry.stat(follow_symlinks=False)
+                        except FileNotFoundError:
+                            continue
+                        if now - max(st.st_mtime, st.st_ctime) < RECONCILE_GRACE_SECONDS:
+                            continue
+                        if self._remove_file_quietly(entry.path):
+                            result['orphan_blobs'] += 1
+                            result['reclaimed_bytes'] += st.st_size
+        return result
     
     def _ensure_unique_filename(self, filepath):
         """确保文件名唯一"""
@@ -1618,21 +5137,11 @@ class PluginMain(Star):
         
         return filename if filename else 'unnamed_file.bin'
     
-    async def _save_record(self, record_file, record_info):
+    async def _save_record(self, record_info):
         """保存记录"""
         try:
-            records = []
-            if os.path.exists(record_file):
-                with open(record_file, 'r', encoding='utf-8') as f:
-                    try:
-                        records = json.load(f)
-                    except:
-                        records = []
-            
-            records.append(record_info)
-            
-            with open(record_file, 'w', encoding='utf-8') as f:
-                json.dump(records, f, ensure_ascii=False, indent=2)
+            record_info['id'] = await self._run_io(self.store.add_record, record_info)
+            self._cleanup_wakeup.set()
                 
             if self.debug_mode:
                 logger.info(f"[1.6.2] 记录已保存")
@@ -1648,72 +5157,181 @@ class PluginMain(Star):
 自动清理: {'✅ 启用' if self.auto_cleanup_enabled else '❌ 禁用'}
 清理天数: {self.cleanup_days}天
 完成消息: {'✅ 启用' if self.send_completion_message else '❌ 禁用'}
-私聊文件限制: {self.max_files_per_user}个/用户
-群聊文件限制: {self.max_files_per_group}个/群
+私聊文件限制: {self.max_files_per_user}个/用户, {self._format_quota(self.max_storage_mb_per_user)}
+群聊文件限制: {self.max_files_per_group}个/群, {self._format_quota(self.max_storage_mb_per_group)}
+总存储上限: {self._format_quota(self.max_storage_mb_total)}, 淘汰策略: {EVICTION_POLICY_NAMES.get(self.eviction_policy, self.eviction_policy)}
 文件大小限制: {self.max_file_size_mb}MB
 群聊白名单: {'全部群' if not self.group_whitelist else self.group_whitelist}
 自动接收群文件: {'✅ 启用' if self.auto_receive_group_files else '❌ 禁用'}
 接收超时时间: {self.group_file_receive_timeout}秒
 LLM工具支持: {'✅ 启用' if LLM_TOOL_SUPPORT else '❌ 禁用'}
 调试模式: {'✅ 开启' if self.debug_mode else '❌ 关闭'}"""
-
-    def _is_text_file(self, file_path: str) -> bool:
-        """检查是否为文本文件"""
-        text_extensions = {
-            ".txt", ".py", ".c", ".cpp", ".h", ".java", ".js", ".html", 
-            ".css", ".xml", ".json", ".yaml", ".yml", ".md", ".log", ".csv"
-        }
         
-        _, ext = os.path.splitext(file_path.lower())
-        return ext in text_extensions
-
-    def _is_text_file_safe(self, filepath):
-        """安全地检测是否为文本文件"""
-        import os
+        cache_stats = self.store.cache.stats()
+        status_msg += f"""
+记录缓存: {cache_stats['entries']}/{cache_stats['max_entries']} 个目录
+缓存命中: {cache_stats['hits']} 次, 未命中: {cache_stats['misses']} 次
+缓存淘汰: {cache_stats['evictions']} 次, 失效: {cache_stats['invalidations']} 次"""
         
-        # 检查文件是否存在
-        if not os.path.exists(filepath):
-            return False, None
+        io_stats = self.io_executor.stats()
+        status_msg += f"""
+I/O线程池: {io_stats['workers']} 线程, 执行中 {io_stats['active']}, 排队 {io_stats['queued']}/{io_stats['max_pending']} (峰值 {io_stats['peak_queued']})
+I/O任务: 已完成 {io_stats['completed']}, 失败 {io_stats['failed']}
+记录变更锁: {len(self._entity_locks)} 个用户/群正在使用"""
         
-        encodings = ['utf-8', 'gbk', 'gb2312', 'latin1']
+        dl_stats = self.download_scheduler.stats()
+        status_msg += f"""
+下载并发: 进行中 {dl_stats['in_flight']}/{dl_stats['max_concurrent']} (单用户/群上限 {dl_stats['per_entity_limit']})
+下载队列: 排队 {dl_stats['queued']}/{dl_stats['max_queued']} (峰值 {dl_stats['peak_queued']}), 等待中的用户/群 {dl_stats['waiting_entities']}
+下载任务: 已完成 {dl_stats['completed']}, 出错 {dl_stats['failed']}"""
         
-        for encoding in encodings:
-            try:
-                with open(filepath, 'r', encoding=encoding) as f:
-                    # 读取前几KB来检测
-                    sample = f.read(4096)
-                    # 检查是否包含过多的控制字符
-                    if sample:  # 确保sample不为空
-                        control_chars = sum(1 for c in sample if ord(c) < 32 and c not in '\t\n\r')
-                        if control_chars / len(sample) > 0.3:
-                            continue  # 控制字符过多,可能不是文本文件
-                    return True, encoding
-            except UnicodeDecodeError:
-                continue
-            except Exception:
-                continue
+        blob_stats = await self._run_io(self.store.blob_stats)
+        saved_bytes = blob_stats['referenced_bytes'] - blob_stats['stored_bytes']
+        status_msg += f"""
+去重存储: {blob_stats['blobs']} 个文件块, 实际占用 {self._format_file_size(blob_stats['stored_bytes'])}, 去重节省 {self._format_file_size(saved_bytes)}"""
+        
+        usage = await self._run_io(self.store.usage_snapshot)
+        total_files = sum(u['files'] for u in usage.values())
+        total_bytes = sum(u['bytes'] for u in usage.values())
+        status_msg += f"""
+存储用量: {len(usage)} 个用户/群, {total_files} 个文件, 共 {self._format_file_size(total_bytes)}"""
+        if self.snapshot_time:
+            status_msg += f"""
+记录库快照: {time.strftime('%m-%d %H:%M', time.localtime(self.snapshot_time))}"""
+        if self.store.restored_from_snapshot:
+            status_msg += """
+⚠️ 记录库已从快照恢复,下次对账时补登快照之后接收的文件"""
+        elif self.store.adopt_orphans_pending:
+            status_msg += """
+⚠️ 记录库为新建,下次对账时为已有文件补登记录"""
+        if self._reserved_total or self._reserved:
+            status_msg += f"""
+下载中预留: {sum(r[0] for r in self._reserved.values())} 个文件, {self._format_file_size(self._reserved_total)}"""
+        top_usage = sorted(usage.items(), key=lambda item: item[1]['bytes'], reverse=True)[:3]
+        if top_usage:
+            status_msg += "\n  占用最多: " + ", ".join(
+                f"{key} {self._format_file_size(u['bytes'])}" for key, u in top_usage
+            )
+        if self.reconcile_stats:
+            rs = self.reconcile_stats
+            status_msg += f"""
+最近对账: {time.strftime('%m-%d %H:%M', time.localtime(rs['time']))}, 耗时 {rs['duration']:.1f}秒, 检查 {rs['entities']} 个目录
+  孤立文件 {rs.get('orphan_files', 0)} (已隔离 {self._format_file_size(rs.get('quarantined_bytes', 0))}, 补登 {rs.get('adopted_files', 0)}, 待迁移目录 {rs.get('legacy_pending_dirs', 0)}), 孤立文件块 {rs.get('orphan_blobs', 0)}, 残留临时文件 {rs.get('stale_temps', 0)}, 缺失文件 {rs.get('missing_records', 0)} (恢复 {rs.get('relinked', 0)}), 失败记录 {rs.get('failed_records', 0)}, 引用计数修正 {rs.get('blob_refs_fixed', 0)}, 回收 {self._format_file_size(rs.get('reclaimed_bytes', 0))}"""
+        
+        id_hits = self.file_id_stats['hits']
+        id_lookups = sum(self.file_id_stats.values())
+        hit_rate = f"{id_hits / id_lookups:.1%}" if id_lookups else "-"
+        status_msg += f"""
+文件ID复用: 命中 {id_hits} 次 / 查询 {id_lookups} 次 (命中率 {hit_rate}), 失效 {self.file_id_stats['stale']} 次, 超过大小限制 {self.file_id_stats['oversize']} 次"""
         
-        return False, None
+        status_msg += f"""
+文档文本提取: 提取 {self.extract_stats['extracted']} 次, 缓存命中 {self.extract_stats['hits']} 次, 失败 {self.extract_stats['failed']} 次"""
+        
+        stage_names = {'sniff': '容器识别', 'extract': '文本提取', 'archive_index': '压缩包索引'}
+        for stage, stats in self.analysis_pool.stats().items():
+            status_msg += f"""
+分析进程池[{stage_names.get(stage, stage)}]: {stats['count']} 次, 平均 {stats['avg_ms']:.0f}ms, 失败 {stats['failed']} / 超时 {stats['timeouts']} / 崩溃 {stats['crashes']}
+  耗时分布: {self.analysis_pool.format_histogram(stats['buckets'])}"""
+        if self.analysis_pool.recycles:
+            status_msg += f"""
+分析进程池已重建 {self.analysis_pool.recycles} 次"""
+        
+        await event.send(event.plain_result(status_msg))
 
-    def _read_text_file_safely(self, file_path: str) -> str:
-        """安全地读取文本文件内容"""
-        encodings = ["utf-8", "gbk", "gb2312", "latin1"]
+    @staticmethod
+    def _detect_text_encoding(head, whole_file=False):
+        """对文件开头的字节样本做一次编码识别,返回编码名,不是文本时返回None
+
+        依次检查BOM、UTF-8合法性和GB18030(兼容GBK/GB2312)中文特征,都不符合时按latin1处理;
+        whole_file为False时允许样本末尾截断在多字节字符中间。
+        """
+        for bom, encoding in TEXT_BOMS:
+            if head.startswith(bom):
+                return encoding
+        if not head:
+            return 'utf-8'
         
-        for encoding in encodings:
-            try:
-                with open(file_path, "r", encoding=encoding) as f:
-                    content = f.read()
-                    # 限制内容长度以避免过长消息
-                    if len(content) > self.max_auto_read_size:
-                        content = content[:self.max_auto_read_size] + "\n[内容已截断,原文过长]"
-                    return content
-            except UnicodeDecodeError:
-                continue
-            except Exception as e:
-                logger.error(f"[AutoRead] 读取文件时出错: {e}")
-                return ""
+        # 控制字符过多,不是文本文件(多字节编码的字节都不小于0x80,按字节统计即可)
+        control_chars = sum(1 for byte in head if byte < 32 and byte not in (9, 10, 13))
+        if control_chars / len(head) > 0.3:
+            return None
+        
+        try:
+            codecs.getincrementaldecoder('utf-8')().decode(head, final=whole_file)
+            return 'utf-8'
+        except UnicodeDecodeError:
+            pass
         
-        logger.warning(f"[AutoRead] 无法解码文件: {file_path}")
-        return ""
+        # 能按GB18030解码且非ASCII字符绝大多数是汉字和中文标点时才视为中文编码
+        try:
+            text = codecs.getincrementaldecoder('gb18030')().decode(head, final=whole_file)
+            non_ascii = [c for c in text if ord(c) >= 0x80]
+            chinese = sum(
+                1 for c in non_ascii
+                if '\u4e00' <= c <= '\u9fff' or '\u3000' <= c <= '\u303f' or '\uff00' <= c <= '\uffef'
+            )
+            if non_ascii and chinese / len(non_ascii) >= 0.8:
+                return 'gb18030'
+        except UnicodeDecodeError:
+            pass
+        return 'latin1'
+
+    def _read_text_range(self, file_path, encoding, offset, length):
+        """从第offset个字符起读取最多length个字符,返回(文本, 之后是否还有内容);无法读取时文本为None
+
+        跳过的部分按块解码后丢弃,不会把整个文件读入内存。
+        """
+        try:
+            if not encoding:
+                head, whole_file = self._read_file_head(file_path)
+                encoding = self._detect_text_encoding(head, whole_file)
+            if not encoding:
+                return None, False
+            with open(file_path, "r", encoding=encoding, errors="replace") as f:
+                remaining = offset
+                while remaining > 0:
+                    skipped = f.read(min(remaining, 64 * 1024))
+                    if not skipped:
+                        return '', False
+                    remaining -= len(skipped)
+                content = f.read(length + 1)
+            return content[:length], len(content) > length
+        except Exception as e:
+            logger.error(f"[AutoRead] 读取文件时出错: {e}")
+            return None, False
+    
+    def _scan_text_matches(self, file_path, encoding, query, max_hits, max_chars):
+        """在文本文件中按块查找关键词(不区分大小写),返回([(字符位置, 片段)], 已扫描字符数)"""
+        try:
+            if not encoding:
+                head, whole_file = self._read_file_head(file_path)
+                encoding = self._detect_text_encoding(head, whole_file)
+            if not encoding:
+                return [], 0
+            pattern = re.compile(re.escape(query), re.IGNORECASE)
+            context = TOOL_SEARCH_SNIPPET_CHARS // 2
+            # 保留上一块的结尾,跨块的关键词和片段前文不会丢失
+            keep = len(query) + context
+            hits, scanned, base, buffer, next_pos = [], 0, 0, '', 0
+            with open(file_path, "r", encoding=encoding, errors="replace") as f:
+                while len(hits) < max_hits and scanned < max_chars:
+                    block = f.read(min(64 * 1024, max_chars - scanned))
+                    if not block:
+                        break
+                    scanned += len(block)
+                    buffer += block
+                    for match in pattern.finditer(buffer, max(0, next_pos - base)):
+                        snippet = buffer[max(0, match.start() - context):match.end() + context]
+                        hits.append((base + match.start(), ' '.join(snippet.split())))
+                        next_pos = base + match.end()
+                        if len(hits) >= max_hits:
+                            break
+                    drop = max(0, len(buffer) - keep)
+                    base += drop
+                    buffer = buffer[drop:]
+            return hits, scanned
+        except Exception as e:
+            logger.error(f"[AutoRead] 搜索文件内容时出错: {e}")
+            return [], 0
 
 AutoFileHandlerPlugin = PluginMain
@@ -0,0 +1,142 @@
+"""测试公共设置
+
+未安装AstrBot时注入插件用到的最小astrbot.api替身,测试在没有AstrBot的环境中也能运行;
+已安装时直接使用真实的AstrBot。
+"""
+import asyncio
+import logging
+import os
+import sys
+import types
+
+import pytest
+
+PLUGIN_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _install_astrbot_stub():
+    """注册astrbot、astrbot.api、astrbot.api.event、astrbot.api.star替身模块"""
+    try:
+        import astrbot.api  # noqa: F401
+        return
+    except ImportError:
+        pass
+
+    class MessageChain:
+        def message(self, message):
+            self.chain = message
+            return self
+
+    class AstrMessageEvent:
+        pass
+
+    class _Filter:
+        class EventMessageType:
+            ALL = 'all'
+
+        @staticmethod
+        def _passthrough(*args, **kwargs):
+            return lambda func: func
+
+        event_message_type = command = llm_tool = _passthrough
+
+    class Star:
+        def __init__(self, context):
+            self.context = context
+
+    def register(*args, **kwargs):
+        return lambda cls: cls
+
+    astrbot = types.ModuleType('astrbot')
+    astrbot.__path__ = []
+    api = types.ModuleType('astrbot.api')
+    api.__path__ = []
+    api.logger = logging.getLogger('astrbot')
+    api.AstrBotConfig = dict
+    event = types.ModuleType('astrbot.api.event')
+    event.MessageChain = MessageChain
+    event.AstrMessageEvent = AstrMessageEvent
+    event.filter = _Filter()
+    star = types.ModuleType('astrbot.api.star')
+    star.Star = Star
+    star.register = register
+    astrbot.api = api
+    api.event = event
+    api.star = star
+    sys.modules.update({
+        'astrbot': astrbot,
+        'astrbot.api': api,
+        'astrbot.api.event': event,
+        'astrbot.api.star': star,
+    })
+
+
+_install_astrbot_stub()
+if PLUGIN_ROOT not in sys.path:
+    sys.path.insert(0, PLUGIN_ROOT)
+
+
+@pytest.fixture
+def loop():
+    """独立的事件循环,测试结束时取消残留任务后关闭"""
+    event_loop = asyncio.new_event_loop()
+    yield event_loop
+    pending = asyncio.all_tasks(event_loop)
+    for task in pending:
+        task.cancel()
+    event_loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+    event_loop.close()
+
+
+@pytest.fixture
+def make_plugin(loop, tmp_path):
+    """按配置创建插件实例,插件的后台任务挂在loop上,测试结束时卸载"""
+    import main
+    plugins = []
+
+    def factory(**config):
+        conf = {'storage_path': str(tmp_path / 'storage'), 'auto_read_content': False}
+        conf.update(config)
+
+        async def create():
+            return main.PluginMain(object(), conf)
+
+        plugin = loop.run_until_complete(create())
+        plugins.append(plugin)
+        return plugin
+
+    yield factory
+    for plugin in plugins:
+        loop.run_until_complete(plugin.terminate())
+
+
+@pytest.fixture
+def add_file():
+    """在用户/群目录下写入文件并登记记录,返回记录"""
+    def add(plugin, entity_id, name, content=b'x', receive_time=1, entity_type='user', **fields):
+        storage_dir = os.path.join(plugin.storage_path, f"{entity_type}_{entity_id}")
+        os.makedirs(storage_dir, exist_ok=True)
+        path = os.path.join(storage_dir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        record = {
+            'type': entity_type,
+            'identifier': entity_id,
+            'final_filename': name,
+            'file_path': path,
+            'file_size': len(content),
+            'file_type': os.path.splitext(name)[1],
+            'receive_time': receive_time,
+            'download_status': 'success',
+        }
+        record.update(fields)
+        plugin.store.add_record(record)
+        return next(r for r in plugin.store.list_records(entity_type, entity_id) if r['file_path'] == path)
+    return add
+
+
+@pytest.fixture
+def no_grace(monkeypatch):
+    """关闭对账的宽限期,刚写入的文件也参与对账"""
+    import main
+    monkeypatch.setattr(main, 'RECONCILE_GRACE_SECONDS', 0)
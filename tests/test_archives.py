@@ -0,0 +1,156 @@
+"""压缩包索引与成员读取防护的测试"""
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+import main
+
+
+def make_zip(path, entries, compression=zipfile.ZIP_DEFLATED):
+    with zipfile.ZipFile(path, 'w', compression) as zf:
+        for name, data in entries:
+            zf.writestr(name, data)
+    return str(path)
+
+
+def make_tar(path, entries, mode='w:gz'):
+    with tarfile.open(path, mode) as tf:
+        for name, data in entries:
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.SYMTYPE
+                info.linkname = '/etc/passwd'
+                tf.addfile(info)
+            else:
+                info.size = len(data)
+                tf.addfile(info, io.BytesIO(data))
+    return str(path)
+
+
+@pytest.fixture
+def plugin(make_plugin):
+    return make_plugin(archive_max_members=100, archive_max_total_mb=1, archive_max_ratio=100)
+
+
+# ---- 建立索引 ----
+
+def test_scan_zip_lists_files_only(tmp_path):
+    path = make_zip(tmp_path / 'a.zip', [('dir/', ''), ('dir/a.txt', 'hello'), ('b.bin', b'\0' * 10)])
+
+    archive = main.scan_archive(path, 100)
+
+    assert archive['format'] == 'zip'
+    assert [(m['name'], m['size']) for m in archive['members']] == [('dir/a.txt', 5), ('b.bin', 10)]
+    assert (archive['member_count'], archive['total_size'], archive['truncated']) == (2, 15, False)
+
+
+def test_scan_zip_truncates_member_list_but_counts_all(tmp_path):
+    path = make_zip(tmp_path / 'many.zip', [(f'f{i}.txt', 'x') for i in range(30)])
+
+    archive = main.scan_archive(path, 10)
+
+    assert len(archive['members']) == 10
+    assert archive['member_count'] == 30
+    assert archive['truncated']
+
+
+def test_scan_tar_stops_after_member_limit_and_skips_links(tmp_path):
+    entries = [('link', None)] + [(f'f{i}.txt', b'x') for i in range(30)]
+    path = make_tar(tmp_path / 'many.tar.gz', entries)
+
+    archive = main.scan_archive(path, 10)
+
+    assert archive['format'] == 'tar'
+    assert [m['name'] for m in archive['members']] == [f'f{i}.txt' for i in range(10)]
+    assert archive['truncated']
+    assert archive['compressed_size'] == os.path.getsize(path)
+
+
+def test_scan_rejects_non_archive(tmp_path):
+    path = tmp_path / 'plain.txt'
+    path.write_bytes(b'just text')
+
+    with pytest.raises(tarfile.TarError):
+        main.scan_archive(str(path), 10)
+
+
+# ---- 读取成员的防护 ----
+
+def test_read_text_member(plugin, tmp_path):
+    path = make_zip(tmp_path / 'a.zip', [('docs/readme.txt', '你好,压缩包'), ('img.png', b'\x89PNG\r\n\x1a\n' + b'\0' * 64)])
+    archive = main.scan_archive(path, 100)
+
+    assert plugin._read_archive_member(path, archive, 'docs/readme.txt') == '你好,压缩包'
+    assert plugin._read_archive_member(path, archive, 'img.png') is None
+
+
+def test_compression_bomb_is_refused(plugin, tmp_path):
+    path = make_zip(tmp_path / 'bomb.zip', [('zeros.txt', b'0' * 900 * 1024)])
+    archive = main.scan_archive(path, 100)
+
+    with pytest.raises(main.ArchiveGuardError, match='压缩比'):
+        plugin._read_archive_member(path, archive, 'zeros.txt')
+
+
+def test_tar_ratio_uses_whole_archive(plugin, tmp_path):
+    path = make_tar(tmp_path / 'bomb.tar.gz', [('zeros.txt', b'0' * 900 * 1024)])
+    archive = main.scan_archive(path, 100)
+
+    with pytest.raises(main.ArchiveGuardError, match='压缩比'):
+        plugin._read_archive_member(path, archive, 'zeros.txt')
+
+
+def test_total_size_limit_is_refused(plugin, tmp_path):
+    plugin.archive_max_ratio = 0
+    path = make_zip(tmp_path / 'big.zip', [('a.txt', 'a'), ('big.bin', os.urandom(1200 * 1024))],
+                    zipfile.ZIP_STORED)
+    archive = main.scan_archive(path, 100)
+
+    with pytest.raises(main.ArchiveGuardError, match='总大小'):
+        plugin._read_archive_member(path, archive, 'a.txt')
+
+
+def test_truncated_index_is_refused(plugin, tmp_path):
+    path = make_zip(tmp_path / 'many.zip', [(f'f{i}.txt', 'x') for i in range(30)])
+    archive = main.scan_archive(path, 10)
+
+    with pytest.raises(main.ArchiveGuardError, match='成员数'):
+        plugin._read_archive_member(path, archive, 'f0.txt')
+
+
+@pytest.mark.parametrize('builder, name', [(make_zip, '../../escape.txt'), (make_tar, '../escape.txt')])
+def test_traversal_names_are_read_in_memory(plugin, tmp_path, builder, name):
+    work = tmp_path / 'a' / 'b'
+    work.mkdir(parents=True)
+    path = builder(work / 'evil.bin', [(name, b'payload')])
+    archive = main.scan_archive(path, 100)
+
+    # 成员只在内存中读取,不解压到磁盘,../不会在任何目录下生成文件
+    assert plugin._read_archive_member(path, archive, name) == 'payload'
+    assert not [f for _, _, files in os.walk(tmp_path) for f in files if f == 'escape.txt']
+
+
+def test_long_member_is_truncated(plugin, tmp_path):
+    plugin.max_auto_read_size = 100
+    path = make_zip(tmp_path / 'a.zip', [('long.txt', 'x' * 1000)])
+    archive = main.scan_archive(path, 100)
+
+    content = plugin._read_archive_member(path, archive, 'long.txt')
+
+    assert content.startswith('x' * 100)
+    assert content.endswith('[内容已截断,原文过长]')
+
+
+@pytest.mark.parametrize('identifier, expected', [
+    ('2', 'docs/b.txt'), ('docs/b.txt', 'docs/b.txt'), ('a.txt', 'a.txt'), ('B.T', 'docs/b.txt'), ('9', None),
+    ('zzz', None),
+])
+def test_find_archive_member(identifier, expected):
+    archive = {'members': [{'name': 'a.txt'}, {'name': 'docs/b.txt'}]}
+
+    member = main.PluginMain._find_archive_member(archive, identifier)
+
+    assert (member['name'] if member else None) == expected
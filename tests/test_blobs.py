@@ -0,0 +1,53 @@
+"""按内容哈希去重的文件块存储与引用计数的测试"""
+import hashlib
+import os
+
+
+def finalize(plugin, entity_id, name, content):
+    """模拟下载完成:写临时文件后存入文件块并登记记录,返回记录"""
+    storage_dir = os.path.join(plugin.storage_path, f"user_{entity_id}")
+    os.makedirs(storage_dir, exist_ok=True)
+    temp_path = os.path.join(storage_dir, f"temp_file_{name}")
+    with open(temp_path, 'wb') as f:
+        f.write(content)
+    sha256 = hashlib.sha256(content).hexdigest()
+    stored = plugin._finalize_temp_file(temp_path, name, storage_dir, sha256)
+    plugin.store.add_record({
+        'type': 'user', 'identifier': entity_id, 'receive_time': 1, 'download_status': 'success', **stored
+    })
+    plugin._settle_blob_ref(sha256)
+    return next(r for r in plugin.store.list_records('user', entity_id) if r['file_path'] == stored['file_path'])
+
+
+def test_identical_content_is_stored_once(make_plugin):
+    plugin = make_plugin()
+    first = finalize(plugin, '1', 'a.txt', b'same content')
+    second = finalize(plugin, '2', 'b.txt', b'same content')
+    blob_path = plugin._blob_path(first['sha256'])
+
+    assert second['sha256'] == first['sha256']
+    assert os.path.samefile(first['file_path'], blob_path)
+    assert os.path.samefile(second['file_path'], blob_path)
+    assert not any(name.startswith('temp_file_') for name in os.listdir(os.path.dirname(first['file_path'])))
+    assert plugin.store.blob_reference_counts() == ({first['sha256']: 2}, {first['sha256']: 2})
+
+
+def test_blob_removed_after_last_reference_released(make_plugin):
+    plugin = make_plugin()
+    first = finalize(plugin, '1', 'a.txt', b'same content')
+    second = finalize(plugin, '2', 'b.txt', b'same content')
+    sha256 = first['sha256']
+    blob_path = plugin._blob_path(sha256)
+
+    assert plugin._discard_record(first)
+    assert not os.path.exists(first['file_path'])
+    assert os.path.exists(blob_path)
+    assert plugin.store.blob_reference_counts()[0] == {sha256: 1}
+
+    # 重复释放同一条记录不会多减引用
+    assert not plugin._discard_record(first)
+    assert plugin.store.blob_reference_counts()[0] == {sha256: 1}
+
+    assert plugin._discard_record(second)
+    assert not os.path.exists(blob_path)
+    assert plugin.store.blob_reference_counts() == ({}, {})
@@ -0,0 +1,263 @@
+"""断点续传、分段下载与重试的测试"""
+import json
+import os
+
+import pytest
+from aiohttp import web
+
+import main
+
+DATA = bytes(range(256)) * 256
+
+
+class FakeServer:
+    """按需返回200/206的下载服务器,记录每次GET请求的Range与If-Range"""
+
+    def __init__(self, data=DATA, etag='"v1"'):
+        self.data = data
+        self.etag = etag
+        self.requests = []
+        # 返回区间的起点相对请求的偏移,以及附加在分段响应末尾的多余字节
+        self.range_shift = 0
+        self.extra = b''
+
+    async def handle(self, request):
+        headers = {'Accept-Ranges': 'bytes'}
+        if self.etag:
+            headers['ETag'] = self.etag
+        if request.method == 'HEAD':
+            return web.Response(body=self.data, headers=headers)
+        rng, if_range = request.headers.get('Range'), request.headers.get('If-Range')
+        self.requests.append((rng, if_range))
+        if rng and if_range in (None, self.etag):
+            first, _, last = rng[len('bytes='):].partition('-')
+            start = int(first) + self.range_shift
+            end = int(last) if last else len(self.data) - 1
+            if start >= len(self.data):
+                return web.Response(status=416, headers={'Content-Range': f'bytes */{len(self.data)}'})
+            headers['Content-Range'] = f'bytes {start}-{end}/{len(self.data)}'
+            return web.Response(status=206, body=self.data[start:end + 1] + self.extra, headers=headers)
+        return web.Response(body=self.data, headers=headers)
+
+
+@pytest.fixture
+def server(loop):
+    fake = FakeServer()
+    app = web.Application()
+    app.router.add_get('/f', fake.handle)
+    runner = web.AppRunner(app)
+
+    async def start():
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        return site._server.sockets[0].getsockname()[1]
+
+    fake.url = f"http://127.0.0.1:{loop.run_until_complete(start())}/f"
+    yield fake
+    loop.run_until_complete(runner.cleanup())
+
+
+@pytest.fixture
+def plugin(make_plugin):
+    return make_plugin(download_retry_backoff=0.001, download_chunk_size_kb=4)
+
+
+def temp_file(plugin, name='temp_file_x', content=None, validator=None):
+    os.makedirs(plugin.storage_path, exist_ok=True)
+    path = os.path.join(plugin.storage_path, name)
+    if content is not None:
+        with open(path, 'wb') as f:
+            f.write(content)
+    if validator is not None:
+        plugin._save_download_validator(path + main.DOWNLOAD_VALIDATOR_SUFFIX, validator)
+    return path
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# ---- 单连接续传 ----
+
+def test_resume_sends_if_range_with_stored_validator(loop, plugin, server):
+    path = temp_file(plugin, content=DATA[:1000], validator='"v1"')
+
+    result = loop.run_until_complete(plugin._download_to_temp(server.url, path))
+
+    assert read(path) == DATA
+    assert result['size'] == len(DATA)
+    assert server.requests == [('bytes=1000-', '"v1"')]
+    assert not os.path.exists(path + main.DOWNLOAD_VALIDATOR_SUFFIX)
+
+
+def test_changed_file_restarts_from_zero(loop, plugin, server):
+    path = temp_file(plugin, content=b'stale bytes', validator='"old"')
+
+    loop.run_until_complete(plugin._download_to_temp(server.url, path))
+
+    # If-Range不匹配时服务器返回整个文件,本地残留被覆盖而不是追加
+    assert read(path) == DATA
+    assert server.requests == [('bytes=11-', '"old"')]
+
+
+def test_leftover_without_validator_is_not_resumed(loop, plugin, server):
+    path = temp_file(plugin, content=b'unknown origin')
+
+    loop.run_until_complete(plugin._download_to_temp(server.url, path))
+
+    assert read(path) == DATA
+    assert server.requests == [(None, None)]
+
+
+def test_fresh_download_saves_validator_until_complete(loop, plugin, server):
+    path = temp_file(plugin)
+    server.data = DATA[:5000]
+    saved = []
+    original = plugin._save_download_validator
+
+    def spy(validator_file, validator):
+        original(validator_file, validator)
+        saved.append(json.loads(read(validator_file)))
+
+    plugin._save_download_validator = spy
+    loop.run_until_complete(plugin._download_to_temp(server.url, path))
+
+    assert saved == [{'validator': '"v1"'}]
+    assert not os.path.exists(path + main.DOWNLOAD_VALIDATOR_SUFFIX)
+
+
+def test_resume_with_mismatched_range_start_restarts(loop, plugin, server):
+    path = temp_file(plugin, content=DATA[:1000], validator='"v1"')
+    server.range_shift = 10
+
+    result = loop.run_until_complete(plugin._download_to_temp(server.url, path))
+
+    assert read(path) == DATA
+    assert result['sha256'] == main.hashlib.sha256(DATA).hexdigest()
+    assert server.requests == [('bytes=1000-', '"v1"'), (None, None)]
+
+
+# ---- 分段下载 ----
+
+@pytest.fixture
+def segmented(plugin):
+    plugin.download_parallel_segments = 4
+    plugin.download_parallel_min_size_mb = 0
+    return plugin
+
+
+def test_segmented_download_uses_if_range_and_removes_sidecar(loop, segmented, server):
+    path = temp_file(segmented)
+
+    loop.run_until_complete(segmented._download_to_temp(server.url, path))
+
+    assert read(path) == DATA
+    assert len(server.requests) == 4
+    assert all(if_range == '"v1"' for _, if_range in server.requests)
+    assert not os.path.exists(path + main.DOWNLOAD_SEGMENTS_SUFFIX)
+
+
+def test_segment_sidecar_dropped_when_temp_file_is_short(loop, segmented, server):
+    path = temp_file(segmented, content=b'x' * 10)
+    with open(path + main.DOWNLOAD_SEGMENTS_SUFFIX, 'w', encoding='utf-8') as f:
+        json.dump({'size': len(DATA), 'validator': '"v1"', 'segments': [[0, len(DATA) - 1, 5000]]}, f)
+
+    loop.run_until_complete(segmented._download_to_temp(server.url, path))
+
+    # 声明已下载5000字节的进度不可信,重新规划分段从头下载
+    assert read(path) == DATA
+    assert sorted(rng for rng, _ in server.requests)[0] == 'bytes=0-16383'
+
+
+def test_segment_sidecar_resumes_each_segment(loop, segmented, server):
+    path = temp_file(segmented, content=DATA[:100] + b'\0' * (len(DATA) - 100))
+    with open(path + main.DOWNLOAD_SEGMENTS_SUFFIX, 'w', encoding='utf-8') as f:
+        json.dump({'size': len(DATA), 'validator': '"v1"', 'segments': [[0, len(DATA) - 1, 100]]}, f)
+
+    loop.run_until_complete(segmented._download_to_temp(server.url, path))
+
+    assert read(path) == DATA
+    assert server.requests == [(f'bytes=100-{len(DATA) - 1}', '"v1"')]
+
+
+@pytest.mark.parametrize('shift, extra', [(7, b'1234567'), (0, b'overflow')])
+def test_bad_segment_response_falls_back_to_full_download(loop, segmented, server, shift, extra):
+    path = temp_file(segmented)
+    server.range_shift = shift
+    server.extra = extra
+
+    loop.run_until_complete(segmented._download_to_temp(server.url, path))
+
+    # 起点不符或超出分段长度的响应不写入下一段,整体回退为单连接下载
+    assert read(path) == DATA
+    assert server.requests[-1] == (None, None)
+    assert not os.path.exists(path + main.DOWNLOAD_SEGMENTS_SUFFIX)
+
+
+def test_segmented_download_needs_validator(loop, segmented, server):
+    path = temp_file(segmented)
+    server.etag = None
+
+    loop.run_until_complete(segmented._download_to_temp(server.url, path))
+
+    # 没有校验值时无法确认各段来自同一版本,按单连接下载
+    assert read(path) == DATA
+    assert server.requests == [(None, None)]
+
+
+# ---- 重试 ----
+
+def test_retries_back_off_exponentially(loop, plugin, monkeypatch):
+    delays = []
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(main.asyncio, 'sleep', fake_sleep)
+    monkeypatch.setattr(main.random, 'uniform', lambda low, high: 0)
+    plugin.download_max_retries = 3
+    plugin.download_retry_backoff = 1.0
+    attempts = []
+
+    async def attempt():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise main.DownloadRetryError('HTTP 503')
+        return True
+
+    assert loop.run_until_complete(plugin._with_retries(attempt, '下载'))
+    assert delays == [1.0, 2.0]
+
+
+def test_retries_give_up_and_cap_delay(loop, plugin, monkeypatch):
+    delays = []
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(main.asyncio, 'sleep', fake_sleep)
+    monkeypatch.setattr(main.random, 'uniform', lambda low, high: high)
+    plugin.download_max_retries = 8
+    plugin.download_retry_backoff = 1.0
+
+    async def attempt():
+        raise main.DownloadRetryError('HTTP 503')
+
+    assert loop.run_until_complete(plugin._with_retries(attempt, '下载')) is False
+    assert len(delays) == 8
+    assert delays[:3] == [1.5, 3.0, 6.0]
+    assert max(delays) == 90.0
+
+
+def test_non_retryable_errors_are_not_retried(loop, plugin):
+    attempts = []
+
+    async def attempt():
+        attempts.append(1)
+        raise ValueError('bug')
+
+    with pytest.raises(ValueError):
+        loop.run_until_complete(plugin._with_retries(attempt, '下载'))
+    assert attempts == [1]
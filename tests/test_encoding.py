@@ -0,0 +1,58 @@
+"""文本编码识别的测试"""
+import codecs
+
+import pytest
+
+import main
+
+detect = main.PluginMain._detect_text_encoding
+
+CHINESE = '这是一段中文文本,用于检测编码。第二句话也是中文。\n' * 20
+
+
+@pytest.mark.parametrize('data, expected', [
+    (b'', 'utf-8'),
+    (b'plain ascii\n', 'utf-8'),
+    (CHINESE.encode('utf-8'), 'utf-8'),
+    (codecs.BOM_UTF8 + CHINESE.encode('utf-8'), 'utf-8-sig'),
+    (CHINESE.encode('utf-16'), 'utf-16'),
+    (CHINESE.encode('utf-32'), 'utf-32'),
+    (CHINESE.encode('gbk'), 'gb18030'),
+    (CHINESE.encode('gb2312'), 'gb18030'),
+    # 西欧文字按GB18030解码得到的不是中文,按latin1处理
+    ('Größe und Übermaß, café à la crème\n'.encode('latin1') * 10, 'latin1'),
+])
+def test_detect_text_encoding(data, expected):
+    assert detect(data, whole_file=True) == expected
+
+
+def test_binary_data_is_not_text():
+    assert detect(bytes(range(32)) * 64, whole_file=True) is None
+    assert detect(b'\x89PNG\r\n\x1a\n' + b'\x00\x01\x02\x03' * 500) is None
+
+
+def test_sample_may_end_inside_multibyte_character():
+    data = CHINESE.encode('utf-8')
+    sample = data[:len(data) - 2]
+
+    # 截取的样本末尾不完整的字符不影响识别
+    assert detect(sample, whole_file=False) == 'utf-8'
+    # 完整文件以不完整的字符结尾时不是合法的UTF-8
+    assert detect(sample, whole_file=True) != 'utf-8'
+
+
+def test_gbk_sample_cut_mid_character():
+    data = CHINESE.encode('gbk')
+
+    assert detect(data[:len(data) // 2 * 2 - 1], whole_file=False) == 'gb18030'
+
+
+def test_detected_encoding_round_trips(make_plugin, tmp_path):
+    plugin = make_plugin()
+    path = tmp_path / 'gbk.txt'
+    path.write_bytes(CHINESE.encode('gbk'))
+
+    sniff = plugin._sniff_file(str(path))
+
+    assert sniff['is_text']
+    assert path.read_bytes().decode(sniff['encoding']) == CHINESE
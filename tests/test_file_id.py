@@ -0,0 +1,81 @@
+"""平台文件ID复用已存储内容的测试"""
+import hashlib
+import os
+
+
+def store_blob(plugin, content, file_id):
+    sha256 = hashlib.sha256(content).hexdigest()
+    blob_path = plugin._blob_path(sha256)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    with open(blob_path, 'wb') as f:
+        f.write(content)
+    plugin.store.acquire_blob(sha256, len(content))
+    plugin.store.remember_file_id(file_id, sha256, '.txt', 'utf-8')
+    return sha256
+
+
+def storage_dir(plugin):
+    path = os.path.join(plugin.storage_path, 'user_1')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def test_known_file_id_links_existing_blob(make_plugin):
+    plugin = make_plugin()
+    sha256 = store_blob(plugin, b'hello', 'fid-1')
+
+    outcome, stored = plugin._link_known_file_id('fid-1', 'hello.txt', storage_dir(plugin))
+
+    assert outcome == 'hits'
+    assert stored['sha256'] == sha256
+    assert stored['file_size'] == 5
+    assert os.path.samefile(stored['file_path'], plugin._blob_path(sha256))
+    assert plugin.store.blob_reference_counts()[0] == {sha256: 2}
+    plugin._settle_blob_ref(sha256)
+
+
+def test_unknown_file_id_is_a_miss(make_plugin):
+    plugin = make_plugin()
+
+    assert plugin._link_known_file_id('nope', 'a.txt', storage_dir(plugin)) == ('misses', None)
+
+
+def test_oversize_hit_is_refused_and_counted_separately(make_plugin):
+    plugin = make_plugin()
+    sha256 = store_blob(plugin, b'x' * 100, 'fid-big')
+
+    outcome, stored = plugin._link_known_file_id('fid-big', 'big.txt', storage_dir(plugin), max_size_bytes=50)
+
+    assert (outcome, stored) == ('oversize', None)
+    assert outcome in plugin.file_id_stats
+    assert plugin.store.blob_reference_counts()[0] == {sha256: 1}
+
+
+def test_missing_blob_forgets_file_id(make_plugin):
+    plugin = make_plugin()
+    sha256 = store_blob(plugin, b'gone', 'fid-gone')
+    os.remove(plugin._blob_path(sha256))
+
+    assert plugin._link_known_file_id('fid-gone', 'gone.txt', storage_dir(plugin)) == ('stale', None)
+    assert plugin.store.lookup_file_id('fid-gone') is None
+
+
+def test_status_hit_rate_counts_every_lookup(loop, make_plugin):
+    plugin = make_plugin()
+    plugin.file_id_stats.update({'hits': 1, 'misses': 1, 'stale': 1, 'oversize': 1})
+
+    class Event:
+        sent = []
+
+        def plain_result(self, text):
+            return text
+
+        async def send(self, result):
+            self.sent.append(result)
+
+    event = Event()
+    loop.run_until_complete(plugin.file_status(event))
+    text = event.sent[0]
+
+    assert '命中 1 次 / 查询 4 次 (命中率 25.0%)' in text
+    assert '超过大小限制 1 次' in text
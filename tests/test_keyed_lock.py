@@ -0,0 +1,75 @@
+"""按用户/群区分的记录锁的测试"""
+import asyncio
+import gc
+
+import main
+
+
+def test_same_key_shares_lock_while_in_use():
+    async def run():
+        locks = main.KeyedLock()
+        first = locks('user:1')
+        other = locks('group:1')
+        assert locks('user:1') is first
+        assert other is not first
+        return len(locks)
+
+    assert asyncio.run(run()) == 2
+
+
+def test_unused_locks_are_released():
+    async def run():
+        locks = main.KeyedLock()
+        for i in range(100):
+            async with locks(f'user:{i}'):
+                pass
+        gc.collect()
+        return len(locks)
+
+    assert asyncio.run(run()) == 0
+
+
+def test_waiters_keep_lock_alive_and_are_serialized():
+    async def run():
+        locks = main.KeyedLock()
+        order = []
+
+        async def worker(name):
+            async with locks('group:1'):
+                order.append(f'{name} start')
+                await asyncio.sleep(0.01)
+                order.append(f'{name} end')
+
+        tasks = [asyncio.ensure_future(worker(name)) for name in 'abc']
+        await asyncio.sleep(0.005)
+        gc.collect()
+        alive = len(locks)
+        await asyncio.gather(*tasks)
+        del tasks
+        gc.collect()
+        return order, alive, len(locks)
+
+    order, alive, remaining = asyncio.run(run())
+    assert order == ['a start', 'a end', 'b start', 'b end', 'c start', 'c end']
+    assert alive == 1
+    assert remaining == 0
+
+
+def test_different_keys_do_not_block_each_other():
+    async def run():
+        locks = main.KeyedLock()
+        async with locks('user:1'):
+            other = locks('user:2')
+            await asyncio.wait_for(other.acquire(), 0.1)
+            other.release()
+        return True
+
+    assert asyncio.run(run())
+
+
+def test_entity_lock_keys_by_type_and_id(make_plugin):
+    plugin = make_plugin()
+    lock = plugin._entity_lock('user', '1')
+
+    assert plugin._entity_lock('user', 1) is lock
+    assert plugin._entity_lock('group', '1') is not lock
@@ -0,0 +1,126 @@
+"""分页列出文件(键集游标)的测试"""
+import re
+
+import pytest
+
+
+class Event:
+    def __init__(self, message_str):
+        self.message_str = message_str
+        self.sent = []
+
+    def plain_result(self, text):
+        return text
+
+    async def send(self, result):
+        self.sent.append(result)
+
+
+def fill(plugin, add_file, count):
+    # 大小与名称的顺序和接收时间相反,且有重复的大小,检验排序值相同时按记录ID区分
+    for i in range(count):
+        add_file(plugin, '1', f'f{count - i:02d}.txt', content=b'x' * (10 + i // 2), receive_time=100 + i)
+
+
+@pytest.mark.parametrize('sort', ['time', 'size', 'name'])
+@pytest.mark.parametrize('descending', [True, False])
+def test_keyset_pages_match_offset_pages(make_plugin, add_file, sort, descending):
+    plugin = make_plugin()
+    fill(plugin, add_file, 11)
+    store = plugin.store
+    expected, _ = store.page_records('user', '1', sort=sort, descending=descending, limit=100)
+
+    listed, after = [], None
+    while True:
+        records, has_more = store.page_records('user', '1', sort=sort, descending=descending, limit=4, after=after)
+        listed += records
+        if not has_more:
+            break
+        after = plugin._list_cursor_after(records[-1], sort)
+
+    assert [r['id'] for r in listed] == [r['id'] for r in expected]
+    assert len(listed) == 11
+
+
+def test_generation_changes_with_records(make_plugin, add_file):
+    plugin = make_plugin()
+    record = add_file(plugin, '1', 'a.txt')
+    before = plugin.store.entity_generation('user', '1')
+    other = plugin.store.entity_generation('user', '2')
+
+    add_file(plugin, '1', 'b.txt', receive_time=2)
+    added = plugin.store.entity_generation('user', '1')
+    assert added != before
+    plugin.store.delete_record(record['id'])
+    assert plugin.store.entity_generation('user', '1') != added
+    assert plugin.store.entity_generation('user', '2') == other
+
+
+def listed_names(text):
+    return re.findall(r'文件名: (\S+)', text)
+
+
+def next_cursor(text):
+    match = re.search(r'next_cursor: (\S+)', text)
+    return match.group(1) if match else None
+
+
+def test_tool_cursor_round_trip(loop, make_plugin, add_file):
+    plugin = make_plugin()
+    fill(plugin, add_file, 5)
+
+    first = loop.run_until_complete(plugin._tool_list_files('user', '1', {'page_size': 2}))
+    cursor = next_cursor(first)
+    second = loop.run_until_complete(plugin._tool_list_files('user', '1', {'page_size': 2, 'cursor': cursor}))
+    third = loop.run_until_complete(
+        plugin._tool_list_files('user', '1', {'page_size': 2, 'cursor': next_cursor(second)}))
+
+    assert listed_names(first) + listed_names(second) + listed_names(third) == [
+        'f05.txt', 'f04.txt', 'f03.txt', 'f02.txt', 'f01.txt']
+    assert '3.' in second and '已是最后一页' in third
+
+
+def test_tool_cursor_falls_back_to_offset_after_change(loop, make_plugin, add_file):
+    plugin = make_plugin()
+    fill(plugin, add_file, 4)
+
+    first = loop.run_until_complete(plugin._tool_list_files('user', '1', {'page_size': 2}))
+    # 游标之前插入一条更早的记录: 游标作废后按已列出的数量继续,序号仍然连续
+    add_file(plugin, '1', 'early.txt', receive_time=1)
+    second = loop.run_until_complete(
+        plugin._tool_list_files('user', '1', {'page_size': 2, 'cursor': next_cursor(first)}))
+
+    assert listed_names(second) == ['f03.txt', 'f02.txt']
+    assert '(第3-4个)' in second
+
+
+def test_invalid_tool_cursor_is_rejected(loop, make_plugin, add_file):
+    plugin = make_plugin()
+    fill(plugin, add_file, 1)
+    result = loop.run_until_complete(plugin._tool_list_files('user', '1', {'cursor': '!!'}))
+    assert result.startswith('错误:cursor无效')
+
+
+def list_page(loop, plugin, page):
+    event = Event(f'查看文件 {page}')
+    loop.run_until_complete(plugin._list_files_command(
+        event, 'user', '1', '文件', '查看文件', '发送文件', '删除文件', '空'))
+    return event.sent[0]
+
+
+def test_command_pages_reuse_cursor_until_records_change(loop, make_plugin, add_file):
+    plugin = make_plugin(list_page_size=2)
+    fill(plugin, add_file, 5)
+
+    assert 'f01.txt' in list_page(loop, plugin, 1)
+    (cursors,) = plugin._list_cursors.values()
+    assert 2 in cursors['pages']
+    assert 'f03.txt' in list_page(loop, plugin, 2)
+    assert 3 in cursors['pages']
+
+    # 新文件排在最前,游标作废后按偏移量读取,第2页与序号保持一致
+    add_file(plugin, '1', 'new.txt', receive_time=999)
+    page = list_page(loop, plugin, 2)
+    assert '3. f02.txt' in page and 'f04.txt' not in page
+    (cursors,) = plugin._list_cursors.values()
+    assert cursors['generation'] == plugin.store.entity_generation('user', '1')
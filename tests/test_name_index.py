@@ -0,0 +1,79 @@
+"""文件名索引的测试"""
+import main
+
+
+def _records(*names):
+    return [{'final_filename': name, 'original_name': name} for name in names]
+
+
+def test_exact_beats_prefix_and_fuzzy():
+    index = main.FileNameIndex(_records('report.pdf.bak', 'report.pdf', 'my_report.pdf'))
+    assert index.lookup('REPORT.PDF') == ('exact', [1])
+
+
+def test_prefix_prefers_shorter_then_newer():
+    index = main.FileNameIndex(_records('notes_long.txt', 'notes.txt', 'notes.csv'))
+    mode, positions = index.lookup('notes')
+    assert mode == 'prefix'
+    assert positions == [1, 2, 0]
+
+
+def test_original_name_also_matches():
+    index = main.FileNameIndex([{'final_filename': 'a_1.txt', 'original_name': 'a.txt'}])
+    assert index.lookup('a.txt') == ('exact', [0])
+
+
+def test_fuzzy_prefers_containing_query():
+    index = main.FileNameIndex(_records('summary_data.csv', 'data_summary.csv', 'dat.csv'))
+    mode, positions = index.lookup('summary')
+    assert mode == 'prefix'
+    mode, positions = index.lookup('y_data')
+    assert mode == 'fuzzy'
+    assert positions[0] == 0
+
+
+def test_no_match_returns_empty():
+    index = main.FileNameIndex(_records('report.pdf'))
+    assert index.lookup('zzzz') == (None, [])
+    assert index.lookup('   ') == (None, [])
+
+
+def test_suggest_returns_closest_records():
+    index = main.FileNameIndex(_records('budget_2024.xlsx', 'photo.png', 'budget_2023.xlsx'))
+    names = [r['final_filename'] for r in index.suggest('budgte_2024')]
+    assert names[0] == 'budget_2024.xlsx'
+    assert 'photo.png' not in names[:2]
+
+
+def test_find_target_record_by_position_and_name(make_plugin, add_file):
+    plugin = make_plugin()
+    add_file(plugin, '1', 'old.txt', receive_time=1)
+    add_file(plugin, '1', 'new.txt', receive_time=2)
+    index = plugin.store.name_index('user', '1')
+
+    record, error = plugin._find_target_record(index, '1')
+    assert error is None and record['final_filename'] == 'new.txt'
+    record, error = plugin._find_target_record(index, 'old')
+    assert error is None and record['final_filename'] == 'old.txt'
+
+    record, error = plugin._find_target_record(index, '9')
+    assert record is None and '序号超出范围' in error
+    record, error = plugin._find_target_record(index, 'olt.txt')
+    assert record is None and 'old.txt' in error
+
+
+def test_index_rebuilt_after_records_change(make_plugin, add_file):
+    plugin = make_plugin()
+    first = add_file(plugin, '1', 'a.txt')
+    index = plugin.store.name_index('user', '1')
+    assert plugin.store.name_index('user', '1') is index
+
+    add_file(plugin, '1', 'b.txt', receive_time=2)
+    rebuilt = plugin.store.name_index('user', '1')
+    assert rebuilt is not index
+    assert rebuilt.lookup('b.txt') == ('exact', [0])
+
+    plugin.store.delete_record(first['id'])
+    index = plugin.store.name_index('user', '1')
+    assert [r['final_filename'] for r in index.records] == ['b.txt']
+    assert index.lookup('a.txt')[0] != 'exact'
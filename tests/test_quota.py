@@ -0,0 +1,130 @@
+"""存储配额与准入的测试"""
+import asyncio
+import os
+
+
+def test_quota_rejects_without_evicting_when_reservations_fill_quota(make_plugin, add_file):
+    plugin = make_plugin(max_files_per_user=1, max_storage_mb_per_user=0)
+    admitted, _, reservation = plugin._enforce_storage_quota('user', '1', 10)
+    assert admitted
+    keep = add_file(plugin, '1', 'keep.txt')
+
+    # 唯一的名额已被下载中的文件占用,淘汰已有文件也放不下
+    admitted, evicted, _ = plugin._enforce_storage_quota('user', '1', 10)
+
+    assert not admitted
+    assert evicted == []
+    assert os.path.exists(keep['file_path'])
+    assert plugin.store.has_record(keep['id'])
+    plugin._release_reservation(reservation)
+
+
+def test_quota_rejects_without_evicting_when_global_reservations_fill_total(make_plugin, add_file):
+    plugin = make_plugin(max_files_per_user=0, max_storage_mb_per_user=0, max_storage_mb_total=1)
+    admitted, _, reservation = plugin._enforce_storage_quota('user', '1', 600 * 1024)
+    assert admitted
+    keep = add_file(plugin, '2', 'keep.txt', content=b'k' * 100)
+
+    admitted, evicted, _ = plugin._enforce_storage_quota('user', '2', 600 * 1024)
+
+    assert not admitted
+    assert evicted == []
+    assert os.path.exists(keep['file_path'])
+    plugin._release_reservation(reservation)
+
+
+def test_oversize_file_rejected_before_download(make_plugin, add_file):
+    plugin = make_plugin(max_files_per_user=0, max_storage_mb_per_user=1)
+    keep = add_file(plugin, '1', 'keep.txt')
+
+    admitted, evicted, reservation = plugin._enforce_storage_quota('user', '1', 2 * 1024 * 1024)
+
+    assert not admitted
+    assert evicted == []
+    assert reservation is None
+    assert os.path.exists(keep['file_path'])
+
+
+def test_reservation_counts_until_released(make_plugin):
+    plugin = make_plugin(max_files_per_user=1, max_storage_mb_per_user=0)
+    admitted, _, reservation = plugin._enforce_storage_quota('user', '1', 10)
+    assert admitted
+    assert not plugin._enforce_storage_quota('user', '1', 10)[0]
+
+    plugin._release_reservation(reservation)
+    plugin._release_reservation(reservation)
+
+    admitted, _, second = plugin._enforce_storage_quota('user', '1', 10)
+    assert admitted
+    plugin._release_reservation(second)
+
+
+def test_quota_evicts_oldest_record(make_plugin, add_file):
+    plugin = make_plugin(max_files_per_user=2, max_storage_mb_per_user=0)
+    old = add_file(plugin, '1', 'old.txt', receive_time=1)
+    new = add_file(plugin, '1', 'new.txt', receive_time=2)
+
+    admitted, evicted, reservation = plugin._enforce_storage_quota('user', '1', 10)
+
+    assert admitted
+    assert [r['id'] for r in evicted] == [old['id']]
+    assert not os.path.exists(old['file_path'])
+    assert os.path.exists(new['file_path'])
+    plugin._release_reservation(reservation)
+
+
+def test_largest_policy_evicts_until_bytes_fit(make_plugin, add_file):
+    plugin = make_plugin(max_files_per_user=0, max_storage_mb_per_user=1, eviction_policy='largest')
+    small = add_file(plugin, '1', 'small.bin', content=b's' * 100)
+    big = add_file(plugin, '1', 'big.bin', content=b'b' * 700 * 1024)
+
+    admitted, evicted, reservation = plugin._enforce_storage_quota('user', '1', 500 * 1024)
+
+    assert admitted
+    assert [r['id'] for r in evicted] == [big['id']]
+    assert os.path.exists(small['file_path'])
+    plugin._release_reservation(reservation)
+
+
+def test_group_and_user_quotas_are_separate(make_plugin, add_file):
+    plugin = make_plugin(max_files_per_user=1, max_files_per_group=2)
+    group_file = add_file(plugin, '1', 'g.txt', entity_type='group')
+
+    admitted, evicted, reservation = plugin._enforce_storage_quota('group', '1', 10)
+
+    assert admitted
+    assert evicted == []
+    assert os.path.exists(group_file['file_path'])
+    plugin._release_reservation(reservation)
+
+
+def test_global_limit_defers_other_entity_eviction_to_its_lock(loop, make_plugin, add_file):
+    plugin = make_plugin(max_files_per_user=0, max_storage_mb_per_user=0, max_storage_mb_total=1)
+    other = add_file(plugin, '1', 'other.bin', content=b'o' * 700 * 1024)
+
+    admitted, evicted, reservation = plugin._enforce_storage_quota('user', '2', 500 * 1024)
+
+    # 其他用户的记录不在本用户的锁内删除,只登记为淘汰中,不再计入用量
+    assert admitted
+    assert evicted == []
+    assert [r['id'] for r in reservation.pending_evictions] == [other['id']]
+    assert os.path.exists(other['file_path'])
+    assert not plugin._enforce_storage_quota('user', '3', 600 * 1024)[0]
+
+    async def evict_while_owner_busy():
+        lock = plugin._entity_lock('user', '1')
+        await lock.acquire()
+        task = asyncio.ensure_future(plugin._evict_pending(reservation))
+        await asyncio.sleep(0.05)
+        still_there = os.path.exists(other['file_path'])
+        lock.release()
+        return still_there, await task
+
+    still_there, evicted = loop.run_until_complete(evict_while_owner_busy())
+
+    assert still_there
+    assert [r['id'] for r in evicted] == [other['id']]
+    assert not os.path.exists(other['file_path'])
+    assert reservation.pending_evictions == []
+    assert plugin._evicting == {}
+    plugin._release_reservation(reservation)
@@ -0,0 +1,120 @@
+"""存储目录与记录库对账的测试"""
+import hashlib
+import json
+import os
+
+import main
+
+
+def store_blob(plugin, content):
+    """直接写入一个文件块并登记一次引用,返回内容哈希"""
+    sha256 = hashlib.sha256(content).hexdigest()
+    blob_path = plugin._blob_path(sha256)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    with open(blob_path, 'wb') as f:
+        f.write(content)
+    plugin.store.acquire_blob(sha256, len(content))
+    return sha256
+
+
+def test_reconcile_quarantines_orphan_file(make_plugin, add_file, no_grace):
+    plugin = make_plugin()
+    known = add_file(plugin, '1', 'known.txt')
+    storage_dir = os.path.dirname(known['file_path'])
+    for name in ('stray.txt', os.path.join(main.ORPHAN_DIR, 'stray.txt')):
+        os.makedirs(os.path.dirname(os.path.join(storage_dir, name)), exist_ok=True)
+        with open(os.path.join(storage_dir, name), 'wb') as f:
+            f.write(b'orphan')
+
+    result = plugin._reconcile_entity_dir('user', '1', storage_dir)
+
+    assert result['orphan_files'] == 1
+    assert result['quarantined_bytes'] == len(b'orphan')
+    assert not os.path.exists(os.path.join(storage_dir, 'stray.txt'))
+    # 隔离目录中已有同名文件时追加序号
+    assert os.path.exists(os.path.join(storage_dir, main.ORPHAN_DIR, 'stray_1.txt'))
+    assert os.path.exists(known['file_path'])
+
+
+def test_reconcile_skips_orphans_while_legacy_records_pending(make_plugin, no_grace):
+    plugin = make_plugin()
+    storage_dir = os.path.join(plugin.storage_path, 'user_1')
+    os.makedirs(storage_dir)
+    with open(os.path.join(storage_dir, main.LEGACY_RECORD_FILE), 'w', encoding='utf-8') as f:
+        json.dump([], f)
+    stray = os.path.join(storage_dir, 'stray.txt')
+    with open(stray, 'wb') as f:
+        f.write(b'data')
+
+    result = plugin._reconcile_entity_dir('user', '1', storage_dir)
+
+    assert result['legacy_pending_dirs'] == 1
+    assert result['orphan_files'] == 0
+    assert os.path.exists(stray)
+
+
+def test_reconcile_adopts_orphan_file(make_plugin, no_grace):
+    plugin = make_plugin()
+    storage_dir = os.path.join(plugin.storage_path, 'user_1')
+    os.makedirs(storage_dir)
+    stray = os.path.join(storage_dir, 'stray.txt')
+    with open(stray, 'wb') as f:
+        f.write(b'adopt me')
+
+    result = plugin._reconcile_entity_dir('user', '1', storage_dir, adopt_orphans=True)
+
+    assert result['adopted_files'] == 1
+    records = plugin.store.list_records('user', '1')
+    assert [r['file_path'] for r in records] == [stray]
+    sha256 = hashlib.sha256(b'adopt me').hexdigest()
+    assert records[0]['sha256'] == sha256
+    assert os.path.exists(plugin._blob_path(sha256))
+    assert plugin.store.blob_reference_counts()[0] == {sha256: 1}
+
+
+def test_reconcile_removes_stale_temp_files(make_plugin, no_grace):
+    plugin = make_plugin(reconcile_temp_max_age_hours=0)
+    storage_dir = os.path.join(plugin.storage_path, 'user_1')
+    os.makedirs(storage_dir)
+    stale = os.path.join(storage_dir, 'temp_file_abc')
+    for path in (stale, stale + main.DOWNLOAD_SEGMENTS_SUFFIX):
+        with open(path, 'wb') as f:
+            f.write(b'partial')
+    active = os.path.join(storage_dir, 'temp_file_def')
+    with open(active, 'wb') as f:
+        f.write(b'partial')
+    plugin._active_temp_paths.add(active)
+
+    result = plugin._reconcile_entity_dir('user', '1', storage_dir)
+
+    assert result['stale_temps'] == 2
+    assert not os.path.exists(stale)
+    assert os.path.exists(active)
+
+
+def test_reconcile_relinks_missing_file_from_blob(make_plugin, add_file, no_grace):
+    plugin = make_plugin()
+    sha256 = store_blob(plugin, b'content')
+    record = add_file(plugin, '1', 'a.txt', content=b'content', sha256=sha256)
+    os.remove(record['file_path'])
+
+    result = plugin._reconcile_entity_dir('user', '1', os.path.dirname(record['file_path']))
+
+    assert result['relinked'] == 1
+    assert os.path.samefile(record['file_path'], plugin._blob_path(sha256))
+
+
+def test_reconcile_blobs_corrects_reference_counts(make_plugin, add_file, no_grace):
+    plugin = make_plugin()
+    kept = store_blob(plugin, b'kept')
+    dropped = store_blob(plugin, b'dropped')
+    add_file(plugin, '1', 'a.txt', content=b'kept', sha256=kept)
+    plugin.store.set_blob_ref_count(kept, 5)
+
+    result = plugin._reconcile_blobs()
+
+    # 引用计数偏高的校正为实际引用数,没有记录引用的文件块被删除
+    assert result['blob_refs_fixed'] == 2
+    assert plugin.store.blob_reference_counts()[0] == {kept: 1}
+    assert os.path.exists(plugin._blob_path(kept))
+    assert not os.path.exists(plugin._blob_path(dropped))
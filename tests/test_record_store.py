@@ -0,0 +1,105 @@
+"""SQLite记录库的测试"""
+import os
+import sqlite3
+
+import pytest
+
+import main
+
+
+def add_record(store, entity_id='1', name='a.txt', receive_time=1, **fields):
+    record = {'type': 'user', 'identifier': entity_id, 'final_filename': name, 'receive_time': receive_time,
+              'download_status': 'success'}
+    record.update(fields)
+    store.add_record(record)
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'records.db')
+
+
+def corrupt(path):
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    with open(path, 'wb') as f:
+        f.write(b'not a database' * 512)
+
+
+# ---- 打开与恢复 ----
+
+def test_new_database_asks_for_orphan_adoption_once(db_path):
+    store = main.FileRecordStore(db_path)
+    assert store.adopt_orphans_pending
+    store.close()
+
+    store = main.FileRecordStore(db_path)
+    try:
+        assert not store.adopt_orphans_pending
+        assert not store.restored_from_snapshot
+    finally:
+        store.close()
+
+
+def test_snapshot_is_atomic_copy(db_path):
+    store = main.FileRecordStore(db_path)
+    try:
+        add_record(store)
+        snapshot_path = store.snapshot()
+        assert snapshot_path == db_path + main.RECORD_SNAPSHOT_SUFFIX
+        assert not os.path.exists(snapshot_path + '.tmp')
+        conn = sqlite3.connect(snapshot_path)
+        try:
+            assert conn.execute('SELECT COUNT(*) FROM file_records').fetchone()[0] == 1
+        finally:
+            conn.close()
+    finally:
+        store.close()
+
+
+def test_corrupt_database_restored_from_snapshot(db_path, tmp_path):
+    store = main.FileRecordStore(db_path)
+    add_record(store)
+    store.snapshot()
+    store.close()
+    corrupt(db_path)
+
+    store = main.FileRecordStore(db_path)
+    try:
+        assert store.restored_from_snapshot
+        assert store.adopt_orphans_pending
+        assert store.entity_usage('user', '1')['files'] == 1
+    finally:
+        store.close()
+    assert any(name.startswith('records.db.corrupt-') for name in os.listdir(tmp_path))
+
+
+def test_corrupt_snapshot_starts_empty_and_adopts_orphans(db_path):
+    store = main.FileRecordStore(db_path)
+    add_record(store)
+    store.close()
+    corrupt(db_path)
+    with open(db_path + main.RECORD_SNAPSHOT_SUFFIX, 'wb') as f:
+        f.write(b'junk' * 1024)
+
+    store = main.FileRecordStore(db_path)
+    try:
+        assert not store.restored_from_snapshot
+        assert store.adopt_orphans_pending
+        assert store.entity_usage('user', '1')['files'] == 0
+    finally:
+        store.close()
+
+
+def test_non_corruption_errors_are_raised_without_moving_database(db_path, tmp_path, monkeypatch):
+    main.FileRecordStore(db_path).close()
+    before = sorted(os.listdir(tmp_path))
+
+    def locked(conn):
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(main.FileRecordStore, '_quick_check', staticmethod(locked))
+    with pytest.raises(sqlite3.OperationalError):
+        main.FileRecordStore(db_path)
+    assert sorted(os.listdir(tmp_path)) == before
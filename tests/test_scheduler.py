@@ -0,0 +1,104 @@
+"""下载调度器的测试"""
+import asyncio
+
+import pytest
+
+import main
+
+
+def recorder(order, name, release=None):
+    async def job():
+        order.append(name)
+        if release is not None:
+            await release.wait()
+    return job
+
+
+def test_entities_take_turns():
+    async def run():
+        scheduler = main.DownloadScheduler(max_concurrent=1, per_entity_limit=1)
+        order = []
+        for i in range(3):
+            await scheduler.submit('group:a', recorder(order, f'a{i}'))
+        await scheduler.submit('group:b', recorder(order, 'b0'))
+        scheduler.start()
+        while scheduler.completed < 4:
+            await asyncio.sleep(0.01)
+        await scheduler.shutdown()
+        return order
+
+    # 刷屏的群a不会让群b等到a的任务全部完成
+    assert asyncio.run(run()) == ['a0', 'b0', 'a1', 'a2']
+
+
+def test_per_entity_limit_leaves_workers_for_others():
+    async def run():
+        scheduler = main.DownloadScheduler(max_concurrent=4, per_entity_limit=2)
+        release = asyncio.Event()
+        order = []
+        for i in range(5):
+            await scheduler.submit('group:a', recorder(order, f'a{i}', release))
+        await scheduler.submit('user:b', recorder(order, 'b0', release))
+        scheduler.start()
+        await asyncio.sleep(0.05)
+        running = list(order)
+        stats = scheduler.stats()
+        release.set()
+        while scheduler.completed < 6:
+            await asyncio.sleep(0.01)
+        await scheduler.shutdown()
+        return running, stats
+
+    running, stats = asyncio.run(run())
+    assert sorted(running) == ['a0', 'a1', 'b0']
+    assert stats['in_flight'] == 3
+    assert stats['queued'] == 3
+
+
+def test_submit_waits_when_queue_is_full():
+    async def run():
+        scheduler = main.DownloadScheduler(max_concurrent=1, max_queued=2)
+        order = []
+        await scheduler.submit('user:a', recorder(order, 'a0'))
+        await scheduler.submit('user:a', recorder(order, 'a1'))
+        assert scheduler.is_full()
+        blocked = asyncio.ensure_future(scheduler.submit('user:a', recorder(order, 'a2')))
+        await asyncio.sleep(0.05)
+        assert not blocked.done()
+        scheduler.start()
+        await asyncio.wait_for(blocked, 1)
+        while scheduler.completed < 3:
+            await asyncio.sleep(0.01)
+        await scheduler.shutdown()
+        return order, scheduler.stats()
+
+    order, stats = asyncio.run(run())
+    assert order == ['a0', 'a1', 'a2']
+    assert stats['peak_queued'] == 2
+
+
+def test_failed_job_does_not_stop_worker():
+    async def run():
+        scheduler = main.DownloadScheduler(max_concurrent=1)
+        order = []
+
+        async def boom():
+            raise RuntimeError('boom')
+
+        await scheduler.submit('user:a', boom)
+        await scheduler.submit('user:a', recorder(order, 'a1'))
+        scheduler.start()
+        while scheduler.completed + scheduler.failed < 2:
+            await asyncio.sleep(0.01)
+        await scheduler.shutdown()
+        return order, scheduler.stats()
+
+    order, stats = asyncio.run(run())
+    assert order == ['a1']
+    assert (stats['completed'], stats['failed'], stats['in_flight']) == (1, 1, 0)
+
+
+@pytest.mark.parametrize('value', [0, -3])
+def test_limits_are_at_least_one(value):
+    scheduler = main.DownloadScheduler(max_concurrent=value, per_entity_limit=value, max_queued=value)
+    assert (scheduler.max_concurrent, scheduler.per_entity_limit, scheduler.max_queued) == (1, 1, 1)
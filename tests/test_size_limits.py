@@ -0,0 +1,120 @@
+"""按响应头和实际字节数限制下载大小的测试"""
+import os
+
+import pytest
+from aiohttp import web
+
+import main
+
+LIMIT = 10000
+
+
+@pytest.fixture
+def server(loop):
+    """/declared 在Content-Length中声明大小,/chunked 不声明大小分块发送"""
+    state = {'sent': 0, 'size': 0}
+
+    async def declared(request):
+        state['sent'] = 0
+        return web.Response(body=b'd' * state['size'])
+
+    async def chunked(request):
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        state['sent'] = 0
+        while state['sent'] < state['size']:
+            await response.write(b'c' * 1024)
+            state['sent'] += 1024
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_get('/declared', declared)
+    app.router.add_get('/chunked', chunked)
+    runner = web.AppRunner(app)
+
+    async def start():
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        return site._server.sockets[0].getsockname()[1]
+
+    state['base'] = f"http://127.0.0.1:{loop.run_until_complete(start())}"
+    yield state
+    loop.run_until_complete(runner.cleanup())
+
+
+@pytest.fixture
+def plugin(make_plugin):
+    return make_plugin(download_retry_backoff=0.001, download_chunk_size_kb=1)
+
+
+def temp_path(plugin):
+    os.makedirs(plugin.storage_path, exist_ok=True)
+    return os.path.join(plugin.storage_path, 'temp_file_x')
+
+
+def test_declared_size_over_limit_rejected_before_writing(loop, plugin, server):
+    server['size'] = LIMIT + 1
+    path = temp_path(plugin)
+
+    with pytest.raises(main.DownloadSizeExceeded) as info:
+        loop.run_until_complete(plugin._download_to_temp(f"{server['base']}/declared", path, LIMIT))
+
+    assert info.value.size == LIMIT + 1
+    assert not os.path.exists(path)
+
+
+def test_undeclared_size_stops_at_limit(loop, plugin, server):
+    server['size'] = 100 * 1024
+    path = temp_path(plugin)
+
+    with pytest.raises(main.DownloadSizeExceeded):
+        loop.run_until_complete(plugin._download_to_temp(f"{server['base']}/chunked", path, LIMIT))
+
+    # 超出上限的部分不会写盘
+    assert os.path.getsize(path) <= LIMIT
+
+
+@pytest.mark.parametrize('route', ['declared', 'chunked'])
+def test_file_within_limit_downloads(loop, plugin, server, route):
+    server['size'] = 8 * 1024
+    path = temp_path(plugin)
+
+    result = loop.run_until_complete(plugin._download_to_temp(f"{server['base']}/{route}", path, LIMIT))
+
+    assert result['size'] == 8 * 1024
+    assert os.path.getsize(path) == 8 * 1024
+
+
+def test_no_limit_means_unbounded(loop, plugin, server):
+    server['size'] = 64 * 1024
+    path = temp_path(plugin)
+
+    result = loop.run_until_complete(plugin._download_to_temp(f"{server['base']}/chunked", path))
+
+    assert result['size'] == 64 * 1024
+
+
+class FakeResponse:
+    def __init__(self, content_length=None, content_range=None):
+        self.content_length = content_length
+        self.headers = {'Content-Range': content_range} if content_range else {}
+
+
+@pytest.mark.parametrize('response, offset, exceeded', [
+    (FakeResponse(content_length=LIMIT), 0, False),
+    (FakeResponse(content_length=LIMIT + 1), 0, True),
+    # 续传时Content-Length只是剩余部分,要加上已下载的字节
+    (FakeResponse(content_length=LIMIT - 100), 200, True),
+    # Content-Range给出的总大小优先
+    (FakeResponse(content_length=10, content_range=f'bytes 100-109/{LIMIT + 5}'), 100, True),
+    (FakeResponse(), 0, False),
+])
+def test_check_declared_size(plugin, response, offset, exceeded):
+    if exceeded:
+        with pytest.raises(main.DownloadSizeExceeded):
+            plugin._check_declared_size(response, offset, LIMIT)
+    else:
+        plugin._check_declared_size(response, offset, LIMIT)
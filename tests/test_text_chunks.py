@@ -0,0 +1,120 @@
+"""大文本文件流式分块读取的测试"""
+import pytest
+
+import main
+
+estimate = main.PluginMain._estimate_tokens
+
+
+@pytest.fixture
+def plugin(make_plugin):
+    return make_plugin()
+
+
+def write(tmp_path, text, encoding='utf-8', name='a.txt'):
+    path = tmp_path / name
+    path.write_bytes(text.encode(encoding))
+    return str(path)
+
+
+def chunks(plugin, path, budget, encoding=None):
+    return list(plugin._iter_text_chunks(path, encoding, budget))
+
+
+def test_estimate_tokens():
+    assert estimate('') == 0
+    assert estimate('abcd') == 1
+    assert estimate('abcde') == 2
+    assert estimate('中文') == 2
+    assert estimate('中文ab') == 3
+
+
+def test_chunks_stay_within_token_budget_and_keep_all_lines(plugin, tmp_path):
+    lines = [f"line {i} " + 'word ' * (i % 17) for i in range(2000)]
+    path = write(tmp_path, '\n'.join(lines) + '\n')
+
+    result = chunks(plugin, path, 200)
+
+    assert len(result) > 1
+    assert all(estimate(chunk) <= 200 for chunk in result)
+    assert [line.strip() for line in '\n'.join(result).split('\n')] == [line.strip() for line in lines]
+
+
+def test_long_line_is_hard_split(plugin, tmp_path):
+    text = 'abcdefghij' * 10000
+    path = write(tmp_path, text)
+
+    result = chunks(plugin, path, 100)
+
+    assert all(estimate(chunk) <= 100 for chunk in result)
+    assert ''.join(result) == text
+
+
+def test_long_cjk_line_is_hard_split(plugin, tmp_path):
+    text = '中文内容' * 5000
+    path = write(tmp_path, text)
+
+    result = chunks(plugin, path, 300)
+
+    assert all(estimate(chunk) <= 300 for chunk in result)
+    assert ''.join(result) == text
+
+
+def test_splits_at_paragraph_once_half_full(plugin, tmp_path):
+    first = 'a' * 240 + '\n'
+    second = 'b' * 240 + '\n'
+    path = write(tmp_path, first + '\n' + second)
+
+    result = chunks(plugin, path, 100)
+
+    # 第一段约60个token,超过一半后遇到空行即切分,第二段单独成块
+    assert result == ['a' * 240, 'b' * 240]
+
+
+def test_whitespace_only_file_yields_nothing(plugin, tmp_path):
+    path = write(tmp_path, '\n \n\t\n' * 100)
+
+    assert chunks(plugin, path, 50) == []
+
+
+def test_encoding_detected_when_not_given(plugin, tmp_path):
+    text = '这是一个使用GBK编码保存的中文文本文件。\n' * 50
+    path = write(tmp_path, text, encoding='gbk')
+
+    result = chunks(plugin, path, 10000)
+
+    assert result == [text.strip()]
+
+
+def run_auto_read(loop, plugin, path, max_chunks):
+    submitted, replies = [], []
+
+    async def submit(event, content, filename):
+        submitted.append((filename, content))
+
+    async def reply(event, message):
+        replies.append(message)
+
+    plugin._submit_auto_read = submit
+    plugin._send_reply = reply
+    plugin.auto_read_chunk_tokens = 100
+    plugin.auto_read_max_chunks = max_chunks
+    loop.run_until_complete(plugin._auto_read_text_file(None, 'a.txt', path))
+    return submitted, replies
+
+
+def test_auto_read_single_chunk_has_no_label(loop, plugin, tmp_path):
+    submitted, replies = run_auto_read(loop, plugin, write(tmp_path, 'short text\n'), 3)
+
+    assert submitted == [('a.txt', 'short text')]
+    assert replies == []
+
+
+def test_auto_read_labels_chunks_and_stops_at_limit(loop, plugin, tmp_path):
+    path = write(tmp_path, ''.join(f'line {i} ' + 'x' * 60 + '\n' for i in range(200)))
+
+    submitted, replies = run_auto_read(loop, plugin, path, 3)
+
+    assert [name for name, _ in submitted] == [f'a.txt (第{i}部分)' for i in (1, 2, 3)]
+    assert submitted[0][1].startswith('[a.txt (第1部分)]\nline 0 ')
+    assert replies == ['📄 文件较长,已自动读取前3部分,其余内容未提交']
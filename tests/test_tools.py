@@ -0,0 +1,78 @@
+"""LLM工具的访问控制与读取、搜索、删除的测试"""
+import os
+from types import SimpleNamespace
+
+
+def tool_context(user_id='10', group_id=''):
+    sender = SimpleNamespace(user_id=user_id)
+    event = SimpleNamespace(message_obj=SimpleNamespace(sender=sender, group_id=group_id))
+    return SimpleNamespace(context=SimpleNamespace(event=event))
+
+
+def test_missing_caller_is_denied(make_plugin):
+    plugin = make_plugin()
+    no_event = SimpleNamespace(context=SimpleNamespace())
+    assert plugin._tool_access_error(no_event, 'user', '10') == "错误:无法确认调用者,拒绝访问文件"
+    assert plugin._tool_access_error(None, 'group', '20') == "错误:无法确认调用者,拒绝访问文件"
+    assert plugin._tool_access_error(no_event, 'user', '10', require_caller=False) is None
+
+
+def test_only_own_user_files(make_plugin):
+    plugin = make_plugin()
+    assert plugin._tool_access_error(tool_context('10'), 'user', '10') is None
+    assert plugin._tool_access_error(tool_context('10'), 'user', '11') == "错误:只能访问当前用户自己的文件"
+
+
+def test_only_current_group_files(make_plugin):
+    plugin = make_plugin()
+    assert plugin._tool_access_error(tool_context('10', '20'), 'group', '20') is None
+    assert plugin._tool_access_error(tool_context('10', '20'), 'group', '21') == "错误:只能访问当前群的文件"
+    # 私聊中不能访问任何群的文件
+    assert plugin._tool_access_error(tool_context('10'), 'group', '20') == "错误:只能访问当前群的文件"
+
+
+def test_tool_entity_prefers_group():
+    import main
+    assert main.PluginMain._tool_entity({'group_id': ' 20 ', 'user_id': '10'}) == ('group', '20')
+    assert main.PluginMain._tool_entity({'user_id': 10}) == ('user', '10')
+    assert main.PluginMain._tool_entity({}) == (None, None)
+
+
+def test_read_file_by_index_and_name_in_ranges(loop, make_plugin, add_file):
+    plugin = make_plugin()
+    add_file(plugin, '10', 'first.txt', content='0123456789'.encode(), receive_time=1)
+    add_file(plugin, '10', 'second.txt', content=b'second', receive_time=2)
+
+    part = loop.run_until_complete(plugin._tool_read_file('user', '10', {'file_index': 1, 'length': 4}))
+    assert 'first.txt' in part and '0123' in part and 'offset=4' in part
+    rest = loop.run_until_complete(plugin._tool_read_file('user', '10', {'file_name': 'first', 'offset': 4}))
+    assert '456789' in rest and '[已读取到文件末尾]' in rest
+
+    out_of_range = loop.run_until_complete(plugin._tool_read_file('user', '10', {'file_index': 3}))
+    assert out_of_range == "错误:序号超出范围 (1-2)"
+
+
+def test_search_matches_names_and_content(loop, make_plugin, add_file):
+    plugin = make_plugin()
+    add_file(plugin, '10', 'budget.txt', content=b'nothing here', receive_time=1)
+    add_file(plugin, '10', 'notes.txt', content=b'the budget is final', receive_time=2)
+
+    result = loop.run_until_complete(plugin._tool_search_files('user', '10', 'budget', 5))
+    names, contents = result.split('内容匹配:')
+    assert '1. budget.txt' in names
+    assert '2. notes.txt' in contents and 'budget is final' in contents
+
+    missing = loop.run_until_complete(plugin._tool_search_files('user', '10', 'zzzz', 5))
+    assert missing.startswith('未找到与 zzzz 相关的文件')
+
+
+def test_delete_file_removes_record_and_file(loop, make_plugin, add_file):
+    plugin = make_plugin()
+    record = add_file(plugin, '10', 'gone.txt')
+
+    result = loop.run_until_complete(plugin._tool_delete_file('user', '10', {'file_name': 'gone.txt'}))
+    assert result.startswith('已删除文件: gone.txt')
+    assert not os.path.exists(record['file_path'])
+    assert plugin.store.list_records('user', '10') == []
+    again = loop.run_until_complete(plugin._tool_delete_file('user', '10', {'file_name': 'gone.txt'}))
+    assert again == "该用户暂无文件"
@@ -0,0 +1,71 @@
+"""按ZIP中央目录区分Office文档、jar、apk、epub等容器格式的测试"""
+import os
+import zipfile
+
+import pytest
+
+import main
+
+
+def make_zip(path, entries, compression=zipfile.ZIP_STORED):
+    with zipfile.ZipFile(path, 'w', compression) as zf:
+        for name, data in entries:
+            zf.writestr(name, data)
+    return str(path)
+
+
+PADDING = ('docProps/thumbnail.bin', os.urandom(64 * 1024))
+
+
+@pytest.mark.parametrize('entries, expected', [
+    # word/条目位于8KB之后,只看文件开头无法识别
+    ([('[Content_Types].xml', '<Types/>'), PADDING, ('word/document.xml', '<w:document/>')], '.docx'),
+    ([('[Content_Types].xml', '<Types/>'), PADDING, ('xl/workbook.xml', '<workbook/>')], '.xlsx'),
+    ([('[Content_Types].xml', '<Types/>'), PADDING, ('ppt/presentation.xml', '<p/>')], '.pptx'),
+    ([('META-INF/MANIFEST.MF', 'Manifest-Version: 1.0'), ('AndroidManifest.xml', b'\x03\x00'),
+      ('classes.dex', b'dex\n035')], '.apk'),
+    ([('META-INF/MANIFEST.MF', 'Manifest-Version: 1.0'), ('App.class', b'\xca\xfe\xba\xbe')], '.jar'),
+    ([('mimetype', 'application/epub+zip'), ('OEBPS/content.opf', '<package/>')], '.epub'),
+    ([('mimetype', 'application/vnd.oasis.opendocument.text'), ('content.xml', '<office/>')], '.odt'),
+    # 带有word目录但没有[Content_Types].xml的只是普通ZIP
+    ([('word/readme.txt', 'hello'), ('notes.txt', 'hi')], '.zip'),
+    ([('[Content_Types].xml', '<Types/>'), ('other/x.xml', '<x/>')], '.zip'),
+])
+def test_detect_zip_container(tmp_path, entries, expected):
+    path = make_zip(tmp_path / 'file.bin', entries)
+
+    assert main.detect_zip_container(path) == expected
+
+
+def test_detect_zip_container_with_deflated_entries(tmp_path):
+    entries = [('[Content_Types].xml', '<Types/>' * 1000), PADDING, ('word/document.xml', '<w:document/>')]
+    path = make_zip(tmp_path / 'file.bin', entries, zipfile.ZIP_DEFLATED)
+
+    assert main.detect_zip_container(path) == '.docx'
+
+
+def test_oversized_mimetype_entry_is_ignored(tmp_path):
+    path = make_zip(tmp_path / 'file.bin', [('mimetype', 'application/epub+zip' + ' ' * 200)])
+
+    assert main.detect_zip_container(path) == '.zip'
+
+
+@pytest.mark.parametrize('content', [b'', b'PK\x03\x04 truncated', os.urandom(4096)])
+def test_non_zip_returns_none(tmp_path, content):
+    path = tmp_path / 'junk.bin'
+    path.write_bytes(content)
+
+    assert main.detect_zip_container(str(path)) is None
+
+
+def test_missing_file_returns_none(tmp_path):
+    assert main.detect_zip_container(str(tmp_path / 'missing.zip')) is None
+
+
+def test_sniff_file_uses_central_directory(make_plugin, tmp_path):
+    plugin = make_plugin()
+    path = make_zip(tmp_path / 'report', [
+        ('[Content_Types].xml', '<Types/>'), PADDING, ('word/document.xml', '<w:document/>')
+    ])
+
+    assert plugin._sniff_file(path)['file_type'] == '.docx'